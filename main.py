@@ -5,56 +5,305 @@ import time
 import shlex
 import socket
 import queue
+import signal
+import threading
+import asyncio
 import logging
 import subprocess
-from concurrent.futures import ThreadPoolExecutor
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import argparse
 
-from azure.iot.device import IoTHubDeviceClient, Message
-
 from utils.forza_telemetry import TelemetryManager
-from utils.file_upload import upload_file_through_iothub
+from utils.telemetry_formats import registry_from_config
+from utils.file_upload import BlobUploader
+from utils.udp_receiver import UdpReceiver, ReceiverStats, enable_reuse_port
+from utils.race_state import RaceStateMachine, RACE_STARTED, RACE_RECORDING, RACE_ENDED, RACE_ON
+from utils.pipeline import Pipeline
+from utils.work_queue import WorkQueue
+from utils.message_batcher import MessageBatcher, encode_message
+from utils.metrics import MetricsRegistry, MetricsServer, SnapshotWriter
+from utils.profiling import ProfilerHook
+from utils.race_summary import RaceSummary
+from utils.forwarder import Forwarder
+from utils.archive import SessionArchive
+from utils.spool import SpoolManager
+from utils.async_io import TelemetryProtocol, BlockingDeviceClient
+from utils.device_connection import DeviceConnection
+from utils.settings import settings_from_config, ConfigWatcher
+from utils.supervisor import Supervisor, SharedCounters, shard_config, SHARDING_MODES
 
 BASE_DIR = "."
 CONFIG_FNAME = os.path.join("config", "forza_config.json")
 LOG_FILE_NAME = 'forza_iot.log'
+# Applied by a config reload, see utils.settings.
+RELOADABLE_DEVICE_KEYS = ("debug", "3_lap_race", "send_ip", "send_port")
 
-tp = ThreadPoolExecutor(10)  # max 10 threads
-def threaded(fn):
-    def wrapper(*args, **kwargs):
-        return tp.submit(fn, *args, **kwargs)  # returns Future object
-    return wrapper
+class ConsoleSession():
+    # Race state, telemetry file and IoT Hub properties of a single console,
+    # keyed by its source IP address and telemetry format.
+
+    def __init__(self,
+                 source_ip:str,
+                 telemetry_manager:TelemetryManager,
+                 three_lap_race:bool,
+                 message_batcher:MessageBatcher,
+                 race_summary:RaceSummary=None,
+                 format_name:str=None):
+        self.source_ip = source_ip
+        self.format_name = format_name
+        self.telemetry_manager = telemetry_manager
+        self.race_state = RaceStateMachine(three_lap_race)
+        self.message_batcher = message_batcher
+        self.race_summary = race_summary
+        self.last_log_time = time.time()
+        # Receive time of the first packet and number of packets of the
+        # recording segment, for the size and time based rotation.
+        self.segment_start_time = None
+        self.segment_packets = 0
+        # First recording and number of the next segment of the race, to
+        # link its rotated segments in the archive.
+        self.race_key = None
+        self.segment_index = 0
+        self.custom_properties = {"source_ip": source_ip}
+        if format_name is not None:
+            self.custom_properties["telemetry_format"] = format_name
 
 class ForzaIoTApp():
     
-    def __init__(self, base_dir, config_path):
-        with open(os.path.join(base_dir, config_path), "r") as f:
-            self.forza_config = json.load(f)
+    def __init__(self, base_dir, config_path, device_client=None, message_cls=None, forza_config=None,
+                 config_transform=None):
+        # device_client and message_cls replace the Azure IoT device SDK,
+        # e.g. with the stand-ins of utils.local_iothub.
+        # forza_config, if given, is used instead of the config file,
+        # e.g. the config of a supervisor worker.
+        # config_transform(forza_config) is applied to the reloaded config
+        # file, e.g. the sharding of a supervisor worker.
+        if forza_config is None:
+            with open(os.path.join(base_dir, config_path), "r") as f:
+                forza_config = json.load(f)
+        self.forza_config = forza_config
+        self.base_dir = base_dir
+        self.config_transform = config_transform
+        # The hot path reads the frozen settings, swapped on a config reload.
+        self.settings = settings_from_config(self.forza_config)
+        self._settings_lock = threading.Lock()
 
         self._init_logger()
 
         self._setup_udp_socket()
-        self.telemetry_manager = TelemetryManager(
-            self.forza_config["device"]["output_fname"],
-            self.forza_config["device"]["telemetry_format_fname"]
+        self.sessions = {}
+        self.recording_backend = self.forza_config["device"].get("recording_backend", "csv")
+        self.formats = registry_from_config(self.forza_config, self.logger)
+        self._init_forwarder()
+
+        # The client is created and connected in the background by run(),
+        # the Azure SDK is only imported then.
+        self.message_cls = message_cls
+        self.device = DeviceConnection(
+            partial(self._create_device_client, base_dir, device_client),
+            wrap=self._wrap_device_client,
+            retry_base_delay=self.forza_config["iothub"].get("connect_retry_base_delay", 1),
+            retry_max_delay=self.forza_config["iothub"].get("connect_retry_max_delay", 60),
+            logger=self.logger
         )
-        self.send_ip = self.forza_config["device"]["send_ip"]
-        self.send_port = self.forza_config["device"]["send_port"]
+        self._init_metrics()
+        self.running = False
 
-        # Get the connection string
-        # TODO(): Risk: the file is saved on the disk in plain text
-        conn_str_fname = os.path.join(base_dir, self.forza_config["iothub"]["conn_str_fname"])
-        self.conn_str = open(conn_str_fname, 'r').read()
-        
-        # Create instance of the device client using the authentication provider
-        self.device_client = IoTHubDeviceClient.create_from_connection_string(self.conn_str)
-        self.device_client.connect()
+        # Closed recording segments wait for upload in the spool, on a disk
+        # budget. With the spool, segments are rotated by size and time
+        # within a race too.
+        spool_config = self.forza_config.get("spool", {})
+        self.spool = None
+        self.segment_max_bytes = None
+        self.segment_max_seconds = None
+        if spool_config.get("enabled", False):
+            budget_mb = spool_config.get("budget_mb", None)
+            self.spool = SpoolManager(
+                os.path.join(base_dir, spool_config.get("dir", "data/spool")),
+                budget_bytes=int(budget_mb * 1024 * 1024) if budget_mb else None,
+                compress=spool_config.get("compress", False),
+                compress_level=spool_config.get("compress_level", 6),
+                logger=self.logger
+            )
+            segment_max_mb = spool_config.get("segment_max_mb", None)
+            self.segment_max_bytes = int(segment_max_mb * 1024 * 1024) if segment_max_mb else None
+            self.segment_max_seconds = spool_config.get("segment_max_seconds", None)
+
+        # One uploader, sharing the device client, for all race files.
+        self.uploader = BlobUploader(
+            self.device,
+            block_size=self.forza_config["device"].get("upload_block_size", 4*1024*1024),
+            compress=self.forza_config["device"].get("upload_compress", False),
+            max_rate=spool_config.get("upload_max_rate", None)
+        )
+
+        # Finished recordings are indexed in the local session archive.
+        archive_config = self.forza_config.get("archive", {})
+        self.archive = None
+        if archive_config.get("enabled", False):
+            self.archive = SessionArchive(os.path.join(base_dir, archive_config.get("dir", "data/archive")))
+
+        # Messages, closed segments and uploads go through a journaled
+        # queue, so they are retried on failure and survive a restart.
+        work_queue_config = self.forza_config.get("work_queue", {})
+        max_retries = work_queue_config.get("max_retries", 10)
+        self.work_queue = WorkQueue(
+            os.path.join(base_dir, work_queue_config.get("journal_fname", "data/work_queue.sqlite")),
+            handlers={
+                "message": self._send_message,
+                "segment": self._close_segment,
+                "upload": self._upload_file,
+            },
+            concurrency={
+                "message": work_queue_config.get("message_concurrency", 2),
+                "upload": work_queue_config.get("upload_concurrency", 1),
+            },
+            max_retries={
+                "message": max_retries,
+                "segment": max_retries,
+                "upload": work_queue_config.get("upload_max_retries", max_retries),
+            },
+            retry_base_delay=work_queue_config.get("retry_base_delay", 1),
+            retry_max_delay=work_queue_config.get("retry_max_delay", 300),
+            logger=self.logger
+        )
+        self.drain_timeout = work_queue_config.get("drain_timeout", 10)
+        self.join_timeout = work_queue_config.get("join_timeout", 5)
+
+        # The config file is watched for changes of the reloadable settings.
+        watch_config = self.forza_config.get("config_watch", {})
+        self.config_watcher = None
+        if config_path is not None and watch_config.get("enabled", False):
+            self.config_watcher = ConfigWatcher(
+                os.path.join(base_dir, config_path),
+                self.reload_config,
+                interval=watch_config.get("interval", 2),
+                logger=self.logger
+            )
         
+    def _create_device_client(self, base_dir, device_client):
+        # Called on the connection thread, DeviceConnection connects it.
+        if device_client is None:
+            from azure.iot.device import IoTHubDeviceClient
+            # Get the connection string
+            # TODO(): Risk: the file is saved on the disk in plain text
+            conn_str_fname = os.path.join(base_dir, self.forza_config["iothub"]["conn_str_fname"])
+            self.conn_str = open(conn_str_fname, 'r').read()
+
+            # Create instance of the device client using the authentication provider
+            device_client = IoTHubDeviceClient.create_from_connection_string(self.conn_str)
+        return device_client
+
+    def _wrap_device_client(self, device_client):
+        return device_client
+
+    def _init_forwarder(self):
+        # Forward the udp packages to somewhere else, e.g. driving simulator.
+        self.forwarder = None
+        if self.settings.forward_targets:
+            dtypes = [telemetry_format.parser.dtype for telemetry_format in self.formats.formats.values()]
+            self.forwarder = Forwarder(self.settings.forward_targets, dtypes, self.logger)
+
+    def reload_config(self, forza_config:dict):
+        # Swap in the settings of a changed config, keeping the socket,
+        # the recordings and the race states. Called by the config watcher.
+        if self.config_transform is not None:
+            forza_config = self.config_transform(forza_config)
+        settings = settings_from_config(forza_config)
+        with self._settings_lock:
+            old = self.settings
+            if settings.forward_targets != old.forward_targets:
+                if self.forwarder is None:
+                    dtypes = [telemetry_format.parser.dtype for telemetry_format in self.formats.formats.values()]
+                    self.forwarder = Forwarder(settings.forward_targets, dtypes, self.logger)
+                else:
+                    # The forwarding thread closes the targets it no longer
+                    # uses, the forwarder stays if all of them are dropped.
+                    self.forwarder.set_targets(settings.forward_targets)
+            if settings.three_lap_race != old.three_lap_race:
+                # Read at the end of the race, so it applies to the races
+                # in progress too.
+                for session in list(self.sessions.values()):
+                    session.race_state.three_lap_race = settings.three_lap_race
+            self.logger.setLevel(logging.INFO if settings.debug else logging.WARNING)
+            self.settings = settings
+            self._settings_changed(old, settings)
+        # The rest of the config is read once, at startup.
+        changed = [
+            section for section in sorted(set(forza_config) | set(self.forza_config))
+            if section not in ("device", "forwarding")
+            and forza_config.get(section, None) != self.forza_config.get(section, None)
+        ]
+        changed += [
+            "device." + key for key in sorted(set(forza_config["device"]) | set(self.forza_config["device"]))
+            if key not in RELOADABLE_DEVICE_KEYS
+            and forza_config["device"].get(key, None) != self.forza_config["device"].get(key, None)
+        ]
+        if changed:
+            self.logger.warning("Config changed in {}, restart to apply it.".format(", ".join(changed)))
+        print("Config reloaded: debug {}, 3_lap_race {}, {} forward targets.".format(
+            settings.debug, settings.three_lap_race, len(settings.forward_targets)))
+
+    def _settings_changed(self, old, settings):
+        pass
+
+    def _init_metrics(self):
+        # Hot path metrics. The stages keep references to the histograms
+        # and counters, recording is a bisect and an increment.
+        self.metrics = MetricsRegistry()
+        self.parse_latency = self.metrics.histogram(
+            "recv_to_parse_seconds", "Time from receiving a packet to parsing it.")
+        self.write_latency = self.metrics.histogram(
+            "parse_to_write_seconds", "Time from parsing a packet to recording it.")
+        self.record_latency = self.metrics.histogram(
+            "recv_to_write_seconds", "Time from receiving a packet to recording it.")
+        self.message_latency = self.metrics.histogram(
+            "enqueue_to_ack_seconds", "Time from queuing a message to its IoT Hub acknowledgement.")
+        self._message_latency_lock = threading.Lock()
+        self.packets_parsed = self.metrics.counter("packets_parsed", "Packets parsed.")
+        self.packets_recorded = self.metrics.counter("packets_recorded", "Packets written to the race files.")
+        # Forwarder targets ("ip:port") and format names go to labels.
+        self.metrics.add_collector(self.stats, labels={"forwarder": "target", "formats": "format"})
+        self.metrics_server = None
+        self.snapshot_writer = None
+
+    def _start_metrics(self):
+        metrics_config = self.forza_config.get("metrics", {})
+        if not metrics_config.get("enabled", False):
+            return
+        if metrics_config.get("port", None) is not None:
+            self.metrics_server = MetricsServer(
+                self.metrics,
+                metrics_config.get("host", "127.0.0.1"),
+                metrics_config["port"]
+            ).start()
+            print("Metrics at http://{}:{}/metrics".format(metrics_config.get("host", "127.0.0.1"), self.metrics_server.port))
+        if metrics_config.get("snapshot_fname", None):
+            self.snapshot_writer = SnapshotWriter(
+                self.metrics,
+                os.path.join(self.base_dir, metrics_config["snapshot_fname"]),
+                metrics_config.get("snapshot_interval", 10)
+            ).start()
+        if metrics_config.get("profiler_dir", None):
+            ProfilerHook(os.path.join(self.base_dir, metrics_config["profiler_dir"]), logger=self.logger).install()
+
+    def _stop_metrics(self):
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        if self.snapshot_writer is not None:
+            self.snapshot_writer.stop()
+
+    def _record_message_latency(self, message:dict):
+        enqueue_time = message.get("enqueue_time", None)
+        if enqueue_time is not None:
+            with self._message_latency_lock:
+                self.message_latency.record(time.time() - enqueue_time)
+
     def _init_logger(self):
 
         self.logger = logging.getLogger(__name__)
-        if self.forza_config["device"].get("debug", False):
+        if self.settings.debug:
             self.logger.setLevel(logging.INFO)
         else:
             self.logger.setLevel(logging.WARNING)
@@ -76,173 +325,650 @@ class ForzaIoTApp():
     def _setup_udp_socket(self):
         recv_ip = self.forza_config["device"]["receive_ip"] #"" #"10.94.72.86" # "0.0.0.0" #"127.0.0.1"
         recv_port = self.forza_config["device"]["receive_port"]
-        self.sock = socket.socket(socket.AF_INET, # Internet
-                             socket.SOCK_DGRAM) # UDP
-        self.sock.bind((recv_ip, recv_port))
         # Set timeout to jump out of the blocked listening,
         # so that keyboard interupt can be receviced.
-        self.sock.settimeout(1)
+        self.receiver = UdpReceiver(
+            recv_ip,
+            recv_port,
+            recv_buffer_size=self.forza_config["device"].get("recv_buffer_size", 4*1024*1024),
+            ring_size=self.forza_config["device"].get("recv_ring_size", 1024),
+            batch_size=self.forza_config["device"].get("recv_batch_size", 64),
+            timeout=1,
+            reuse_port=self.forza_config["device"].get("recv_reuse_port", False)
+        )
+        self.sock = self.receiver.sock
+
+    def _get_session(self, addr:tuple, telemetry_format) -> ConsoleSession:
+        source_ip = addr[0]
+        session = self.sessions.get((source_ip, telemetry_format.name), None)
+        if session is None:
+            # Each console records into its own file,
+            # e.g. data/telemetry_192-168-1-20.csv, and each format other
+            # than the primary one too, e.g. data/telemetry_192-168-1-20_fm7_dash.csv
+            output_fname, ext = os.path.splitext(self.forza_config["device"]["output_fname"])
+            output_fname += "_" + source_ip.replace(".", "-").replace(":", "-")
+            format_name = None
+            if telemetry_format.name != self.formats.primary:
+                format_name = telemetry_format.name
+                output_fname += "_" + format_name
+            output_fname += ext
+            telemetry_manager = TelemetryManager(
+                output_fname,
+                telemetry_format.parser.telemetry_format_fname,
+                recording_backend=self.recording_backend,
+                chunk_rows=self.forza_config["device"].get("recording_chunk_rows", 600),
+                export_csv=self.forza_config["device"].get("recording_export_csv", False),
+                telemetry_parser=telemetry_format.parser
+            )
+            output_fname = telemetry_manager.output_file_name
+            messages_config = self.forza_config.get("messages", {})
+            summary_config = self.forza_config.get("race_summary", {})
+            race_summary = None
+            if summary_config.get("enabled", True):
+                race_summary = RaceSummary(n_sectors=summary_config.get("n_sectors", 3))
+            session = ConsoleSession(
+                source_ip,
+                telemetry_manager,
+                self.settings.three_lap_race,
+                MessageBatcher(
+                    mode=messages_config.get("mode", "single"),
+                    window=messages_config.get("window", 1),
+                    rate=messages_config.get("rate", None),
+                    fields=messages_config.get("fields", None),
+                    reduce_config=messages_config.get("reduce", None)
+                ),
+                race_summary,
+                format_name
+            )
+            self.sessions[(source_ip, telemetry_format.name)] = session
+            print("New console {}, recording to {}.".format(source_ip, output_fname))
+        return session
     
-    @threaded
     def _send_message(self, message):
         
         # Send a single message
-        print("Sending message...")
-        iothub_msg = Message(
-            json.dumps(message["data"]),
-            content_encoding="UTF-8",
-            content_type="application/json"
+        self.logger.info("Sending message...")
+        self.device.send_message(self._build_message(message))
+        self._record_message_latency(message)
+
+    def _build_message(self, message:dict):
+        messages_config = self.forza_config.get("messages", {})
+        body, content_type, content_encoding = encode_message(
+            message["data"],
+            messages_config.get("encoding", "json"),
+            messages_config.get("compress", False)
+        )
+        if self.message_cls is None:
+            from azure.iot.device import Message
+            self.message_cls = Message
+        iothub_msg = self.message_cls(
+            body,
+            content_encoding=content_encoding,
+            content_type=content_type
         )
         properties = message.get("custom_properties", None)
         if properties is not None:
             iothub_msg.custom_properties.update(properties)
-        self.device_client.send_message(iothub_msg)
-        print("Message successfully sent!")
+        return iothub_msg
     
-    @threaded
-    def _upload_file(self, path_to_src:str, dst_fname:str):
-        upload_file_through_iothub(self.conn_str, path_to_src, dst_fname)
-    
-    def _check_position(curr_pos:iter, start_pos:iter, threshold:float=200**2) -> bool:
-        # The threshold is for the slight difference between
-        # the starting position and the ending position.
-        # Before a racing, your car is usually waiting at around 100 unit length
-        # before the starting/ending line, which is known as the staging line.
-        diff_pos = [(curr_i - start_i) ** 2 for curr_i, start_i in zip(curr_pos, start_pos)]
-        diff_pos = sum(diff_pos)
-        return diff_pos < threshold
-    
-    def _update_race_status(self, cur_status:int, race_pos_not_zero:bool, race_time_not_zero:bool) -> int:
-        # cur_status: 0: not in race event,
-        #             1: race event starts, will be set to 2 outside afterwards
-        #             2: race event is on,
-        #             3: race event stops, will be set to 0 or 4 outside afterwards
-        #             4: race event is paused
-        #
-        # status transfer table:
-        # cur_status, race_pos_not_zero, race_time_not_zero, next_status
-        #          0,                 0,                              0
-        #          0,                 1,                 0,           0
-        #          0,                 1,                 1,           1
-        #          2,                 0,                              3
-        #          2,                 1,                              2
-        #          4,                 0,                              4
-        #          4,                 1,                              2
-        if cur_status == 0 and race_pos_not_zero is True and race_time_not_zero is True:
-            return 1
-        if cur_status == 2 and race_pos_not_zero is False:
-            return 3
-        if cur_status == 4 and race_pos_not_zero is True:
-            return 2
-        return cur_status
+    def _upload_file(self, job:dict):
+        path_to_src = job["path_to_src"]
+        if not os.path.isfile(path_to_src):
+            # Deleted by the spool to stay within its disk budget.
+            self.logger.warning("{} is gone, skipping its upload.".format(path_to_src))
+            return
+        # Resumes from the upload manifest if a previous attempt failed.
+        # Segments compressed by the spool are uploaded as they are.
+        compress = False if path_to_src.endswith(".gz") else None
+        if self.spool is None:
+            self.uploader.upload_sync(path_to_src, job["dst_fname"], compress=compress)
+            return
+        # The spool does not evict the segment while it is uploaded.
+        with self.spool.uploading(path_to_src):
+            self.uploader.upload_sync(path_to_src, job["dst_fname"], compress=compress)
+        self.spool.uploaded(path_to_src)
+
+    def _close_segment(self, job:dict):
+        # Archive and spool a closed recording segment, then queue its
+        # upload. Every step can be repeated if the job is retried.
+        path, recording = job["path"], job["recording"]
+        if self.archive is not None:
+            telemetry_format = self.formats.formats[job["format"]]
+            self.archive.add(
+                recording,
+                telemetry_format.parser,
+                format_name=telemetry_format.name,
+                three_lap_race=self.settings.three_lap_race,
+                ended=job.get("ended", None),
+                session=job.get("session", None),
+                segment=job.get("segment", 0)
+            )
+        if self.spool is not None:
+            if recording != path:
+                # The recording of a CSV export is kept, not uploaded.
+                self.spool.add(recording, uploaded=True)
+            path = self.spool.add(path)
+        self.work_queue.submit("upload", {
+            "path_to_src": path,
+            "dst_fname": os.path.basename(path)
+        })
     
+    def _build_pipeline(self):
+        # receiver (main thread) -> parser -> race_state -> recorder
+        #                       |                         -> iothub
+        #                       -> forwarder
+        # The parser and the forwarder read the receive ring in place.
+        pipeline_config = self.forza_config.get("pipeline", {})
+        queue_size = pipeline_config.get("queue_size", 1024)
+        sample_every = pipeline_config.get("sample_every", 4)
+        backpressure = pipeline_config.get("backpressure", {})
+
+        self.pipeline = Pipeline(self.logger)
+        def add_stage(name, handler, default_policy, on_drop=None):
+            self.pipeline.add_stage(
+                name,
+                handler,
+                maxsize=queue_size,
+                policy=backpressure.get(name, default_policy),
+                sample_every=sample_every,
+                on_drop=on_drop
+            )
+        # Dropped batches still hold slots of the receiver ring.
+        add_stage("parser", self._parse_batch, "drop_oldest",
+                  on_drop=lambda item: item[1].done())
+        add_stage("race_state", self._update_race_state, "block")
+        add_stage("recorder", self._write_telemetry, "block")
+        add_stage("iothub", self._queue_message, "drop_oldest")
+        add_stage("forwarder", self._forward, "drop_oldest",
+                  on_drop=lambda shared_batch: shared_batch.done())
+
     def run(self):
-        
-        race_event_status = 0
-        start_pos = None
 
+        self._build_pipeline()
+        self.pipeline.start()
+        self.device.start()
+        self.work_queue.start()
+        self._start_metrics()
+        self._start_config_watcher()
+        print("Ready. Waiting for messages.")
+        last_stats_time = time.time()
+        self.running = True
+        try:
+            while self.running:
+
+                batch = self.receiver.recv_batch()
+                if batch:
+                    recv_time = time.time()
+                    if self.forwarder is None:
+                        self.pipeline.put("parser", (recv_time, self.receiver.share(batch, 1)))
+                    else:
+                        shared_batch = self.receiver.share(batch, 2)
+                        self.pipeline.put("forwarder", shared_batch)
+                        self.pipeline.put("parser", (recv_time, shared_batch))
+
+                if self.settings.debug:
+                    this_stats_time = time.time()
+                    if this_stats_time - last_stats_time > 1:
+                        self.logger.info(self.stats())
+                        last_stats_time = this_stats_time
+        finally:
+            self.pipeline.stop()
+            # Jobs waiting for an IoT Hub connection give up and stay in
+            # the journal, instead of holding the drain for drain_timeout.
+            self.device.stop()
+            self.work_queue.shutdown(self.drain_timeout, self.join_timeout)
+            self._stop_metrics()
+            self._stop_config_watcher()
+            if self.forwarder is not None:
+                self.forwarder.close()
+
+    def _start_config_watcher(self):
+        if self.config_watcher is None:
+            return
+        self.config_watcher.start()
+        # kill -HUP <pid> reloads the config now.
+        if hasattr(signal, "SIGHUP") and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.config_watcher.reload())
+
+    def _stop_config_watcher(self):
+        if self.config_watcher is not None:
+            self.config_watcher.stop()
+
+    def stop(self):
+        # Makes run() return after the current receive timeout.
+        self.running = False
+
+    def stats(self) -> dict:
+        return {
+            "receiver": self.receiver.stats.as_dict(),
+            "pipeline": self.pipeline.stats(),
+            "work_queue": self.work_queue.stats(),
+            "forwarder": self.forwarder.stats() if self.forwarder is not None else {},
+            "formats": self.formats.stats(),
+            "spool": self.spool.stats() if self.spool is not None else {},
+            "iothub": self.device.stats(),
+            "config": self.config_watcher.stats() if self.config_watcher is not None else {},
+        }
+
+    def _record(self, item:tuple):
+        # (session, dict_telemetry, udp_data, recv_time, parse_time), or the
+        # end of a race if dict_telemetry is None.
+        self.pipeline.put("recorder", item)
+
+    def _publish(self, message:dict):
+        # Live telemetry, dropped first under back pressure.
+        message["enqueue_time"] = time.time()
+        self.pipeline.put("iothub", message)
+
+    def _queue_message(self, message:dict):
+        message.setdefault("enqueue_time", time.time())
+        self.work_queue.submit("message", message)
+
+    def _parse_batch(self, item:tuple):
+        recv_time, shared_batch = item
+        # Binary recorders keep the packet as received.
+        keep_udp_data = self.recording_backend != "csv"
+        try:
+            n_parsed = 0
+            for data, addr in shared_batch.batch:
+                # Unknown and malformed packets are counted by the registry,
+                # packets without race fields are only forwarded.
+                telemetry_format = self.formats.dispatch(data)
+                if telemetry_format is None or not telemetry_format.has_race_fields:
+                    continue
+                session = self._get_session(addr, telemetry_format)
+                # The ring slot is reused after release, so the record
+                # view gets a copy of the packet.
+                telemetry = session.telemetry_manager.view(bytes(data))
+                parse_time = time.time()
+                self.parse_latency.record(parse_time - recv_time)
+                udp_data = telemetry.data if keep_udp_data else None
+                self.pipeline.put("race_state", (session, telemetry, udp_data, recv_time, parse_time))
+                n_parsed += 1
+            self.packets_parsed.inc(n_parsed)
+        finally:
+            shared_batch.done()
+
+    def _forward(self, shared_batch):
+        # The forwarder is created by a config reload if there was none.
+        forwarder = self.forwarder
+        try:
+            if forwarder is not None:
+                forwarder.forward_batch(shared_batch.batch)
+        finally:
+            shared_batch.done()
+
+    def _update_race_state(self, item:tuple):
+        # telemetry is a record view of the packet; the race state machine
+        # only decodes the few fields it reads.
+        session, telemetry, udp_data, recv_time, parse_time = item
+
+        if self.settings.debug:
+            this_log_time = time.time()
+            if this_log_time - session.last_log_time > 1:
+                self.logger.info({
+                    k:telemetry[k] for k in self.telemetry_to_log
+                })
+                session.last_log_time = this_log_time
+
+        race_event = session.race_state.update(telemetry)
+        dict_telemetry = None
+        # Write the telemetry if in a race. The sinks of in-race packets
+        # need every field, so the packet is decoded once for all of them.
+        if race_event in (RACE_STARTED, RACE_RECORDING):
+            dict_telemetry = telemetry.to_dict()
+            self._record((session, dict_telemetry, udp_data, recv_time, parse_time))
+            if session.race_summary is not None:
+                if race_event == RACE_STARTED:
+                    session.race_summary.reset()
+                session.race_summary.update(dict_telemetry)
+
+        # The race summary is queued before the file upload, so that it
+        # reaches IoT Hub ahead of the recording.
+        if race_event == RACE_ENDED and session.race_summary is not None:
+            self._queue_message({
+                "data": session.race_summary.summary(),
+                "custom_properties": dict(session.custom_properties, message_type="race_summary")
+            })
+
+        # At the end of a race event, we will
+        #     1) rename the telemetry file,
+        #     2) send the telemetry file to Azure Storage, and
+        #     3) create a new file
+        # The recorder stage does it in order with the pending writes.
+        if race_event == RACE_ENDED:
+            self._record((session, None, None, None, None))
+
+        # Send telemetry data to IoT Hub once per message window
+        # if race event is on. The samples of the window left
+        # at the end of the race are sent too.
+        message_data = None
+        if session.race_state.status == RACE_ON:
+            message_data = session.message_batcher.add(dict_telemetry, recv_time)
+        elif race_event == RACE_ENDED:
+            message_data = session.message_batcher.flush()
+        if message_data is not None:
+            self._publish({
+                "data": message_data,
+                "custom_properties": session.custom_properties
+            })
+
+    def _write_telemetry(self, item:tuple):
+        session, dict_telemetry, udp_data, recv_time, parse_time = item
+        if dict_telemetry is not None:
+            session.telemetry_manager.write(dict_telemetry, udp_data, recv_time)
+            write_time = time.time()
+            self.write_latency.record(write_time - parse_time)
+            self.record_latency.record(write_time - recv_time)
+            self.packets_recorded.inc()
+            if self.segment_max_bytes or self.segment_max_seconds:
+                self._rotate_segment(session, recv_time)
+            return
+        self._submit_segment(session, ended=True)
+
+    def _rotate_segment(self, session:ConsoleSession, recv_time:float):
+        session.segment_packets += 1
+        if session.segment_start_time is None:
+            session.segment_start_time = recv_time
+        too_old = self.segment_max_seconds and recv_time - session.segment_start_time >= self.segment_max_seconds
+        # The size is checked every 60 packets, and lags by the write buffer.
+        too_big = self.segment_max_bytes and session.segment_packets % 60 == 0 \
+            and os.path.getsize(session.telemetry_manager.output_file_name) >= self.segment_max_bytes
+        if too_old or too_big:
+            self._submit_segment(session, ended=False)
+
+    def _submit_segment(self, session:ConsoleSession, ended:bool):
+        # Close the recording, at the end of a race or when it is rotated,
+        # and hand it to the work queue.
+        upload_file_name = session.telemetry_manager.prepare_upload_file()
+        # The recording itself, not its CSV export.
+        recording = session.telemetry_manager.last_output_fname or upload_file_name
+        if session.race_key is None:
+            session.race_key = recording
+        session.segment_start_time = None
+        session.segment_packets = 0
+        self.work_queue.submit("segment", {
+            "path": upload_file_name,
+            "recording": recording,
+            "format": session.format_name or self.formats.primary,
+            "ended": ended,
+            "session": session.race_key,
+            "segment": session.segment_index
+        })
+        if ended:
+            session.race_key = None
+            session.segment_index = 0
+        else:
+            session.segment_index += 1
+
+class AsyncForzaIoTApp(ForzaIoTApp):
+    """
+    Event loop runtime of the relay (--mode async).
+
+    Datagrams arrive through an asyncio.DatagramProtocol, and are parsed,
+    forwarded and run through the race state on the loop, without polling.
+    Telemetry messages are sent with the async device client of
+    azure.iot.device.aio; a message that fails goes to the journaled work
+    queue to be retried. Recording writes are batched and offloaded to a
+    single file I/O thread, uploads stay on the work queue.
+    """
+
+    def __init__(self, base_dir, config_path, device_client=None, message_cls=None, forza_config=None,
+                 config_transform=None):
+        super().__init__(base_dir, config_path, device_client, message_cls, forza_config, config_transform)
+        self.recv_stats = ReceiverStats()
+        self.loop = None
+        self.transport = None
+        self._stopped = None
+        self._flush_handle = None
+        self._pending_records = []
+        self._records_in_flight = 0
+        self._write_futures = set()
+        self._send_tasks = set()
+        self.messages_dropped = 0
+        self.max_send_tasks = self.forza_config.get("pipeline", {}).get("queue_size", 1024)
+        self.record_flush_interval = self.forza_config.get("async", {}).get("record_flush_interval", 0.01)
+        self._file_executor = ThreadPoolExecutor(1)
+        self._stats_task = None
+
+    def _create_device_client(self, base_dir, device_client):
+        if device_client is None:
+            from azure.iot.device.aio import IoTHubDeviceClient
+            conn_str_fname = os.path.join(base_dir, self.forza_config["iothub"]["conn_str_fname"])
+            self.conn_str = open(conn_str_fname, 'r').read()
+            device_client = IoTHubDeviceClient.create_from_connection_string(self.conn_str)
+        return device_client
+
+    def _wrap_device_client(self, device_client):
+        # The connection thread and the work queue call the async client
+        # on the event loop.
+        return BlockingDeviceClient(device_client, self.loop)
+
+    def _setup_udp_socket(self):
+        self.receiver = None
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(
+            socket.SOL_SOCKET,
+            socket.SO_RCVBUF,
+            self.forza_config["device"].get("recv_buffer_size", 4*1024*1024)
+        )
+        if self.forza_config["device"].get("recv_reuse_port", False):
+            enable_reuse_port(self.sock)
+        self.sock.bind((self.forza_config["device"]["receive_ip"], self.forza_config["device"]["receive_port"]))
+        self.sock.setblocking(False)
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._main())
+        finally:
+            self.loop.close()
+
+    def stop(self):
+        # Thread-safe, e.g. from the replay harness.
+        self.running = False
+        if self.loop is not None and self._stopped is not None:
+            self.loop.call_soon_threadsafe(self._stopped.set)
+
+    async def _main(self):
+        self._stopped = asyncio.Event()
+        self._send_slots = asyncio.Semaphore(
+            self.forza_config.get("work_queue", {}).get("message_concurrency", 2))
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(signum, self.stop)
+            except (NotImplementedError, RuntimeError, ValueError):
+                # Windows, or not running in the main thread.
+                pass
+
+        self.device.start()
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: TelemetryProtocol(self._on_datagram, self.logger), sock=self.sock)
+        self.work_queue.start()
+        self._start_metrics()
+        if self.config_watcher is not None:
+            self.config_watcher.start()
+            try:
+                self.loop.add_signal_handler(signal.SIGHUP, self.config_watcher.reload)
+            except (AttributeError, NotImplementedError, RuntimeError, ValueError):
+                pass
+        if self.settings.debug:
+            self._stats_task = self.loop.create_task(self._log_stats())
         print("Ready. Waiting for messages.")
-        last_put_time = time.time()
-        last_log_time = time.time()
+        self.running = True
+        try:
+            await self._stopped.wait()
+        finally:
+            await self._shutdown()
+
+    def _settings_changed(self, old, settings):
+        # Called by the config watcher thread, the stats task runs on the loop.
+        if settings.debug != old.debug and self.loop is not None and self.running:
+            self.loop.call_soon_threadsafe(self._toggle_stats_task, settings.debug)
+
+    def _toggle_stats_task(self, debug:bool):
+        if debug and self._stats_task is None:
+            self._stats_task = self.loop.create_task(self._log_stats())
+        elif not debug and self._stats_task is not None:
+            self._stats_task.cancel()
+            self._stats_task = None
+
+    async def _shutdown(self):
+        # Stop receiving, write what was received, give the messages in
+        # flight drain_timeout seconds, then cancel what is left.
+        self.running = False
+        self.transport.close()
+        self._stop_config_watcher()
+        if self._stats_task is not None:
+            self._stats_task.cancel()
+        self._flush_records()
+        if self._write_futures:
+            await asyncio.wait(self._write_futures)
+        if self._send_tasks:
+            _, pending = await asyncio.wait(self._send_tasks, timeout=self.drain_timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+        # Messages that failed are being journaled.
+        if self._write_futures:
+            await asyncio.wait(self._write_futures)
+        # The work queue handlers call back into the loop, so it drains in a thread.
+        self.device.stop()
+        await self.loop.run_in_executor(None, self.work_queue.shutdown, self.drain_timeout, self.join_timeout)
+        self._file_executor.shutdown()
+        self._stop_metrics()
+        if self.forwarder is not None:
+            self.forwarder.close()
+        if self.device.connected.is_set():
+            await self.device.client.shutdown()
+
+    async def _log_stats(self):
         while True:
-            
-            # Set timeout to jump out of the blocked listening,
-            # so that keyboard interupt can be receviced.
-            data = None
-            while not data:
-                try:
-                    data, addr = self.sock.recvfrom(1024) # buffer size is 1024 bytes
-                except socket.timeout:
-                    pass
-
-            # Forward the udp package to somewhere else, e.g. driving simulator.
-            if self.send_ip:
-                self.sock.sendto(data, (self.send_ip, self.send_port))
-
-            dict_telemetry = self.telemetry_manager.parse(data)
-
-            if self.forza_config["device"].get("debug", False):
-                this_log_time = time.time()
-                if this_log_time - last_log_time > 1:
-                    self.logger.info({
-                        k:v for k, v in dict_telemetry.items() if k in self.telemetry_to_log
-                    })
-                    last_log_time = this_log_time
-            this_put_time = time.time()
-
-            race_event_status = self._update_race_status(
-                race_event_status,
-                dict_telemetry["RacePosition"] != 0,
-                dict_telemetry["CurrentRaceTime"] > 0
-            )
-            # Write the telemetry if in a race.
-            if race_event_status in (1, 2):
-                self.telemetry_manager.write(dict_telemetry)
-            dict_telemetry["RaceStatus"] = race_event_status
-
-            # If a race event starts, record the starting X, Y, Z position.
-            # The position will be used in race event ending check.
-            if race_event_status == 1:
-                print("Recording start position.")
-                start_pos = (
-                    dict_telemetry["PositionX"],
-                    dict_telemetry["PositionY"],
-                    dict_telemetry["PositionZ"]
-                )
-                race_event_status = 2
-
-            # If a race event is on, record the current telemetry.
-            # It will be used to tell whether the race ends or
-            # pauses when blank data is detected.
-            if race_event_status == 2:
-                prev_telemetry = dict_telemetry
-
-            # If a race event stops, check whetehr it is a pause or an end.
-            if race_event_status == 3:
-                # For a full 3-lap race, if
-                #     1) a race event stops (race_event_status == 3),
-                #     2) the current position is close to the start position,
-                #     3) is in the 3rd lap, and
-                #     4) race time is in a reasonable range
-                #   then it is the end of the race event.
-                # For a short race, it is always the end of the race.
-                if self.forza_config["device"].get("3_lap_race", True):
-                    race_event_status = 4
-                    if start_pos is None:
-                        print("Start position not found.")
-                        continue
-                    stop_pos = (
-                        prev_telemetry["PositionX"],
-                        prev_telemetry["PositionY"],
-                        prev_telemetry["PositionZ"]
-                    )
-                    if not self._check_position(stop_pos, start_pos):
-                        print("Stop position {} is not close to the start position {}.".format(stop_pos, start_pos))
-                        continue
-                    stop_lap = prev_telemetry["LapNumber"]
-                    if not (stop_lap == 2): # LapNumber starts from 0
-                        print("In lap {}, not the 3rd.".format(stop_lap))
-                        continue
-                    if prev_telemetry["CurrentRaceTime"] < 2.5 * prev_telemetry["BestLap"]:
-                        print("CurrentRaceTime is {}. Too early to stop.".format(prev_telemetry["CurrentRaceTime"]))
-                        continue
-                race_event_status = 0
-
-                # At the end of a race event, we will
-                #     1) rename the telemetry csv,
-                #     2) send the telemetry csv to Azure Storage, and
-                #     3) create a new csv
-                # Remarks:
-                #     1) If you want to remove the status transfer 2 -> 3,
-                #        remember to handle prev_telemetry == None
-                upload_file_name = self.telemetry_manager.prepare_upload_file()
-                self._upload_file(upload_file_name, os.path.basename(upload_file_name))
-
-            # Send telemetry data to IoT Hub no faster than 1 msg/sec
-            # if race event is on.
-            if race_event_status == 2 and this_put_time - last_put_time >= 1:
-                self._send_message({"data": dict_telemetry})
-                last_put_time = this_put_time
+            await asyncio.sleep(1)
+            self.logger.info(self.stats())
+
+    def stats(self) -> dict:
+        return {
+            "receiver": self.recv_stats.as_dict(),
+            "pipeline": {
+                "recorder": {"depth": len(self._pending_records) + self._records_in_flight, "dropped": 0},
+                "iothub": {"depth": len(self._send_tasks), "dropped": self.messages_dropped},
+            },
+            "work_queue": self.work_queue.stats(),
+            "forwarder": self.forwarder.stats() if self.forwarder is not None else {},
+            "formats": self.formats.stats(),
+            "spool": self.spool.stats() if self.spool is not None else {},
+            "iothub": self.device.stats(),
+            "config": self.config_watcher.stats() if self.config_watcher is not None else {},
+        }
+
+    def _on_datagram(self, data:bytes, addr:tuple):
+        recv_time = time.time()
+        self.recv_stats.packets += 1
+        self.recv_stats.bytes += len(data)
+        forwarder = self.forwarder
+        if forwarder is not None:
+            forwarder.forward(data, addr)
+        telemetry_format = self.formats.dispatch(data)
+        if telemetry_format is None or not telemetry_format.has_race_fields:
+            return
+        session = self._get_session(addr, telemetry_format)
+        telemetry = session.telemetry_manager.view(data)
+        parse_time = time.time()
+        self.parse_latency.record(parse_time - recv_time)
+        self.packets_parsed.inc()
+        udp_data = data if self.recording_backend != "csv" else None
+        self._update_race_state((session, telemetry, udp_data, recv_time, parse_time))
+
+    def _record(self, item:tuple):
+        # Writes are batched for up to record_flush_interval seconds.
+        self._pending_records.append(item)
+        if self._flush_handle is None:
+            self._flush_handle = self.loop.call_later(self.record_flush_interval, self._flush_records)
+
+    def _flush_records(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending_records:
+            return
+        items, self._pending_records = self._pending_records, []
+        # One file I/O thread keeps the writes and the race ends in order.
+        self._records_in_flight += len(items)
+        future = self.loop.run_in_executor(self._file_executor, self._write_records, items)
+        self._write_futures.add(future)
+        future.add_done_callback(lambda future: self._records_written(future, len(items)))
+
+    def _records_written(self, future, n_items:int):
+        self._records_in_flight -= n_items
+        self._write_futures.discard(future)
+
+    def _write_records(self, items:list):
+        for item in items:
+            try:
+                self._write_telemetry(item)
+            except Exception:
+                self.logger.exception("Failed to write telemetry.")
+
+    def _publish(self, message:dict):
+        message["enqueue_time"] = time.time()
+        if not self.device.connected.is_set():
+            # Buffered in the work queue journal until the client connects.
+            self._queue_message(message)
+            return
+        if len(self._send_tasks) >= self.max_send_tasks:
+            self.messages_dropped += 1
+            return
+        task = self.loop.create_task(self._send_message_async(message))
+        self._send_tasks.add(task)
+        task.add_done_callback(self._send_tasks.discard)
+
+    async def _send_message_async(self, message:dict):
+        async with self._send_slots:
+            try:
+                await self.device.client.send_message(self._build_message(message))
+                self._record_message_latency(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.warning("Failed to send a message, queued for retry: {}".format(e))
+                self._queue_message(message)
+
+    def _queue_message(self, message:dict):
+        # The journal insert and commit run on the file I/O thread, after the
+        # writes queued before, so the race summary is still journaled ahead
+        # of the upload of the race.
+        message.setdefault("enqueue_time", time.time())
+        future = self.loop.run_in_executor(self._file_executor, self._submit_message, message)
+        self._write_futures.add(future)
+        future.add_done_callback(self._write_futures.discard)
+
+    def _submit_message(self, message:dict):
+        try:
+            self.work_queue.submit("message", message)
+        except Exception:
+            self.logger.exception("Failed to queue a message.")
+
+    def _send_message(self, message:dict):
+        # Work queue handler, called from its worker threads. It waits for
+        # the connection, and calls the async client on the event loop.
+        self.device.send_message(self._build_message(message))
+        self._record_message_latency(message)
+
+def run_worker(worker_id:int, counters:SharedCounters, base_dir:str, config_path:str, mode:str, sharding:str):
+    # Entry point of a worker process of the supervisor. Ctrl-C goes to the
+    # supervisor, which stops the workers with SIGTERM.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    with open(os.path.join(base_dir, config_path), "r") as f:
+        forza_config = shard_config(json.load(f), worker_id, sharding)
+    app_cls = AsyncForzaIoTApp if mode == "async" else ForzaIoTApp
+    app = app_cls(base_dir, config_path, forza_config=forza_config,
+                  config_transform=partial(shard_config, worker_id=worker_id, sharding=sharding))
+    signal.signal(signal.SIGTERM, lambda signum, frame: app.stop())
+    counters.report(worker_id, app.stats)
+    app.run()
 
 if __name__ == "__main__":
     
@@ -252,7 +978,26 @@ if __name__ == "__main__":
                     help='Base directory of the Forza IoT demo repository.')
     parser.add_argument('--config', dest='config_path', default=CONFIG_FNAME,
                     help='Path of the config file, relevant to BASE_DIR.')
+    parser.add_argument('--mode', dest='mode', choices=['threads', 'async'], default='threads',
+                    help='Run the relay on threads, or on a single asyncio event loop.')
+    parser.add_argument('--workers', dest='n_workers', type=int, default=1,
+                    help='Number of relay processes, restarted by a supervisor if they crash.')
+    parser.add_argument('--sharding', dest='sharding', choices=SHARDING_MODES, default='reuseport',
+                    help='reuseport: all workers share receive_port, a restart can move consoles '
+                         'between workers; ports: worker i listens on receive_port + i.')
     args = parser.parse_args()
     
-    app = ForzaIoTApp(args.base_dir, args.config_path)
-    app.run()
+    if args.n_workers > 1:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+        supervisor = Supervisor(
+            run_worker,
+            args.n_workers,
+            args=(args.base_dir, args.config_path, args.mode, args.sharding)
+        )
+        supervisor.run()
+    else:
+        if args.mode == "async":
+            app = AsyncForzaIoTApp(args.base_dir, args.config_path)
+        else:
+            app = ForzaIoTApp(args.base_dir, args.config_path)
+        app.run()
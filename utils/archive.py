@@ -0,0 +1,336 @@
+import os
+import json
+import time
+import sqlite3
+import argparse
+import threading
+
+import numpy as np
+
+from .recording import RAW_MAGIC, RAW_HEADER, COLUMNAR_MAGIC, raw_record_dtype, load_session
+from .segmentation import segment_session
+
+ARCHIVE_DIR = os.path.join("data", "archive")
+INDEX_FNAME = "index.sqlite"
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS files ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+    "source TEXT NOT NULL UNIQUE, "
+    "path TEXT NOT NULL, "
+    "format TEXT, "
+    "dtype TEXT NOT NULL, "
+    "n_packets INTEGER NOT NULL, "
+    "session TEXT, "
+    "segment INTEGER, "
+    "added REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS races ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+    "file_id INTEGER NOT NULL, "
+    "race INTEGER NOT NULL, "
+    "car_ordinal INTEGER, "
+    "car_class INTEGER, "
+    "car_pi INTEGER, "
+    "track INTEGER, "
+    "start_time REAL NOT NULL, "
+    "stop_time REAL NOT NULL, "
+    "ended INTEGER NOT NULL, "
+    "n_laps INTEGER NOT NULL, "
+    "best_lap REAL, "
+    "start_offset INTEGER NOT NULL, "
+    "stop_offset INTEGER NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS laps ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+    "race_id INTEGER NOT NULL, "
+    "lap INTEGER NOT NULL, "
+    "lap_time REAL NOT NULL, "
+    "start_time REAL NOT NULL, "
+    "stop_time REAL NOT NULL, "
+    "start_offset INTEGER NOT NULL, "
+    "stop_offset INTEGER NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS races_car ON races (car_ordinal, start_time)",
+    "CREATE INDEX IF NOT EXISTS races_time ON races (start_time)",
+    "CREATE INDEX IF NOT EXISTS laps_race ON laps (race_id, lap)",
+    "CREATE INDEX IF NOT EXISTS laps_time ON laps (lap_time)",
+)
+
+# Query arguments -> conditions on the races table.
+_RACE_CONDITIONS = {
+    "car_ordinal": "races.car_ordinal = ?",
+    "car_class": "races.car_class = ?",
+    "min_pi": "races.car_pi >= ?",
+    "max_pi": "races.car_pi <= ?",
+    "track": "races.track = ?",
+    "since": "races.start_time >= ?",
+    "until": "races.start_time < ?",
+    "ended": "races.ended = ?",
+}
+
+_LAP_CONDITIONS = {
+    "min_lap_time": "laps.lap_time >= ?",
+    "max_lap_time": "laps.lap_time <= ?",
+}
+
+class SessionArchive():
+    """
+    Local archive of finished recordings with an SQLite index of their races
+    and laps, for queries such as "the laps of car 1234 under 90 s" without
+    reading every recording.
+
+    add() copies a recording (CSV, raw or columnar) into archive_dir as a raw
+    packet log, splits it with segment_session, and indexes every race (car
+    ordinal, class and PI, track if the format has TrackOrdinal, start and
+    stop time, laps) with the byte offsets of its packets in the log.
+    The segments of a relay session, rotated by size or time, are appended
+    to the log of the first one and indexed as one race.
+    races() and laps() query the index; read() memory-maps the packets of a
+    race or lap, so only the pages of the slice are read from disk.
+    """
+
+    def __init__(self, archive_dir:str=ARCHIVE_DIR, index_fname:str=None):
+        self.archive_dir = archive_dir
+        if not os.path.isdir(archive_dir):
+            os.makedirs(archive_dir)
+        self._db = sqlite3.connect(index_fname or os.path.join(archive_dir, INDEX_FNAME), check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        for statement in _SCHEMA:
+            self._db.execute(statement)
+        self._db.commit()
+        self._lock = threading.Lock()
+        self._dtypes = {}   # file id -> record dtype
+
+    def close(self):
+        self._db.close()
+
+    def add(self,
+            fname:str,
+            parser,
+            format_name:str=None,
+            three_lap_race:bool=False,
+            ended:bool=None,
+            session:str=None,
+            segment:int=0) -> int:
+        # Archive and index a recording of the telemetry format of parser.
+        # Returns the number of races in its log; a recording already in
+        # the archive is skipped.
+        # A relay recording stops with the race, without the idle packets
+        # that end it, so the relay tells if the race ended or the segment
+        # was rotated: a race that runs to the end of the log gets ended.
+        # Segment n > 0 of session continues the log of segment n - 1.
+        source = os.path.abspath(fname)
+        with self._lock:
+            if self._db.execute("SELECT id FROM files WHERE source = ?", (source,)).fetchone() is not None:
+                return 0
+            previous = None
+            if session is not None and segment > 0:
+                previous = self._db.execute(
+                    "SELECT id, path FROM files WHERE session = ? AND segment = ?", (session, segment - 1)).fetchone()
+
+        with open(fname, "rb") as f:
+            magic = f.read(len(RAW_MAGIC))
+        packets, times = load_session(fname, parser)
+        if magic not in (RAW_MAGIC, COLUMNAR_MAGIC) and len(times):
+            # CSV rows have no receive time; the file was closed at the
+            # end of the recording.
+            times = times - times[-1] + os.path.getmtime(fname)
+
+        # The archive keeps its own raw log, so the recording can be
+        # uploaded, compressed or deleted afterwards.
+        record_dtype = raw_record_dtype(parser.dtype)
+        records = np.zeros(len(packets), dtype=record_dtype)
+        records["recv_time"] = times
+        records["length"] = parser.dtype.itemsize
+        records["packet"] = packets
+        if previous is not None and self._record_dtype(previous["id"]) == record_dtype:
+            # A segment retried after the previous one, or of another
+            # format, is indexed on its own.
+            path = previous["path"]
+            with self._lock:
+                n_logged = self._db.execute("SELECT SUM(n_packets) FROM files WHERE path = ?", (path,)).fetchone()[0]
+            logged = np.fromfile(path, dtype=record_dtype, count=n_logged, offset=RAW_HEADER.size)
+            # Cut what an interrupted add left after the indexed segments.
+            with open(path, "r+b") as f:
+                f.truncate(RAW_HEADER.size + n_logged * record_dtype.itemsize)
+                f.seek(0, os.SEEK_END)
+                f.write(records.tobytes())
+            records = np.concatenate((logged, records))
+        else:
+            previous = None
+            root = os.path.join(self.archive_dir, os.path.splitext(os.path.basename(fname))[0])
+            path = root + ".fzraw"
+            n = 1
+            while os.path.exists(path):
+                # Recordings from different directories can have the same name.
+                path = "{}_{}.fzraw".format(root, n)
+                n += 1
+            with open(path + ".tmp", "wb") as f:
+                f.write(RAW_HEADER.pack(RAW_MAGIC, parser.dtype.itemsize, 0))
+                f.write(records.tobytes())
+            os.replace(path + ".tmp", path)
+
+        log_packets, log_times = records["packet"], records["recv_time"]
+        race_index = segment_session(log_packets, three_lap_race)
+        def offset(index):
+            return RAW_HEADER.size + int(index) * record_dtype.itemsize
+        def field(name, index):
+            return log_packets[name][index].item() if name in log_packets.dtype.names else None
+
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO files (source, path, format, dtype, n_packets, session, segment, added) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (source, os.path.abspath(path), format_name, json.dumps(parser.dtype.descr), len(packets),
+                 session, segment, time.time()))
+            file_id = cursor.lastrowid
+            if previous is not None:
+                # The races of the log are indexed again, under its first file.
+                file_id = self._db.execute(
+                    "SELECT MIN(id) FROM files WHERE path = ?", (previous["path"],)).fetchone()[0]
+                self._db.execute(
+                    "DELETE FROM laps WHERE race_id IN (SELECT id FROM races WHERE file_id = ?)", (file_id,))
+                self._db.execute("DELETE FROM races WHERE file_id = ?", (file_id,))
+            for race_id, race in enumerate(race_index.races):
+                start, stop = int(race["start"]), int(race["stop"])
+                race_ended = bool(race["ended"])
+                if ended is not None and stop == len(log_packets):
+                    race_ended = ended
+                laps = race_index.laps[race_index.laps["race"] == race_id]
+                cursor = self._db.execute(
+                    "INSERT INTO races (file_id, race, car_ordinal, car_class, car_pi, track, "
+                    "start_time, stop_time, ended, n_laps, best_lap, start_offset, stop_offset) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (file_id, race_id, field("CarOrdinal", start), field("CarClass", start),
+                     field("CarPerformanceIndex", start), field("TrackOrdinal", start),
+                     float(log_times[start]), float(log_times[stop - 1]), race_ended, len(laps),
+                     field("BestLap", stop - 1), offset(start), offset(stop)))
+                race_row_id = cursor.lastrowid
+                self._db.executemany(
+                    "INSERT INTO laps (race_id, lap, lap_time, start_time, stop_time, start_offset, stop_offset) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(race_row_id, int(lap["lap"]), float(lap["lap_time"]),
+                      float(log_times[lap["start"]]), float(log_times[lap["stop"] - 1]),
+                      offset(lap["start"]), offset(lap["stop"])) for lap in laps])
+            self._db.commit()
+        return len(race_index.races)
+
+    def _where(self, conditions:dict, filters:dict) -> tuple:
+        clauses = []
+        params = []
+        for name, value in filters.items():
+            if name not in conditions:
+                raise TypeError("Unknown filter {}.".format(name))
+            if value is not None:
+                clauses.append(conditions[name])
+                params.append(value)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    def races(self, **filters) -> list:
+        # Races matching the filters of _RACE_CONDITIONS, oldest first.
+        where, params = self._where(_RACE_CONDITIONS, filters)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT races.*, files.path FROM races JOIN files ON files.id = races.file_id"
+                + where + " ORDER BY races.start_time", params).fetchall()
+        return [dict(row) for row in rows]
+
+    def laps(self, **filters) -> list:
+        # Laps matching the filters of _LAP_CONDITIONS and of their race,
+        # fastest first.
+        conditions = dict(_RACE_CONDITIONS, **_LAP_CONDITIONS)
+        where, params = self._where(conditions, filters)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT laps.*, races.file_id, races.car_ordinal, races.car_class, races.car_pi, "
+                "races.track, files.path FROM laps "
+                "JOIN races ON races.id = laps.race_id JOIN files ON files.id = races.file_id"
+                + where + " ORDER BY laps.lap_time", params).fetchall()
+        return [dict(row) for row in rows]
+
+    def _record_dtype(self, file_id:int) -> np.dtype:
+        record_dtype = self._dtypes.get(file_id, None)
+        if record_dtype is None:
+            with self._lock:
+                descr = self._db.execute("SELECT dtype FROM files WHERE id = ?", (file_id,)).fetchone()[0]
+            packet_dtype = np.dtype([tuple(field) for field in json.loads(descr)])
+            record_dtype = raw_record_dtype(packet_dtype)
+            self._dtypes[file_id] = record_dtype
+        return record_dtype
+
+    def read(self, row:dict) -> np.ndarray:
+        # Memory-mapped records (recv_time, length, packet) of a row of
+        # races() or laps(), e.g. archive.read(lap)["packet"]["Speed"].
+        record_dtype = self._record_dtype(row["file_id"])
+        n_records = (row["stop_offset"] - row["start_offset"]) // record_dtype.itemsize
+        if n_records == 0:
+            return np.zeros(0, dtype=record_dtype)
+        return np.memmap(row["path"], dtype=record_dtype, mode="r", offset=row["start_offset"], shape=(n_records,))
+
+def _timestamp(date:str) -> float:
+    return time.mktime(time.strptime(date, "%Y-%m-%d")) if date else None
+
+if __name__ == "__main__":
+
+    from .forza_telemetry import TelemetryParser
+
+    parser = argparse.ArgumentParser(description='Archive Forza recordings and query their races and laps.')
+    parser.add_argument('--archive_dir', dest='archive_dir', default=ARCHIVE_DIR,
+                    help='Directory of the archive and its index.')
+    subparsers = parser.add_subparsers(dest='command')
+    add_parser = subparsers.add_parser('add', help='Archive recordings.')
+    add_parser.add_argument('recordings', nargs='+', help='CSV, raw (.fzraw) or columnar (.fzcol) recordings.')
+    add_parser.add_argument('--telemetry_format', dest='telemetry_format_fname',
+                    default=os.path.join("config", "telemetry_format"),
+                    help='Path of the telemetry format file.')
+    add_parser.add_argument('--3_lap_race', dest='three_lap_race', action='store_true',
+                    help='Apply the 3-lap race end checks.')
+    query_parser = subparsers.add_parser('query', help='List the races, or the laps with --laps.')
+    query_parser.add_argument('--laps', dest='laps', action='store_true', help='List laps instead of races.')
+    query_parser.add_argument('--car', dest='car_ordinal', type=int, default=None)
+    query_parser.add_argument('--class', dest='car_class', type=int, default=None)
+    query_parser.add_argument('--min_pi', dest='min_pi', type=int, default=None)
+    query_parser.add_argument('--max_pi', dest='max_pi', type=int, default=None)
+    query_parser.add_argument('--track', dest='track', type=int, default=None)
+    query_parser.add_argument('--since', dest='since', default=None, help='yyyy-mm-dd')
+    query_parser.add_argument('--until', dest='until', default=None, help='yyyy-mm-dd')
+    query_parser.add_argument('--max_lap_time', dest='max_lap_time', type=float, default=None)
+    query_parser.add_argument('--field', dest='field', default=None,
+                    help='Print min/mean/max of this field, read from the archived packets.')
+    args = parser.parse_args()
+
+    archive = SessionArchive(args.archive_dir)
+    if args.command == 'add':
+        telemetry_parser = TelemetryParser(args.telemetry_format_fname)
+        for fname in args.recordings:
+            print("{}: {} races.".format(fname, archive.add(fname, telemetry_parser, three_lap_race=args.three_lap_race)))
+    elif args.command == 'query':
+        filters = {
+            "car_ordinal": args.car_ordinal,
+            "car_class": args.car_class,
+            "min_pi": args.min_pi,
+            "max_pi": args.max_pi,
+            "track": args.track,
+            "since": _timestamp(args.since),
+            "until": _timestamp(args.until),
+        }
+        start = time.perf_counter()
+        if args.laps:
+            rows = archive.laps(max_lap_time=args.max_lap_time, **filters)
+        else:
+            rows = archive.races(**filters)
+        elapsed = time.perf_counter() - start
+        for row in rows:
+            line = "{} car {} class {} PI {}".format(
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row["start_time"])),
+                row["car_ordinal"], row["car_class"], row["car_pi"])
+            if args.laps:
+                line += " lap {} {:.3f} s".format(row["lap"], row["lap_time"])
+            else:
+                line += " {} laps, best {:.3f} s".format(row["n_laps"], row["best_lap"] or 0)
+            if args.field:
+                values = archive.read(row)["packet"][args.field]
+                line += " {} {:.3f}/{:.3f}/{:.3f}".format(args.field, values.min(), values.mean(), values.max())
+            print(line)
+        print("{} rows in {:.2f} ms.".format(len(rows), elapsed * 1000))
+    else:
+        parser.print_help()
+    archive.close()
@@ -0,0 +1,57 @@
+import asyncio
+import logging
+
+class TelemetryProtocol(asyncio.DatagramProtocol):
+    # Hands every datagram to callback(data, addr) on the event loop.
+
+    def __init__(self, callback, logger:logging.Logger=None):
+        self.callback = callback
+        self.logger = logger or logging.getLogger(__name__)
+        self.transport = None
+        self.errors = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data:bytes, addr:tuple):
+        try:
+            self.callback(data, addr)
+        except Exception:
+            self.errors += 1
+            self.logger.exception("Failed to handle a datagram from {}.".format(addr))
+
+    def error_received(self, exc:Exception):
+        # e.g. ICMP port unreachable after forwarding to a closed port.
+        self.errors += 1
+        self.logger.warning("UDP socket error: {}".format(exc))
+
+class BlockingDeviceClient():
+    """
+    Blocking facade of an azure.iot.device.aio device client, for code that
+    runs in worker threads, e.g. the BlobUploader of the upload jobs.
+    The calls are scheduled on the event loop that owns the client.
+    """
+
+    def __init__(self, device_client, loop:asyncio.AbstractEventLoop):
+        self.device_client = device_client
+        self.loop = loop
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    @property
+    def connected(self) -> bool:
+        return getattr(self.device_client, "connected", True)
+
+    def connect(self):
+        return self._call(self.device_client.connect())
+
+    def send_message(self, message):
+        return self._call(self.device_client.send_message(message))
+
+    def get_storage_info_for_blob(self, blob_name:str) -> dict:
+        return self._call(self.device_client.get_storage_info_for_blob(blob_name))
+
+    def notify_blob_upload_status(self, correlation_id:str, is_success:bool, status_code:int, status_description:str):
+        return self._call(self.device_client.notify_blob_upload_status(
+            correlation_id, is_success, status_code, status_description))
@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import numpy as np
+
+from .forza_telemetry import TelemetryParser
+from .race_state import RaceStateMachine
+
+BASE_DIR = "."
+TELEMETRY_FORMAT_FNAME = os.path.join("config", "telemetry_format")
+
+def make_packets(parser:TelemetryParser, n_packets:int, seed:int=0) -> list:
+    # Random field values packed with the real layout.
+    rng = np.random.RandomState(seed)
+    packets = parser.allocate(n_packets)
+    for name in parser.fields:
+        kind = packets.dtype[name]
+        if kind.kind == "f":
+            packets[name] = rng.uniform(-1000, 1000, n_packets)
+        else:
+            info = np.iinfo(kind)
+            packets[name] = rng.randint(max(info.min, -100), min(info.max, 100) + 1, n_packets)
+    return [packets[i:i + 1].tobytes() for i in range(n_packets)]
+
+def _time_it(fn, repeat:int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def bench_parse(parser:TelemetryParser, n_packets:int, repeat:int):
+    packets = make_packets(parser, n_packets)
+    # The baseline built the format without a byte order prefix, i.e. with
+    # native alignment.
+    legacy_struct_format = parser.struct_format.lstrip("<>=!@")
+
+    def legacy_dict():
+        # The namedtuple + _asdict path used before the compiled decoder.
+        import struct
+        for data in packets:
+            parser.telemetry._asdict(parser.telemetry(*struct.unpack(legacy_struct_format, data)))
+
+    def compiled_dict():
+        for data in packets:
+            parser.parse(data)
+
+    out = parser.allocate(n_packets)
+    def parse_into():
+        for i, data in enumerate(packets):
+            parser.parse_into(data, out, i)
+
+    def parse_batch():
+        parser.parse_batch(packets)
+
+    # What the relay does with an out-of-race packet: decode it and run
+    # the race state machine, which reads a few fields.
+    def race_state_dict():
+        race_state = RaceStateMachine(verbose=False)
+        for data in packets:
+            race_state.update(parser.parse(data))
+
+    def race_state_view():
+        race_state = RaceStateMachine(verbose=False)
+        for data in packets:
+            race_state.update(parser.view(data))
+
+    results = [
+        ("legacy dict", _time_it(legacy_dict, repeat)),
+        ("compiled dict", _time_it(compiled_dict, repeat)),
+        ("parse_into", _time_it(parse_into, repeat)),
+        ("parse_batch", _time_it(parse_batch, repeat)),
+        ("race state, dict", _time_it(race_state_dict, repeat)),
+        ("race state, view", _time_it(race_state_view, repeat)),
+    ]
+    baseline = results[0][1]
+    print("Parsing {} packets, best of {}:".format(n_packets, repeat))
+    for name, elapsed in results:
+        print("  {:<18} {:8.2f} us/packet {:12.0f} packets/s {:6.1f}x".format(
+            name, elapsed / n_packets * 1e6, n_packets / elapsed, baseline / elapsed))
+
+def probe_startup(base_dir:str, import_time:float, connect_delay:float) -> dict:
+    # Start a relay wired to the local IoT Hub stand-in, whose handshake
+    # takes connect_delay seconds, and time how soon it receives packets.
+    # Run by bench_startup in a fresh interpreter that just imported main.
+    from main import ForzaIoTApp
+    from .local_iothub import LocalBlobServer, LocalDeviceClient, LocalMessage
+
+    with open(os.path.join(base_dir, "config", "forza_config.json"), "r") as f:
+        forza_config = json.load(f)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        forza_config["device"].update({
+            "receive_ip": "127.0.0.1",
+            "receive_port": 0,
+            "output_fname": os.path.join(tmp_dir, "data", "telemetry.csv"),
+            "telemetry_format_fname": os.path.abspath(os.path.join(base_dir, TELEMETRY_FORMAT_FNAME)),
+            "debug": False,
+            "log_fname": "",
+        })
+        forza_config.setdefault("work_queue", {})["journal_fname"] = os.path.join(tmp_dir, "work_queue.sqlite")
+        forza_config["metrics"] = {"enabled": False}
+        formats_config = forza_config.setdefault("formats", {})
+        formats_config["specs"] = {
+            name: os.path.abspath(os.path.join(base_dir, fname))
+            for name, fname in formats_config.get("specs", {}).items()
+        }
+        formats_config["cache_fname"] = os.path.join(tmp_dir, "telemetry_formats.json")
+
+        blob_server = LocalBlobServer().start()
+        device_client = LocalDeviceClient(blob_server, connect_delay=connect_delay)
+        start = time.perf_counter()
+        app = ForzaIoTApp(tmp_dir, None, device_client, LocalMessage, forza_config=forza_config)
+        app_thread = threading.Thread(target=app.run, daemon=True)
+        app_thread.start()
+        while not app.running:
+            time.sleep(0.0005)
+        ready = time.perf_counter() - start
+
+        # An idle packet every millisecond until the relay parsed one.
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        packet = bytes(app.formats.formats[app.formats.primary].packet_size)
+        while app.packets_parsed.value == 0:
+            sock.sendto(packet, app.sock.getsockname())
+            time.sleep(0.001)
+        first_packet = time.perf_counter() - start
+        sock.close()
+
+        app.device.connected.wait()
+        connected = time.perf_counter() - start
+        app.stop()
+        app_thread.join()
+        blob_server.stop()
+    return {
+        "import_main": import_time,
+        "ready": ready,
+        "first_packet": first_packet,
+        "connected": connected,
+    }
+
+def bench_startup(base_dir:str, connect_delay:float, repeat:int):
+    # Each run is a new interpreter, so module imports are included.
+    code = (
+        "import sys, time, json; start = time.perf_counter(); import main; "
+        "from utils.benchmark import probe_startup; "
+        "print(json.dumps(probe_startup(sys.argv[1], time.perf_counter() - start, float(sys.argv[2]))))"
+    )
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, "-c", code, os.path.abspath(base_dir), str(connect_delay)],
+            cwd=base_dir, stderr=subprocess.DEVNULL)
+        runs.append(json.loads(output.decode("utf-8").strip().splitlines()[-1]))
+    print("Startup with a {:.1f} s IoT Hub handshake, median of {}:".format(connect_delay, repeat))
+    for name in ("import_main", "ready", "first_packet", "connected"):
+        print("  {:<18} {:8.1f} ms".format(name, float(np.median([run[name] for run in runs])) * 1000))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Run Forza IoT demo micro-benchmarks.')
+    parser.add_argument('--base_dir', dest='base_dir', default=BASE_DIR,
+                    help='Base directory of the Forza IoT demo repository.')
+    parser.add_argument('--packets', dest='n_packets', type=int, default=60000,
+                    help='Number of packets per run.')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=5,
+                    help='Number of runs, the best one is reported.')
+    parser.add_argument('--startup', dest='startup', action='store_true',
+                    help='Benchmark the relay startup instead of parsing.')
+    parser.add_argument('--connect_delay', dest='connect_delay', type=float, default=2,
+                    help='Seconds the IoT Hub stand-in takes to connect, for --startup.')
+    args = parser.parse_args()
+
+    if args.startup:
+        bench_startup(args.base_dir, args.connect_delay, args.repeat)
+        exit(0)
+
+    telemetry_parser = TelemetryParser(os.path.join(args.base_dir, TELEMETRY_FORMAT_FNAME))
+    bench_parse(telemetry_parser, args.n_packets, args.repeat)
@@ -0,0 +1,121 @@
+import time
+import logging
+import threading
+
+class DeviceConnection():
+    """
+    The IoT Hub device client, connected in the background.
+
+    create_client() and connect() run on the connection thread, so the
+    Azure SDK is imported and the cloud handshake done while the relay
+    already receives and records. connect() is retried with exponential
+    backoff, and again when the client reports a lost connection.
+
+    send_message and the blob upload calls wait until the client is
+    connected. They are called by the work queue, whose journal buffers
+    the messages and uploads in the meantime.
+
+    wrap(client), if given, returns the blocking facade of the client that
+    is called, e.g. a BlockingDeviceClient of an asyncio client.
+    """
+
+    def __init__(self,
+                 create_client,
+                 wrap=None,
+                 retry_base_delay:float=1,
+                 retry_max_delay:float=60,
+                 check_interval:float=5,
+                 logger:logging.Logger=None):
+        self.create_client = create_client
+        self.wrap = wrap
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.check_interval = check_interval
+        self.logger = logger or logging.getLogger(__name__)
+        self.client = None      # as created, e.g. for the async calls
+        self._blocking = None   # what the calls of this class go to
+        self.connected = threading.Event()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self.connects = 0
+        self.failures = 0
+        self.connect_time = None  # seconds from start() to the first connection
+        self._start_time = None
+
+    def start(self):
+        self._start_time = time.time()
+        self._thread = threading.Thread(target=self._run, name="iothub-connection", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        # A connected client stays usable, e.g. to drain the work queue;
+        # calls waiting for a connection give up.
+        self._stopping = True
+        self._wake.set()
+
+    def _run(self):
+        delay = self.retry_base_delay
+        while not self._stopping:
+            if self.connected.is_set():
+                self._wake.wait(self.check_interval)
+                self._wake.clear()
+                if self._stopping:
+                    break
+                if getattr(self._blocking, "connected", True) is False:
+                    self.logger.warning("IoT Hub connection lost, reconnecting.")
+                    self.connected.clear()
+                continue
+            try:
+                if self._blocking is None:
+                    client = self.create_client()
+                    self._blocking = self.wrap(client) if self.wrap is not None else client
+                    self.client = client
+                self._blocking.connect()
+            except Exception as e:
+                self.failures += 1
+                self.logger.warning("Failed to connect to IoT Hub, retry in {:.1f} s: {}".format(delay, e))
+                self._wake.wait(delay)
+                self._wake.clear()
+                delay = min(delay * 2, self.retry_max_delay)
+                continue
+            delay = self.retry_base_delay
+            self.connects += 1
+            if self.connect_time is None:
+                self.connect_time = time.time() - self._start_time
+            self.connected.set()
+            self.logger.info("Connected to IoT Hub.")
+
+    def wait(self, timeout:float=None):
+        # The connected client; raises ConnectionError after timeout seconds
+        # or when the connection stops.
+        deadline = None if timeout is None else time.time() + timeout
+        while not self.connected.wait(0.1):
+            if self._stopping or (deadline is not None and time.time() >= deadline):
+                raise ConnectionError("Not connected to IoT Hub.")
+        return self._blocking
+
+    def _call(self, name:str, *args):
+        client = self.wait()
+        try:
+            return getattr(client, name)(*args)
+        except Exception:
+            # Have the connection thread check the client now.
+            self._wake.set()
+            raise
+
+    def send_message(self, message):
+        return self._call("send_message", message)
+
+    def get_storage_info_for_blob(self, blob_name:str) -> dict:
+        return self._call("get_storage_info_for_blob", blob_name)
+
+    def notify_blob_upload_status(self, correlation_id:str, is_success:bool, status_code:int, status_description:str):
+        return self._call("notify_blob_upload_status", correlation_id, is_success, status_code, status_description)
+
+    def stats(self) -> dict:
+        return {
+            "connected": int(self.connected.is_set()),
+            "connects": self.connects,
+            "failures": self.failures,
+        }
@@ -1,23 +1,33 @@
 # Modified from https://docs.microsoft.com/en-us/azure/iot-hub/iot-hub-python-python-file-upload
 import time
-import sys
-import iothub_client
 import os
-from iothub_client import IoTHubClient, IoTHubClientError, IoTHubTransportProvider, IoTHubClientResult, IoTHubError
-
-PROTOCOL = IoTHubTransportProvider.HTTP
+import json
+import gzip
+import base64
+import threading
+import http.client
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
 
 PATHTOFILE = os.path.join("..", "data", "telemetry.csv") # "[Full path to file]"
 FILENAME = "telemetry.csv" # "[File name for storage]"
 
+BLOCK_SIZE = 4 * 1024 * 1024
+BLOB_API_VERSION = "2019-02-02"
+MANIFEST_EXT = ".upload.json"
+
 def blob_upload_conf_callback(result, user_context):
     if str(result) == 'OK':
         print ( "...file {} uploaded successfully.".format(user_context["file_name"]))
-        user_context["done"] = True
     else:
         print ( "...file upload callback returned: " + str(result) )
+    user_context["done"].set()
 
 def upload_file_through_iothub(conn_str:str, path_to_file:str=PATHTOFILE, file_name:str=FILENAME):
+    # Legacy whole-file upload through the iothub_client SDK.
+    # The relay uses BlobUploader instead, so the SDK is only imported here.
+    from iothub_client import IoTHubClient, IoTHubTransportProvider, IoTHubError
+    PROTOCOL = IoTHubTransportProvider.HTTP
     try:
         print ( "Upload file through IoT Hub." )
 
@@ -28,17 +38,14 @@ def upload_file_through_iothub(conn_str:str, path_to_file:str=PATHTOFILE, file_n
 
         user_context = {
             "file_name": path_to_file,
-            "done": False
+            "done": threading.Event()
         }
         client.upload_blob_async(file_name, content, len(content), blob_upload_conf_callback, user_context)
 
         print ( "" )
         print ( "File upload initiated..." )
 
-        while True:
-            if user_context["done"]:
-                return
-            time.sleep(1)
+        user_context["done"].wait()
 
     except IoTHubError as iothub_error:
         print ( "Unexpected error %s from IoTHub" % iothub_error )
@@ -47,3 +54,161 @@ def upload_file_through_iothub(conn_str:str, path_to_file:str=PATHTOFILE, file_n
         print ( "IoTHubClient stopped" )
     except:
         print ( "generic error" )
+
+class BlobUploadError(Exception):
+    pass
+
+class BlobUploader():
+    """
+    Stream files to the IoT Hub linked storage account in fixed-size blocks.
+
+    The storage SAS URI comes from the long-lived device client
+    (get_storage_info_for_blob), the blocks are sent with the Azure Blob
+    "Put Block" / "Put Block List" REST calls, and the hub is notified with
+    notify_blob_upload_status. Uploaded block ids are kept in a manifest next
+    to the file, so an upload interrupted by a crash resumes where it stopped.
+
+    With compress=True, every block is gzip-compressed on its own. The blob,
+    named with a .gz suffix, is a multi-member gzip stream.
+
+    max_rate caps the upload bandwidth in bytes per second, so that a backlog
+    of recordings does not starve the live messages sharing the uplink.
+    """
+
+    def __init__(self,
+                 device_client,
+                 block_size:int=BLOCK_SIZE,
+                 compress:bool=False,
+                 max_workers:int=1,
+                 scheme:str="https",
+                 http_timeout:float=60,
+                 max_rate:float=None):
+        self.device_client = device_client
+        self.block_size = block_size
+        self.compress = compress
+        self.scheme = scheme
+        self.http_timeout = http_timeout
+        self.max_rate = max_rate
+        self._send_at = 0.0
+        self._rate_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers)
+
+    def upload(self, path_to_file:str, blob_name:str):
+        # Returns a concurrent.futures.Future resolving to the blob name.
+        return self._executor.submit(self.upload_sync, path_to_file, blob_name)
+
+    def shutdown(self, wait:bool=True):
+        self._executor.shutdown(wait)
+
+    def upload_sync(self, path_to_file:str, blob_name:str, compress:bool=None) -> str:
+        # compress overrides self.compress, e.g. for files compressed already.
+        if compress is None:
+            compress = self.compress
+        manifest_fname = path_to_file + MANIFEST_EXT
+        manifest = self._load_manifest(manifest_fname, path_to_file, blob_name, compress)
+        self._save_manifest(manifest_fname, manifest)
+        if compress:
+            blob_name += ".gz"
+
+        storage_info = self.device_client.get_storage_info_for_blob(blob_name)
+        host = storage_info["hostName"]
+        blob_path = "/{}/{}".format(storage_info["containerName"], quote(storage_info["blobName"]))
+        sas_token = storage_info["sasToken"]
+        if not sas_token.startswith("?"):
+            sas_token = "?" + sas_token
+
+        if self.scheme == "https":
+            conn = http.client.HTTPSConnection(host, timeout=self.http_timeout)
+        else:
+            conn = http.client.HTTPConnection(host, timeout=self.http_timeout)
+        try:
+            block_ids = []
+            with open(path_to_file, "rb") as f:
+                while True:
+                    block = f.read(self.block_size)
+                    if not block:
+                        break
+                    # Block ids of a blob must all have the same length.
+                    block_id = base64.b64encode("{:08d}".format(len(block_ids)).encode()).decode()
+                    block_ids.append(block_id)
+                    if block_id in manifest["uploaded"]:
+                        continue
+                    if compress:
+                        block = gzip.compress(block)
+                    self._put(conn, "{}{}&comp=block&blockid={}".format(
+                        blob_path, sas_token, quote(block_id)), block)
+                    manifest["uploaded"].append(block_id)
+                    self._save_manifest(manifest_fname, manifest)
+
+            block_list = "".join("<Latest>{}</Latest>".format(block_id) for block_id in block_ids)
+            block_list = '<?xml version="1.0" encoding="utf-8"?><BlockList>{}</BlockList>'.format(block_list)
+            self._put(conn, "{}{}&comp=blocklist".format(blob_path, sas_token), block_list.encode("utf-8"))
+        except Exception as e:
+            self.device_client.notify_blob_upload_status(
+                storage_info["correlationId"], False, 500, str(e))
+            raise
+        finally:
+            conn.close()
+
+        self.device_client.notify_blob_upload_status(
+            storage_info["correlationId"], True, 201, "OK")
+        os.remove(manifest_fname)
+        print("...file {} uploaded successfully.".format(path_to_file))
+        return blob_name
+
+    def _throttle(self, n_bytes:int):
+        # Wait for the turn of n_bytes at max_rate, shared by all uploads.
+        with self._rate_lock:
+            now = time.time()
+            self._send_at = max(self._send_at, now)
+            delay = self._send_at - now
+            self._send_at += n_bytes / self.max_rate
+        if delay > 0:
+            time.sleep(delay)
+
+    def _paced(self, body:bytes, chunk_size:int=64 * 1024):
+        for start in range(0, len(body), chunk_size):
+            chunk = body[start:start + chunk_size]
+            self._throttle(len(chunk))
+            yield chunk
+
+    def _put(self, conn:http.client.HTTPConnection, url:str, body:bytes):
+        headers = {
+            "x-ms-version": BLOB_API_VERSION,
+            "Content-Length": str(len(body)),
+        }
+        if self.max_rate:
+            # Sent in chunks at max_rate; Content-Length keeps it unchunked.
+            conn.request("PUT", url, body=self._paced(body), headers=headers)
+        else:
+            conn.request("PUT", url, body=body, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        if response.status != 201:
+            raise BlobUploadError("PUT {} returned {} {}".format(
+                url.split("?")[0], response.status, response.reason))
+
+    def _load_manifest(self, manifest_fname:str, path_to_file:str, blob_name:str, compress:bool) -> dict:
+        stat = os.stat(path_to_file)
+        manifest = {
+            "blob_name": blob_name,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "block_size": self.block_size,
+            "compress": compress,
+            "uploaded": [],
+        }
+        if os.path.isfile(manifest_fname):
+            with open(manifest_fname, "r") as f:
+                previous = json.load(f)
+            # Only resume an upload of the same file with the same settings.
+            if all(previous.get(k) == v for k, v in manifest.items() if k != "uploaded"):
+                manifest["uploaded"] = previous["uploaded"]
+                print("Resuming upload of {} after {} blocks.".format(path_to_file, len(manifest["uploaded"])))
+        return manifest
+
+    def _save_manifest(self, manifest_fname:str, manifest:dict):
+        # Write then rename, so a crash never leaves a truncated manifest.
+        with open(manifest_fname + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(manifest_fname + ".tmp", manifest_fname)
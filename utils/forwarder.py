@@ -0,0 +1,222 @@
+import socket
+import struct
+import logging
+import threading
+
+_TIMESTAMP = struct.Struct("<I")
+
+class ForwardTarget():
+    """
+    One destination of the forwarded packets, e.g. a motion simulator.
+
+    The socket is connected once, so sending does not build or resolve an
+    address per packet, and non-blocking, so a slow or unreachable target
+    costs a failed send instead of stalling ingest.
+
+    rate:      packets per second per console, from the game timestamps;
+               None forwards every packet.
+    ranges:    {packet size: (start, stop) byte ranges of the packet to send},
+               None for the whole packet. They are sent as memoryview slices
+               with scatter/gather I/O, without copying the packet. Packets
+               of other sizes are not sent.
+    source_ip: only forward the packets of this console.
+    """
+
+    def __init__(self,
+                 ip:str,
+                 port:int,
+                 rate:float=None,
+                 ranges:dict=None,
+                 source_ip:str=None,
+                 timestamp_offset:int=None,
+                 name:str=None):
+        self.address = (ip, port)
+        self.name = name or "{}:{}".format(ip, port)
+        self.interval_ms = 1000.0 / rate if rate else None
+        self.ranges = ranges
+        self.source_ip = source_ip
+        self.timestamp_offset = timestamp_offset
+        self._next_timestamps = {}  # source ip -> game time of the next packet to send
+        self._use_sendmsg = hasattr(socket.socket, "sendmsg")
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.sock.connect(self.address)
+
+        self.sent = 0
+        self.decimated = 0  # skipped to keep the rate
+        self.dropped = 0    # the socket buffer was full
+        self.errors = 0     # e.g. ICMP port unreachable
+        self.unmatched = 0  # the format of the packet lacks the fields
+
+    def _due(self, data:memoryview, source_ip:str) -> bool:
+        # The game timestamp paces the packets of every console, whether
+        # they arrive one by one or in a batch.
+        if self.timestamp_offset is None or len(data) < self.timestamp_offset + 4:
+            return True
+        timestamp = _TIMESTAMP.unpack_from(data, self.timestamp_offset)[0]
+        next_timestamp = self._next_timestamps.get(source_ip, None)
+        if next_timestamp is not None:
+            ahead = next_timestamp - timestamp
+            if 0 < ahead <= self.interval_ms:
+                return False
+            if -self.interval_ms < ahead <= 0:
+                # Keep the cadence, the late part is caught up next time.
+                self._next_timestamps[source_ip] = next_timestamp + self.interval_ms
+                return True
+        # First packet, after a gap, or the game restarted its clock.
+        self._next_timestamps[source_ip] = timestamp + self.interval_ms
+        return True
+
+    def send(self, data:memoryview, source_ip:str):
+        if self.source_ip is not None and source_ip != self.source_ip:
+            return
+        ranges = None
+        if self.ranges is not None:
+            ranges = self.ranges.get(len(data), None)
+            if ranges is None:
+                self.unmatched += 1
+                return
+        if self.interval_ms is not None and not self._due(data, source_ip):
+            self.decimated += 1
+            return
+        try:
+            if ranges is None:
+                self.sock.send(data)
+            elif self._use_sendmsg:
+                self.sock.sendmsg([data[start:stop] for start, stop in ranges])
+            else:
+                self.sock.send(b"".join(data[start:stop] for start, stop in ranges))
+            self.sent += 1
+        except BlockingIOError:
+            self.dropped += 1
+        except OSError:
+            self.errors += 1
+
+    def stats(self) -> dict:
+        return {
+            "sent": self.sent,
+            "decimated": self.decimated,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "unmatched": self.unmatched,
+        }
+
+    def close(self):
+        self.sock.close()
+
+def field_ranges(dtype, fields:list) -> list:
+    # Byte ranges of fields in a packet of the structured dtype, in packet
+    # order, with adjacent fields merged.
+    ranges = []
+    for name in sorted(fields, key=lambda name: dtype.fields[name][1]):
+        field_dtype, offset = dtype.fields[name][:2]
+        if ranges and ranges[-1][1] == offset:
+            ranges[-1] = (ranges[-1][0], offset + field_dtype.itemsize)
+        else:
+            ranges.append((offset, offset + field_dtype.itemsize))
+    return ranges
+
+class Forwarder():
+    """
+    Fan the received packets out to several targets, see ForwardTarget.
+
+    Each target in targets_config is a dict:
+        {"ip": "192.168.1.30", "port": 5300, "rate": 10,
+         "fields": ["Speed", "CurrentEngineRpm"], "source_ip": null, "name": "dashboard"}
+    A target with "fields" receives those fields back to back, in the order
+    of the telemetry format, instead of the whole packet. dtypes are the
+    telemetry formats the packets can have, told apart by their size; a
+    target with "fields" only receives the formats that have all of them.
+
+    forward() and forward_batch() are called from a single thread, e.g. the
+    forwarder stage; set_targets() can be called from any other.
+    """
+
+    def __init__(self, targets_config:list, dtypes:list, logger:logging.Logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.dtypes = dtypes
+        # Every Forza format has the game timestamp at the same offset.
+        self.timestamp_offset = None
+        for dtype in dtypes:
+            if "TimestampMS" in dtype.fields:
+                self.timestamp_offset = dtype.fields["TimestampMS"][1]
+        self._target_configs = []
+        self.targets = []
+        # Targets replaced by set_targets, closed by the forwarding thread.
+        self._retired = []
+        self._retired_lock = threading.Lock()
+        self.set_targets(targets_config)
+
+    def _create_target(self, target_config:dict) -> ForwardTarget:
+        fields = target_config.get("fields", None)
+        ranges = None
+        if fields:
+            ranges = {
+                dtype.itemsize: field_ranges(dtype, fields)
+                for dtype in self.dtypes if all(name in dtype.fields for name in fields)
+            }
+        return ForwardTarget(
+            target_config["ip"],
+            target_config["port"],
+            rate=target_config.get("rate", None),
+            ranges=ranges,
+            source_ip=target_config.get("source_ip", None),
+            timestamp_offset=self.timestamp_offset,
+            name=target_config.get("name", None)
+        )
+
+    def set_targets(self, targets_config:list):
+        # Replace the targets, e.g. on a config reload. Targets whose config
+        # did not change keep their socket, pacing and counters. The list is
+        # swapped in one assignment, forward() sends to the old or the new
+        # one; the old targets are closed by the next forward(), once the
+        # forwarding thread is done with the old list.
+        old = list(zip(self._target_configs, self.targets))
+        targets = []
+        for target_config in targets_config:
+            for i, (old_config, old_target) in enumerate(old):
+                if old_config == target_config:
+                    targets.append(old.pop(i)[1])
+                    break
+            else:
+                targets.append(self._create_target(target_config))
+        self._target_configs = list(targets_config)
+        self.targets = targets
+        with self._retired_lock:
+            self._retired.extend(old_target for _, old_target in old)
+
+    def _close_retired(self):
+        # Called by the forwarding thread before it reads self.targets:
+        # the targets retired so far were swapped out before that read.
+        with self._retired_lock:
+            retired, self._retired = self._retired, []
+        for target in retired:
+            target.close()
+
+    def forward(self, data:memoryview, addr:tuple):
+        if self._retired:
+            self._close_retired()
+        source_ip = addr[0]
+        for target in self.targets:
+            target.send(data, source_ip)
+
+    def forward_batch(self, batch:list):
+        if self._retired:
+            self._close_retired()
+        targets = self.targets
+        if not targets:
+            return
+        for data, addr in batch:
+            source_ip = addr[0]
+            for target in targets:
+                target.send(data, source_ip)
+
+    def stats(self) -> dict:
+        return {target.name: target.stats() for target in self.targets}
+
+    def close(self):
+        # Once the forwarding thread is stopped.
+        self._close_retired()
+        for target in self.targets:
+            target.close()
@@ -1,12 +1,88 @@
 import os
-import csv
 import collections
 import struct
 from datetime import datetime
 
+import numpy as np
+
+from .recording import create_recorder, recorder_ext, export_csv
+
 OUTPUT_FILE_FNAME = os.path.join("..", "data", "telemetry.csv")
 TELEMETRY_FORMAT_FNAME = os.path.join("..", "config", "telemetry_format")
 
+class TelemetryRecord():
+    """
+    View of one packet that decodes a field only when it is read, e.g.
+    record["RacePosition"] or record.RacePosition, with struct.unpack_from
+    at the offset of the field. Subclasses are generated per telemetry
+    format by TelemetryParser.view.
+
+    "RaceStatus", set by the race state machine, is kept next to the packet;
+    other keys set on the record go to a dict created on demand.
+    to_dict() decodes the whole packet at once, for the sinks that need
+    every field.
+    """
+
+    __slots__ = ("data", "RaceStatus", "_extra")
+    fields = ()
+    decoder = None
+    _getters = {}   # field -> (unpack_from, offset)
+
+    def __init__(self, data:bytes):
+        self.data = data
+        self.RaceStatus = None
+        self._extra = None
+
+    def __getitem__(self, name:str):
+        getter = self._getters.get(name, None)
+        if getter is not None:
+            return getter[0](self.data, getter[1])[0]
+        if name == "RaceStatus" and self.RaceStatus is not None:
+            return self.RaceStatus
+        if self._extra is not None and name in self._extra:
+            return self._extra[name]
+        raise KeyError(name)
+
+    def __setitem__(self, name:str, value):
+        if name == "RaceStatus":
+            self.RaceStatus = value
+            return
+        if name in self._getters:
+            raise KeyError("{} is read-only, the record is a view of the packet.".format(name))
+        if self._extra is None:
+            self._extra = {}
+        self._extra[name] = value
+
+    def __contains__(self, name:str) -> bool:
+        try:
+            self[name]
+            return True
+        except KeyError:
+            return False
+
+    def get(self, name:str, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def keys(self) -> list:
+        return list(self.to_dict().keys())
+
+    def items(self) -> list:
+        return list(self.to_dict().items())
+
+    def to_dict(self) -> dict:
+        dict_data = dict(zip(self.fields, self.decoder.unpack(self.data)))
+        if self.RaceStatus is not None:
+            dict_data["RaceStatus"] = self.RaceStatus
+        if self._extra is not None:
+            dict_data.update(self._extra)
+        return dict_data
+
+def _field_property(unpack_from, offset:int) -> property:
+    return property(lambda self: unpack_from(self.data, offset)[0])
+
 class TelemetryParser():
     
     struct_format_map = {
@@ -18,76 +94,176 @@ class TelemetryParser():
         "s8":"b",
         "u8":"B",
     }
+
+    dtype_format_map = {
+        "s32":"<i4",
+        "u32":"<u4",
+        "f32":"<f4",
+        "u16":"<u2",
+        "s8":"i1",
+        "u8":"u1",
+    }
     
-    def __init__(self, telemetry_format_fname:str):
+    def __init__(self, telemetry_format_fname:str, layout:dict=None):
+        # layout, the result of compile_layout(), skips reading and
+        # parsing the format file, e.g. when it comes from a cache.
         self.telemetry_format_fname = telemetry_format_fname
-        self._parse_telemetry_format()
-    
-    def _parse_telemetry_format(self):
-        telemetry_format = open(self.telemetry_format_fname, 'r').read()
-        
-        self.struct_format = ""
-        var_names = []
+        if layout is None:
+            layout = self.compile_layout(telemetry_format_fname)
+        self._load_layout(layout)
+
+    @classmethod
+    def compile_layout(cls, telemetry_format_fname:str) -> dict:
+        # The serializable form of a format file: the struct format and
+        # the names and numpy types of the fields, in packet order.
+        telemetry_format = open(telemetry_format_fname, 'r').read()
+
+        # Forza sends little-endian packets without padding.
+        struct_format = "<"
+        dtype_fields = []
         for format_str in telemetry_format.split("\n"):
             if len(format_str) == 0 or format_str.startswith("//"):
                 continue
             f, var = format_str.split("//")[0].strip().split(" ")
-            self.struct_format += self.struct_format_map[f]
-            var_names.append(var.replace(";", ""))
-        var_name = " ".join(var_names)
+            var = var.replace(";", "")
+            struct_format += cls.struct_format_map[f]
+            dtype_fields.append((var, cls.dtype_format_map[f]))
+        return {"struct_format": struct_format, "dtype": dtype_fields}
+
+    def _load_layout(self, layout:dict):
+        self.struct_format = layout["struct_format"]
+        dtype_fields = [tuple(field) for field in layout["dtype"]]
+        var_name = " ".join(name for name, _ in dtype_fields)
 
         self.telemetry = collections.namedtuple("telemetry", var_name)
         self.fields = self.telemetry._fields
+
+        # Compile the layout once, so that no format string is
+        # re-interpreted per packet.
+        self.decoder = struct.Struct(self.struct_format)
+        self.packet_size = self.decoder.size
+        self.dtype = np.dtype(dtype_fields)
+        self.record_cls = self._make_record_class()
+
+    def _make_record_class(self) -> type:
+        # A TelemetryRecord subclass with the offset of every field, and a
+        # property per field for attribute access.
+        getters = {}
+        attributes = {"__slots__": (), "fields": self.fields, "decoder": self.decoder, "_getters": getters}
+        offset = 0
+        for name, format_char in zip(self.fields, self.struct_format[1:]):
+            field_struct = struct.Struct("<" + format_char)
+            getters[name] = (field_struct.unpack_from, offset)
+            attributes[name] = _field_property(field_struct.unpack_from, offset)
+            offset += field_struct.size
+        return type("TelemetryRecordView", (TelemetryRecord,), attributes)
         
     def parse(self, udp_data:str) -> dict:
-        parsed_telemetry = self.telemetry(*struct.unpack(self.struct_format, udp_data))
-        dict_data = self.telemetry._asdict(parsed_telemetry)
-        return dict_data
+        return dict(zip(self.fields, self.decoder.unpack(udp_data)))
+
+    def view(self, udp_data:bytes) -> TelemetryRecord:
+        # Wraps udp_data without decoding it. The record reads udp_data
+        # later, so it must not be a buffer that is reused, e.g. a slot
+        # of the receive ring.
+        if len(udp_data) != self.packet_size:
+            raise ValueError("Expected a {}-byte packet, got {} bytes.".format(
+                self.packet_size, len(udp_data)))
+        return self.record_cls(udp_data)
+
+    def allocate(self, n_packets:int) -> np.ndarray:
+        # Preallocate a structured array to be filled by parse_into.
+        return np.zeros(n_packets, dtype=self.dtype)
+
+    def parse_into(self, udp_data:bytes, out:np.ndarray, index:int):
+        # Copy the raw packet into row `index` of a structured array
+        # created by allocate(). The dtype matches the wire layout,
+        # so no decoding or intermediate objects are needed.
+        if len(udp_data) != self.packet_size:
+            raise ValueError("Expected a {}-byte packet, got {} bytes.".format(
+                self.packet_size, len(udp_data)))
+        start = index * self.packet_size
+        out.view(np.uint8)[start:start + self.packet_size] = np.frombuffer(udp_data, dtype=np.uint8)
+
+    def parse_batch(self, buffers) -> np.ndarray:
+        # Decode a list of packets in one vectorized call.
+        # The result is a structured array with one row per packet.
+        for udp_data in buffers:
+            if len(udp_data) != self.packet_size:
+                raise ValueError("Expected a {}-byte packet, got {} bytes.".format(
+                    self.packet_size, len(udp_data)))
+        return np.frombuffer(b"".join(buffers), dtype=self.dtype)
 
 class TelemetryManager():
     
     def __init__(self,
                  output_file_name:str=OUTPUT_FILE_FNAME,
                  telemetry_format_fname:str=TELEMETRY_FORMAT_FNAME,
-                 forced_new_file:bool=False):
+                 forced_new_file:bool=False,
+                 recording_backend:str="csv",
+                 chunk_rows:int=600,
+                 export_csv:bool=False,
+                 telemetry_parser:TelemetryParser=None):
         
-        self.output_file_name = output_file_name
-        self.telemetry_parser = TelemetryParser(telemetry_format_fname)
-        self._prepare_csv_writer(forced_new_file)
+        # The extension follows the backend, e.g. data/telemetry.fzraw
+        self.recording_backend = recording_backend
+        self.output_file_name = os.path.splitext(output_file_name)[0] + recorder_ext(recording_backend)
+        self.chunk_rows = chunk_rows
+        self.export_csv = export_csv and recording_backend != "csv"
+        # A parser can be shared by the managers of a telemetry format.
+        self.telemetry_parser = telemetry_parser or TelemetryParser(telemetry_format_fname)
+        self.recorder = None
         self.last_output_fname = None
+        self._prepare_recorder(forced_new_file)
     
     def parse(self, udp_data: str) -> dict:
         dict_data = self.telemetry_parser.parse(udp_data)
         return dict_data
+
+    def view(self, udp_data: bytes) -> TelemetryRecord:
+        return self.telemetry_parser.view(udp_data)
+
+    def parse_into(self, udp_data: bytes, out: np.ndarray, index: int):
+        self.telemetry_parser.parse_into(udp_data, out, index)
+
+    def parse_batch(self, buffers) -> np.ndarray:
+        return self.telemetry_parser.parse_batch(buffers)
     
-    def write(self, dict_data: dict):
-        self.csv_writer.writerow(dict_data)
+    def write(self, dict_data: dict, udp_data: bytes = None, recv_time: float = None):
+        # Binary backends store udp_data as received if it is given.
+        self.recorder.write(dict_data, udp_data, recv_time)
     
     def prepare_upload_file(self) -> str:
-        self.output_file_handler.close()
-        self._prepare_csv_writer(forced_new_file=True)
+        self.recorder.close()
+        self._prepare_recorder(forced_new_file=True)
         if self.last_output_fname is not None:
             upload_file_name = self.last_output_fname
         else:
             upload_file_name = self.output_file_name
+        if self.export_csv:
+            upload_file_name = export_csv(
+                upload_file_name,
+                os.path.splitext(upload_file_name)[0] + ".csv",
+                self.telemetry_parser.dtype
+            )
         return upload_file_name
     
-    def _prepare_csv_writer(self, forced_new_file:bool):
+    def _prepare_recorder(self, forced_new_file:bool):
         output_file_exists = os.path.isfile(self.output_file_name)
         if forced_new_file or not output_file_exists:
             file_dir = os.path.split(self.output_file_name)[0]
             if not os.path.isdir(file_dir):
                 os.makedirs(file_dir)
-            # Rename the output csv if it exists
+            # Rename the output file if it exists
             if output_file_exists:
                 self._generate_last_output_fname()
                 os.rename(self.output_file_name, self.last_output_fname)
-            self.output_file_handler = open(self.output_file_name, "w", newline='', encoding='utf-8')
-            self.csv_writer = csv.DictWriter(self.output_file_handler, fieldnames=list(self.telemetry_parser.fields))
-            self.csv_writer.writeheader()
-        else:
-            self.output_file_handler = open(self.output_file_name, "a", newline='', encoding='utf-8')
-            self.csv_writer = csv.DictWriter(self.output_file_handler, fieldnames=self.telemetry_parser.fields)
+        self.recorder = create_recorder(
+            self.recording_backend,
+            self.output_file_name,
+            self.telemetry_parser,
+            append=output_file_exists and not forced_new_file,
+            chunk_rows=self.chunk_rows
+        )
 
     def _generate_last_output_fname(self) -> str:
         # Generate file name /path/to/telemetry_yyyymmddHHMMss.csv from /path/to/telemetry.csv
@@ -98,5 +274,5 @@ class TelemetryManager():
         return self.last_output_fname
     
     def __exit__(self, exc_type, exc_value, traceback):
-        if self.output_file_handler is not None:
-            self.output_file_handler.close()
+        if self.recorder is not None:
+            self.recorder.close()
@@ -0,0 +1,188 @@
+# In-process stand-ins for IoT Hub and its linked blob storage,
+# to run the relay and the uploader without an Azure subscription.
+import time
+import asyncio
+import uuid
+import threading
+from urllib.parse import urlsplit, parse_qs, unquote
+from xml.etree import ElementTree
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class LocalBlobServer():
+    """
+    Minimal HTTP implementation of the Azure Blob "Put Block" and
+    "Put Block List" calls. Committed blobs are kept in self.blobs.
+
+    fail_after_blocks makes the server reject every block after the given
+    number of accepted ones, to exercise resumed uploads.
+    """
+
+    def __init__(self, host:str="127.0.0.1", port:int=0, fail_after_blocks:int=None):
+        self.blobs = {}
+        self.blocks = {}
+        self.n_block_requests = 0
+        self.fail_after_blocks = fail_after_blocks
+        self._lock = threading.Lock()
+
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_PUT(self):
+                server._handle_put(self)
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = _ThreadingHTTPServer((host, port), Handler)
+        self.host_name = "{}:{}".format(*self.httpd.server_address)
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _handle_put(self, handler:BaseHTTPRequestHandler):
+        url = urlsplit(handler.path)
+        blob_path = unquote(url.path)
+        query = parse_qs(url.query)
+        body = handler.rfile.read(int(handler.headers.get("Content-Length", 0)))
+        comp = query.get("comp", [""])[0]
+        status = 201
+        with self._lock:
+            if comp == "block":
+                if self.fail_after_blocks is not None and self.n_block_requests >= self.fail_after_blocks:
+                    status = 503
+                else:
+                    self.blocks[(blob_path, query["blockid"][0])] = body
+                    self.n_block_requests += 1
+            elif comp == "blocklist":
+                block_ids = [e.text for e in ElementTree.fromstring(body)]
+                try:
+                    self.blobs[blob_path] = b"".join(self.blocks[(blob_path, i)] for i in block_ids)
+                except KeyError:
+                    status = 400
+            else:
+                self.blobs[blob_path] = body
+        handler.send_response(status)
+        handler.send_header("Content-Length", "0")
+        handler.end_headers()
+
+class LocalMessage():
+    # Stand-in for azure.iot.device.Message.
+
+    def __init__(self, data, message_id=None, content_encoding=None, content_type=None):
+        self.data = data
+        self.message_id = message_id
+        self.content_encoding = content_encoding
+        self.content_type = content_type
+        self.custom_properties = {}
+
+class LocalDeviceClient():
+    # Stand-in for azure.iot.device.IoTHubDeviceClient. connect() takes
+    # connect_delay seconds, like the cloud handshake, and the first
+    # fail_connects calls fail, like a network that is down. The first
+    # fail_sends messages fail too.
+
+    def __init__(self,
+                 blob_server:LocalBlobServer=None,
+                 device_id:str="forza_iot_relay",
+                 connect_delay:float=0,
+                 fail_connects:int=0,
+                 fail_sends:int=0):
+        self.blob_server = blob_server
+        self.device_id = device_id
+        self.connect_delay = connect_delay
+        self.fail_connects = fail_connects
+        self.fail_sends = fail_sends
+        self.container_name = "forza"
+        self.connected = False
+        self.messages = []
+        self.upload_notifications = []
+
+    @classmethod
+    def create_from_connection_string(cls, conn_str:str, **kwargs):
+        return cls()
+
+    def connect(self):
+        if self.fail_connects > 0:
+            self.fail_connects -= 1
+            raise ConnectionError("Local IoT Hub unreachable.")
+        time.sleep(self.connect_delay)
+        self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+
+    def shutdown(self):
+        self.connected = False
+
+    def send_message(self, message):
+        if self.fail_sends > 0:
+            self.fail_sends -= 1
+            raise ConnectionError("Local IoT Hub dropped the message.")
+        self.messages.append((time.time(), message))
+
+    def get_storage_info_for_blob(self, blob_name:str) -> dict:
+        return {
+            "correlationId": str(uuid.uuid4()),
+            "hostName": self.blob_server.host_name,
+            "containerName": self.container_name,
+            "blobName": "{}/{}".format(self.device_id, blob_name),
+            "sasToken": "?sv=local&sig=local",
+        }
+
+    def notify_blob_upload_status(self, correlation_id:str, is_success:bool, status_code:int, status_description:str):
+        self.upload_notifications.append((correlation_id, is_success, status_code, status_description))
+
+class LocalAsyncDeviceClient():
+    # Stand-in for azure.iot.device.aio.IoTHubDeviceClient.
+
+    def __init__(self,
+                 blob_server:LocalBlobServer=None,
+                 device_id:str="forza_iot_relay",
+                 connect_delay:float=0,
+                 fail_connects:int=0,
+                 fail_sends:int=0):
+        self.client = LocalDeviceClient(blob_server, device_id, fail_connects=fail_connects, fail_sends=fail_sends)
+        self.connect_delay = connect_delay
+
+    @classmethod
+    def create_from_connection_string(cls, conn_str:str, **kwargs):
+        return cls()
+
+    @property
+    def messages(self) -> list:
+        return self.client.messages
+
+    @property
+    def upload_notifications(self) -> list:
+        return self.client.upload_notifications
+
+    @property
+    def connected(self) -> bool:
+        return self.client.connected
+
+    async def connect(self):
+        await asyncio.sleep(self.connect_delay)
+        self.client.connect()
+
+    async def disconnect(self):
+        self.client.disconnect()
+
+    async def shutdown(self):
+        self.client.shutdown()
+
+    async def send_message(self, message):
+        self.client.send_message(message)
+
+    async def get_storage_info_for_blob(self, blob_name:str) -> dict:
+        return self.client.get_storage_info_for_blob(blob_name)
+
+    async def notify_blob_upload_status(self, correlation_id:str, is_success:bool, status_code:int, status_description:str):
+        self.client.notify_blob_upload_status(correlation_id, is_success, status_code, status_description)
@@ -0,0 +1,186 @@
+import json
+import math
+import zlib
+import struct
+
+from .streaming_reducer import StreamingReducer, REDUCE_FIELDS
+
+MESSAGE_MODES = ("single", "columnar", "delta", "stats", "reduce")
+MESSAGE_ENCODINGS = ("json", "msgpack", "cbor")
+
+CONTENT_TYPES = {
+    "json": "application/json",
+    "msgpack": "application/msgpack",
+    "cbor": "application/cbor",
+}
+
+class MessageBatcher():
+    """
+    Aggregate the telemetry of one console into one IoT Hub message per window.
+
+    Samples are taken at most `rate` times per second. Every `window` seconds,
+    add() returns the payload of the window, depending on mode:
+        single:   the latest sample, as the relay always sent
+        columnar: {"t": [...], field: [...]} with one entry per sample
+        delta:    the first sample in full, then only the changed fields
+        stats:    {field: {"min", "max", "mean", "last"}} over the window
+        reduce:   n_points values per field, see StreamingReducer
+    Only the fields listed in `fields` are kept, or all fields if it is empty;
+    reduce keeps REDUCE_FIELDS if it is empty.
+    """
+
+    def __init__(self,
+                 mode:str="single",
+                 window:float=1,
+                 rate:float=None,
+                 fields:list=None,
+                 reduce_config:dict=None):
+        if mode not in MESSAGE_MODES:
+            raise ValueError("Unknown message mode {}, expected one of {}.".format(mode, MESSAGE_MODES))
+        self.mode = mode
+        self.window = window
+        self.sample_interval = 1.0 / rate if rate else 0
+        self.fields = list(fields) if fields else None
+        self._window_start = None
+        self._last_sample_time = None
+        self._samples = []
+        self._times = []
+        self.reducer = None
+        if mode == "reduce":
+            reduce_config = reduce_config or {}
+            self.reducer = StreamingReducer(
+                self.fields or REDUCE_FIELDS,
+                method=reduce_config.get("method", "lttb"),
+                n_points=reduce_config.get("points", 10),
+                capacity=reduce_config.get("capacity", 256)
+            )
+
+    def add(self, dict_telemetry:dict, t:float) -> dict:
+        if self._window_start is None:
+            self._window_start = t
+        if self._last_sample_time is None or t - self._last_sample_time >= self.sample_interval:
+            if self.fields is not None and self.reducer is None:
+                dict_telemetry = {k: dict_telemetry[k] for k in self.fields if k in dict_telemetry}
+            if self.reducer is not None:
+                # The ring buffer copies the fields, no dict per sample.
+                self.reducer.add(dict_telemetry, t)
+            elif self.mode == "single":
+                self._samples = [dict_telemetry]
+                self._times = [t]
+            else:
+                self._samples.append(dict_telemetry)
+                self._times.append(t)
+            self._last_sample_time = t
+        if t - self._window_start < self.window:
+            return None
+        return self.flush()
+
+    def flush(self) -> dict:
+        # Returns the payload of the samples collected so far, or None.
+        samples, times = self._samples, self._times
+        self._samples, self._times = [], []
+        self._window_start = None
+        if self.reducer is not None:
+            return self.reducer.reduce()
+        if not samples:
+            return None
+        if self.mode == "single":
+            return samples[-1]
+        if self.mode == "columnar":
+            return self._columnar(samples, times)
+        if self.mode == "delta":
+            return self._delta(samples, times)
+        return self._stats(samples, times)
+
+    def _columnar(self, samples:list, times:list) -> dict:
+        payload = {"t": [round(t - times[0], 4) for t in times], "t0": times[0]}
+        for k in samples[0]:
+            payload[k] = [sample[k] for sample in samples]
+        return payload
+
+    def _delta(self, samples:list, times:list) -> dict:
+        deltas = []
+        prev = samples[0]
+        for sample, t in zip(samples[1:], times[1:]):
+            delta = {k: v for k, v in sample.items() if prev.get(k) != v}
+            delta["dt"] = round(t - times[0], 4)
+            deltas.append(delta)
+            prev = sample
+        return {"t0": times[0], "first": samples[0], "deltas": deltas}
+
+    def _stats(self, samples:list, times:list) -> dict:
+        payload = {"t0": times[0], "t1": times[-1], "count": len(samples)}
+        for k in samples[0]:
+            values = [sample[k] for sample in samples]
+            payload[k] = {
+                "min": min(values),
+                "max": max(values),
+                "mean": sum(values) / len(values),
+                "last": values[-1],
+            }
+        return payload
+
+def encode_message(data, encoding:str="json", compress:bool=False) -> tuple:
+    # Returns (body, content_type, content_encoding).
+    if encoding == "json":
+        body = json.dumps(data, separators=(",", ":")).encode("utf-8")
+        content_encoding = "utf-8"
+    elif encoding == "msgpack":
+        try:
+            import msgpack
+        except ImportError:
+            raise ImportError("The msgpack message encoding requires the msgpack package, "
+                              "use the cbor encoding instead or pip install msgpack.")
+        body = msgpack.packb(data, use_bin_type=True)
+        content_encoding = None
+    elif encoding == "cbor":
+        body = encode_cbor(data)
+        content_encoding = None
+    else:
+        raise ValueError("Unknown message encoding {}, expected one of {}.".format(
+            encoding, MESSAGE_ENCODINGS))
+    if compress:
+        body = zlib.compress(body)
+        content_encoding = "deflate"
+    return body, CONTENT_TYPES[encoding], content_encoding
+
+def _cbor_head(major:int, n:int) -> bytes:
+    if n < 24:
+        return struct.pack(">B", major << 5 | n)
+    if n < 1 << 8:
+        return struct.pack(">BB", major << 5 | 24, n)
+    if n < 1 << 16:
+        return struct.pack(">BH", major << 5 | 25, n)
+    if n < 1 << 32:
+        return struct.pack(">BI", major << 5 | 26, n)
+    return struct.pack(">BQ", major << 5 | 27, n)
+
+def encode_cbor(data) -> bytes:
+    # Minimal CBOR (RFC 7049) encoder for the payloads of MessageBatcher:
+    # dicts, lists, strings, ints, floats, bools and None.
+    if data is None:
+        return b"\xf6"
+    if data is True:
+        return b"\xf5"
+    if data is False:
+        return b"\xf4"
+    if isinstance(data, int):
+        if data >= 0:
+            return _cbor_head(0, data)
+        return _cbor_head(1, -1 - data)
+    if isinstance(data, float):
+        # Telemetry floats are 32-bit on the wire, keep them that size.
+        if math.isnan(data) or math.isinf(data) or struct.unpack(">f", struct.pack(">f", data))[0] == data:
+            return b"\xfa" + struct.pack(">f", data)
+        return b"\xfb" + struct.pack(">d", data)
+    if isinstance(data, str):
+        encoded = data.encode("utf-8")
+        return _cbor_head(3, len(encoded)) + encoded
+    if isinstance(data, (bytes, bytearray)):
+        return _cbor_head(2, len(data)) + bytes(data)
+    if isinstance(data, (list, tuple)):
+        return _cbor_head(4, len(data)) + b"".join(encode_cbor(v) for v in data)
+    if isinstance(data, dict):
+        return _cbor_head(5, len(data)) + b"".join(
+            encode_cbor(k) + encode_cbor(v) for k, v in data.items())
+    raise TypeError("Cannot encode {} as CBOR.".format(type(data)))
@@ -0,0 +1,250 @@
+import os
+import re
+import json
+import time
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# Upper bounds in seconds, from 10 us to 10 s.
+DEFAULT_LATENCY_BUCKETS = [
+    1e-5, 2.5e-5, 5e-5,
+    1e-4, 2.5e-4, 5e-4,
+    1e-3, 2.5e-3, 5e-3,
+    1e-2, 2.5e-2, 5e-2,
+    1e-1, 2.5e-1, 5e-1,
+    1.0, 2.5, 5.0, 10.0,
+]
+
+class LatencyHistogram():
+    # Fixed-bucket histogram. The buckets are allocated once, recording
+    # a sample is a bisect and an increment.
+
+    def __init__(self, buckets:list=DEFAULT_LATENCY_BUCKETS):
+        self.buckets = list(buckets)
+        # The last bucket counts samples above the largest bound.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds:float):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q:float) -> float:
+        # Upper bound of the bucket holding the q-quantile.
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for i, n in enumerate(self.counts):
+            cumulative += n
+            if cumulative >= target:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+        }
+
+class Counter():
+    # Monotonic counter, incremented from a single thread.
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n:int=1):
+        self.value += n
+
+def metric_name(key) -> str:
+    # Prometheus names are [a-zA-Z_:][a-zA-Z0-9_:]*, a stats key becomes
+    # a name segment with the other characters mapped to "_".
+    name = re.sub("[^a-zA-Z0-9_]", "_", str(key))
+    return "_" + name if name[:1].isdigit() else name
+
+def flatten_stats(stats:dict, prefix:str="", labels:dict=None, label_values:tuple=()) -> dict:
+    # {"pipeline": {"parser": {"depth": 0}}} -> {("pipeline_parser_depth", ()): 0}
+    # The keys of the dict at a path of labels become a label instead of a
+    # name segment, e.g. with labels={"forwarder": "target"}
+    # {"forwarder": {"1.2.3.4:5300": {"sent": 1}}} -> {("forwarder_sent", (("target", "1.2.3.4:5300"),)): 1}
+    labels = labels or {}
+    flat = {}
+    for key, value in stats.items():
+        if isinstance(value, dict) and prefix in labels:
+            child_labels = {path: label for path, label in labels.items() if path != prefix}
+            flat.update(flatten_stats(value, prefix, child_labels, label_values + ((labels[prefix], str(key)),)))
+            continue
+        name = "{}_{}".format(prefix, metric_name(key)) if prefix else metric_name(key)
+        if isinstance(value, dict):
+            flat.update(flatten_stats(value, name, labels, label_values))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[(name, label_values)] = value
+    return flat
+
+def format_sample(name:str, label_values:tuple) -> str:
+    # forwarder_sent{target="1.2.3.4:5300"}
+    if not label_values:
+        return name
+    return "{}{{{}}}".format(name, ",".join(
+        '{}="{}"'.format(label, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for label, value in label_values
+    ))
+
+class MetricsRegistry():
+    """
+    Counters and latency histograms of the hot path, plus gauges read from
+    collectors, e.g. ForzaIoTApp.stats, when the metrics are exported.
+
+    The hot path only holds references to the Counter and LatencyHistogram
+    objects, so recording does not look anything up.
+    """
+
+    def __init__(self, namespace:str="forza"):
+        self.namespace = namespace
+        self.counters = {}      # name -> (help, Counter)
+        self.histograms = {}    # name -> (help, LatencyHistogram)
+        self.collectors = []    # (function returning a dict of stats, labels)
+
+    def counter(self, name:str, help:str="") -> Counter:
+        if name not in self.counters:
+            self.counters[name] = (help, Counter())
+        return self.counters[name][1]
+
+    def histogram(self, name:str, help:str="", buckets:list=DEFAULT_LATENCY_BUCKETS) -> LatencyHistogram:
+        if name not in self.histograms:
+            self.histograms[name] = (help, LatencyHistogram(buckets))
+        return self.histograms[name][1]
+
+    def add_collector(self, collector, labels:dict=None):
+        # labels maps the stats paths keyed by e.g. a target or a format
+        # name to a label, see flatten_stats.
+        self.collectors.append((collector, labels or {}))
+
+    def gauges(self) -> dict:
+        # (name, label values) -> value
+        gauges = {}
+        for collector, labels in self.collectors:
+            gauges.update(flatten_stats(collector(), labels=labels))
+        return gauges
+
+    def snapshot(self) -> dict:
+        return {
+            "time": time.time(),
+            "counters": {name: counter.value for name, (_, counter) in self.counters.items()},
+            "histograms": {
+                name: dict(histogram.as_dict(), buckets=histogram.buckets, counts=list(histogram.counts))
+                for name, (_, histogram) in self.histograms.items()
+            },
+            "gauges": {format_sample(name, label_values): value for (name, label_values), value in self.gauges().items()},
+        }
+
+    def render_prometheus(self) -> str:
+        # Prometheus text exposition format 0.0.4.
+        lines = []
+        def header(name, help, kind):
+            if help:
+                lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+        for name, (help, counter) in sorted(self.counters.items()):
+            name = "{}_{}_total".format(self.namespace, metric_name(name))
+            header(name, help, "counter")
+            lines.append("{} {}".format(name, counter.value))
+        for name, (help, histogram) in sorted(self.histograms.items()):
+            name = "{}_{}".format(self.namespace, metric_name(name))
+            header(name, help, "histogram")
+            cumulative = 0
+            for bound, n in zip(histogram.buckets, histogram.counts):
+                cumulative += n
+                lines.append('{}_bucket{{le="{}"}} {}'.format(name, bound, cumulative))
+            lines.append('{}_bucket{{le="+Inf"}} {}'.format(name, histogram.count))
+            lines.append("{}_sum {}".format(name, histogram.total))
+            lines.append("{}_count {}".format(name, histogram.count))
+        # The samples of a name are grouped under one TYPE line.
+        previous = None
+        for (name, label_values), value in sorted(self.gauges().items()):
+            name = "{}_{}".format(self.namespace, name)
+            if name != previous:
+                header(name, "", "gauge")
+                previous = name
+            lines.append("{} {}".format(format_sample(name, label_values), value))
+        return "\n".join(lines) + "\n"
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # A slow scrape does not hold up the others.
+    daemon_threads = True
+
+class MetricsServer():
+    # Serves the registry in Prometheus text format at /metrics.
+
+    def __init__(self, registry:MetricsRegistry, host:str="127.0.0.1", port:int=9108):
+        registry_ = registry
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry_.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format, *args):
+                pass
+        self.server = _ThreadingHTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class SnapshotWriter():
+    # Writes registry.snapshot() as JSON to fname every interval seconds.
+    # The file is replaced atomically, so readers never see half of it.
+
+    def __init__(self, registry:MetricsRegistry, fname:str, interval:float=10):
+        self.registry = registry
+        self.fname = fname
+        self.interval = interval
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        fname_dir = os.path.dirname(self.fname)
+        if fname_dir and not os.path.isdir(fname_dir):
+            os.makedirs(fname_dir)
+        self._thread = threading.Thread(target=self._run, name="metrics-snapshot", daemon=True)
+        self._thread.start()
+        return self
+
+    def write(self):
+        tmp_fname = self.fname + ".tmp"
+        with open(tmp_fname, "w") as f:
+            json.dump(self.registry.snapshot(), f)
+        os.replace(tmp_fname, self.fname)
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            self.write()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.write()
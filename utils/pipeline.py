@@ -0,0 +1,159 @@
+import time
+import queue
+import logging
+import threading
+import collections
+
+from .metrics import LatencyHistogram
+
+# Backpressure policies, applied when a stage's queue is full.
+DROP_OLDEST = "drop_oldest"  # evict the oldest queued item
+BLOCK = "block"              # block the producer until there is room
+SAMPLE = "sample"            # above half full, keep 1 of every sample_every items
+
+BACKPRESSURE_POLICIES = (DROP_OLDEST, BLOCK, SAMPLE)
+
+class BoundedQueue():
+
+    def __init__(self,
+                 maxsize:int=1024,
+                 policy:str=DROP_OLDEST,
+                 sample_every:int=4,
+                 on_drop=None):
+        if policy not in BACKPRESSURE_POLICIES:
+            raise ValueError("Unknown backpressure policy {}, expected one of {}.".format(
+                policy, BACKPRESSURE_POLICIES))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.sample_every = sample_every
+        # Called with every item the queue discards.
+        self.on_drop = on_drop
+
+        self._items = collections.deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._n_offered = 0
+
+        self.dropped = 0
+        self.max_depth = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def put(self, item):
+        dropped_item = None
+        with self._lock:
+            self._n_offered += 1
+            depth = len(self._items)
+            if self.policy == SAMPLE and depth >= self.maxsize // 2:
+                if depth >= self.maxsize or self._n_offered % self.sample_every:
+                    self.dropped += 1
+                    dropped_item = item
+                    item = None
+            elif depth >= self.maxsize:
+                if self.policy == BLOCK:
+                    while len(self._items) >= self.maxsize:
+                        self._not_full.wait()
+                else:
+                    self.dropped += 1
+                    dropped_item = self._items.popleft()[1]
+            if item is not None:
+                self._items.append((time.perf_counter(), item))
+                self.max_depth = max(self.max_depth, len(self._items))
+                self._not_empty.notify()
+        if dropped_item is not None and self.on_drop is not None:
+            self.on_drop(dropped_item)
+
+    def get(self, timeout:float=None) -> tuple:
+        # Returns (enqueue_time, item), raises queue.Empty after timeout.
+        with self._lock:
+            if not self._items:
+                self._not_empty.wait(timeout)
+                if not self._items:
+                    raise queue.Empty
+            entry = self._items.popleft()
+            self._not_full.notify()
+            return entry
+
+class Stage(threading.Thread):
+    # A worker thread consuming one BoundedQueue. The latency histogram
+    # covers queueing plus handling time of every item.
+
+    def __init__(self, name:str, handler, in_queue:BoundedQueue, logger:logging.Logger=None):
+        super().__init__(name=name, daemon=True)
+        self.handler = handler
+        self.in_queue = in_queue
+        self.logger = logger or logging.getLogger(__name__)
+        self.latency = LatencyHistogram()
+        self.processed = 0
+        self.errors = 0
+        self._stopping = threading.Event()
+
+    def run(self):
+        while not (self._stopping.is_set() and len(self.in_queue) == 0):
+            try:
+                enqueue_time, item = self.in_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            try:
+                self.handler(item)
+            except Exception:
+                self.errors += 1
+                self.logger.exception("Stage {} failed to handle an item.".format(self.name))
+            self.processed += 1
+            self.latency.record(time.perf_counter() - enqueue_time)
+
+    def stop(self):
+        # The stage drains its queue before exiting.
+        self._stopping.set()
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self.in_queue),
+            "max_depth": self.in_queue.max_depth,
+            "dropped": self.in_queue.dropped,
+            "processed": self.processed,
+            "errors": self.errors,
+            "latency": self.latency.as_dict(),
+        }
+
+class Pipeline():
+    """
+    Stages linked by bounded queues, e.g.
+    receiver -> parser -> race_state -> csv / iothub / forwarder.
+
+    Stages are added in upstream-to-downstream order and stopped in the same
+    order, so each stage drains before the stages it feeds.
+    """
+
+    def __init__(self, logger:logging.Logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.stages = collections.OrderedDict()
+
+    def add_stage(self,
+                  name:str,
+                  handler,
+                  maxsize:int=1024,
+                  policy:str=DROP_OLDEST,
+                  sample_every:int=4,
+                  on_drop=None) -> Stage:
+        in_queue = BoundedQueue(maxsize, policy, sample_every, on_drop)
+        stage = Stage(name, handler, in_queue, self.logger)
+        self.stages[name] = stage
+        return stage
+
+    def put(self, name:str, item):
+        self.stages[name].in_queue.put(item)
+
+    def start(self):
+        for stage in self.stages.values():
+            stage.start()
+
+    def stop(self, timeout:float=5):
+        for stage in self.stages.values():
+            stage.stop()
+            stage.join(timeout)
+
+    def stats(self) -> dict:
+        return {name: stage.stats() for name, stage in self.stages.items()}
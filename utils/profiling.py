@@ -0,0 +1,119 @@
+import os
+import sys
+import time
+import signal
+import logging
+import threading
+import tracemalloc
+
+class SamplingProfiler():
+    """
+    Samples the stacks of all the threads every interval seconds from a
+    background thread, so the relay keeps running at full speed between
+    samples. write() saves the samples as collapsed stacks, one
+    "thread;outer;...;inner count" line per stack, the input format of
+    flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, interval:float=0.005):
+        self.interval = interval
+        self.counts = {}
+        self.n_samples = 0
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self):
+        self.counts = {}
+        self.n_samples = 0
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stopping.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{} ({}:{})".format(
+                        code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+            self.n_samples += 1
+
+    def write(self, fname:str):
+        with open(fname, "w") as f:
+            for stack, count in sorted(self.counts.items(), key=lambda item: -item[1]):
+                f.write("{} {}\n".format(stack, count))
+
+class ProfilerHook():
+    """
+    Diagnose a running relay without restarting it:
+        kill -USR1 <pid>  starts the sampling profiler, the next USR1 stops it
+                          and writes profile_<time>.folded
+        kill -USR2 <pid>  starts tracemalloc, the next USR2 writes the top
+                          allocations to tracemalloc_<time>.txt and stops it
+    The files go to output_dir. Not available on Windows.
+    """
+
+    def __init__(self, output_dir:str, interval:float=0.005, logger:logging.Logger=None):
+        self.output_dir = output_dir
+        self.profiler = SamplingProfiler(interval)
+        self.logger = logger or logging.getLogger(__name__)
+
+    def install(self) -> bool:
+        if not hasattr(signal, "SIGUSR1"):
+            return False
+        try:
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.toggle_profiler())
+            signal.signal(signal.SIGUSR2, lambda signum, frame: self.toggle_tracemalloc())
+        except ValueError:
+            # Not running in the main thread.
+            return False
+        return True
+
+    def _fname(self, prefix:str, ext:str) -> str:
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+        return os.path.join(self.output_dir, "{}_{}.{}".format(prefix, time.strftime("%Y%m%d%H%M%S"), ext))
+
+    def toggle_profiler(self):
+        if not self.profiler.running:
+            self.profiler.start()
+            self.logger.warning("Sampling profiler started.")
+            return
+        self.profiler.stop()
+        fname = self._fname("profile", "folded")
+        self.profiler.write(fname)
+        self.logger.warning("Sampling profiler stopped after {} samples, written to {}.".format(
+            self.profiler.n_samples, fname))
+
+    def toggle_tracemalloc(self, n_top:int=50):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+            self.logger.warning("tracemalloc started.")
+            return
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        fname = self._fname("tracemalloc", "txt")
+        with open(fname, "w") as f:
+            for stat in snapshot.statistics("traceback")[:n_top]:
+                f.write("{}\n".format(stat))
+                for line in stat.traceback.format():
+                    f.write("{}\n".format(line))
+        self.logger.warning("tracemalloc snapshot written to {}.".format(fname))
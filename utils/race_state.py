@@ -0,0 +1,132 @@
+# Race event state machine, shared by the live relay and offline tools.
+#
+# status: 0: not in race event,
+#         1: race event starts, will be set to 2 afterwards
+#         2: race event is on,
+#         3: race event stops, will be set to 0 or 4 afterwards
+#         4: race event is paused
+NOT_IN_RACE = 0
+RACE_STARTING = 1
+RACE_ON = 2
+RACE_STOPPING = 3
+RACE_PAUSED = 4
+
+# Events returned by RaceStateMachine.update
+RACE_STARTED = "started"
+RACE_RECORDING = "recording"
+RACE_ENDED = "ended"
+RACE_PAUSE = "paused"
+
+# Squared distance to the start position within which a 3-lap race may end.
+START_POSITION_THRESHOLD = 200**2
+
+def check_position(curr_pos:iter, start_pos:iter, threshold:float=START_POSITION_THRESHOLD) -> bool:
+    # The threshold is for the slight difference between
+    # the starting position and the ending position.
+    # Before a racing, your car is usually waiting at around 100 unit length
+    # before the starting/ending line, which is known as the staging line.
+    diff_pos = [(curr_i - start_i) ** 2 for curr_i, start_i in zip(curr_pos, start_pos)]
+    diff_pos = sum(diff_pos)
+    return diff_pos < threshold
+
+def update_race_status(cur_status:int, race_pos_not_zero:bool, race_time_not_zero:bool) -> int:
+    # status transfer table:
+    # cur_status, race_pos_not_zero, race_time_not_zero, next_status
+    #          0,                 0,                              0
+    #          0,                 1,                 0,           0
+    #          0,                 1,                 1,           1
+    #          2,                 0,                              3
+    #          2,                 1,                              2
+    #          4,                 0,                              4
+    #          4,                 1,                              2
+    if cur_status == 0 and race_pos_not_zero is True and race_time_not_zero is True:
+        return 1
+    if cur_status == 2 and race_pos_not_zero is False:
+        return 3
+    if cur_status == 4 and race_pos_not_zero is True:
+        return 2
+    return cur_status
+
+class RaceStateMachine():
+
+    def __init__(self, three_lap_race:bool=False, verbose:bool=True):
+        self.three_lap_race = three_lap_race
+        self.verbose = verbose
+        self.status = NOT_IN_RACE
+        self.start_pos = None
+        self.prev_telemetry = None
+
+    def _print(self, msg:str):
+        if self.verbose:
+            print(msg)
+
+    def update(self, dict_telemetry:dict) -> str:
+        # Feed one packet. Returns RACE_STARTED or RACE_RECORDING if the packet
+        # belongs to a race and should be recorded, RACE_ENDED at the end of a
+        # race event, RACE_PAUSE if the race is paused, and None otherwise.
+        # dict_telemetry["RaceStatus"] is set as a side effect.
+        self.status = update_race_status(
+            self.status,
+            dict_telemetry["RacePosition"] != 0,
+            dict_telemetry["CurrentRaceTime"] > 0
+        )
+        dict_telemetry["RaceStatus"] = self.status
+
+        # If a race event starts, record the starting X, Y, Z position.
+        # The position will be used in race event ending check.
+        if self.status == RACE_STARTING:
+            self._print("Recording start position.")
+            self.start_pos = (
+                dict_telemetry["PositionX"],
+                dict_telemetry["PositionY"],
+                dict_telemetry["PositionZ"]
+            )
+            self.status = RACE_ON
+            self.prev_telemetry = dict_telemetry
+            return RACE_STARTED
+
+        # If a race event is on, record the current telemetry.
+        # It will be used to tell whether the race ends or
+        # pauses when blank data is detected.
+        if self.status == RACE_ON:
+            self.prev_telemetry = dict_telemetry
+            return RACE_RECORDING
+
+        # If a race event stops, check whetehr it is a pause or an end.
+        if self.status == RACE_STOPPING:
+            if self.three_lap_race and not self._is_three_lap_race_end():
+                self.status = RACE_PAUSED
+                return RACE_PAUSE
+            self.status = NOT_IN_RACE
+            return RACE_ENDED
+
+        return None
+
+    def _is_three_lap_race_end(self) -> bool:
+        # For a full 3-lap race, if
+        #     1) a race event stops (status == 3),
+        #     2) the current position is close to the start position,
+        #     3) is in the 3rd lap, and
+        #     4) race time is in a reasonable range
+        #   then it is the end of the race event.
+        # For a short race, it is always the end of the race.
+        if self.start_pos is None:
+            self._print("Start position not found.")
+            return False
+        prev_telemetry = self.prev_telemetry
+        stop_pos = (
+            prev_telemetry["PositionX"],
+            prev_telemetry["PositionY"],
+            prev_telemetry["PositionZ"]
+        )
+        if not check_position(stop_pos, self.start_pos):
+            self._print("Stop position {} is not close to the start position {}.".format(stop_pos, self.start_pos))
+            return False
+        stop_lap = prev_telemetry["LapNumber"]
+        if not (stop_lap == 2): # LapNumber starts from 0
+            self._print("In lap {}, not the 3rd.".format(stop_lap))
+            return False
+        if prev_telemetry["CurrentRaceTime"] < 2.5 * prev_telemetry["BestLap"]:
+            self._print("CurrentRaceTime is {}. Too early to stop.".format(prev_telemetry["CurrentRaceTime"]))
+            return False
+        return True
@@ -0,0 +1,162 @@
+import numpy as np
+
+WHEELS = ("FrontLeft", "FrontRight", "RearLeft", "RearRight")
+
+# Fields with running mean, standard deviation, min and max.
+SUMMARY_FIELDS = [
+    "Speed",
+    "CurrentEngineRpm",
+    "Power",
+    "Torque",
+    "Boost",
+    "AccelerationX",
+    "AccelerationY",
+    "AccelerationZ",
+] + ["TireTemp" + wheel for wheel in WHEELS] \
+  + ["TireSlipRatio" + wheel for wheel in WHEELS] \
+  + ["TireSlipAngle" + wheel for wheel in WHEELS] \
+  + ["TireCombinedSlip" + wheel for wheel in WHEELS]
+
+COMBINED_SLIP_FIELDS = ["TireCombinedSlip" + wheel for wheel in WHEELS]
+
+class RaceSummary():
+    """
+    Running statistics of one race, updated in O(1) per packet.
+
+    All the state is preallocated: Welford mean/variance, min and max per
+    field of SUMMARY_FIELDS, a gear histogram, a combined tire slip histogram
+    per wheel, lap times, and the mean speed over distance bins of every lap,
+    which summary() folds into n_sectors sectors per lap.
+    """
+
+    def __init__(self,
+                 fields:list=SUMMARY_FIELDS,
+                 n_sectors:int=3,
+                 max_laps:int=32,
+                 distance_bin:float=50,
+                 max_distance_bins:int=512,
+                 n_gears:int=11,
+                 slip_bins:int=20,
+                 max_slip:float=2):
+        self.fields = list(fields)
+        self.n_sectors = n_sectors
+        self.max_laps = max_laps
+        self.distance_bin = distance_bin
+        self.max_distance_bins = max_distance_bins
+        self.n_gears = n_gears
+        self.slip_bin_width = max_slip / slip_bins
+
+        n_fields = len(self.fields)
+        self._x = np.zeros(n_fields)
+        self._delta = np.zeros(n_fields)
+        self.mean = np.zeros(n_fields)
+        self.m2 = np.zeros(n_fields)
+        self.min = np.zeros(n_fields)
+        self.max = np.zeros(n_fields)
+        self.gear_counts = np.zeros(n_gears, dtype=np.int64)
+        self.slip_counts = np.zeros((len(WHEELS), slip_bins), dtype=np.int64)
+        self.lap_times = np.zeros(max_laps)
+        self.speed_sums = np.zeros((max_laps, max_distance_bins))
+        self.speed_counts = np.zeros((max_laps, max_distance_bins), dtype=np.int64)
+        self.lap_distances = np.zeros(max_laps)
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean[:] = 0
+        self.m2[:] = 0
+        self.min[:] = np.inf
+        self.max[:] = -np.inf
+        self.gear_counts[:] = 0
+        self.slip_counts[:] = 0
+        self.lap_times[:] = 0
+        self.speed_sums[:] = 0
+        self.speed_counts[:] = 0
+        self.lap_distances[:] = 0
+        self.lap = 0
+        self.lap_start_distance = None
+        self.last = None
+
+    def update(self, dict_telemetry:dict):
+        x = self._x
+        for i, name in enumerate(self.fields):
+            x[i] = dict_telemetry[name]
+        self.count += 1
+        # Welford's online mean and variance.
+        np.subtract(x, self.mean, out=self._delta)
+        self.mean += self._delta / self.count
+        self.m2 += self._delta * (x - self.mean)
+        np.minimum(self.min, x, out=self.min)
+        np.maximum(self.max, x, out=self.max)
+
+        gear = dict_telemetry["Gear"]
+        self.gear_counts[gear if gear < self.n_gears else self.n_gears - 1] += 1
+        for i, name in enumerate(COMBINED_SLIP_FIELDS):
+            slip_bin = int(abs(dict_telemetry[name]) / self.slip_bin_width)
+            self.slip_counts[i, min(slip_bin, self.slip_counts.shape[1] - 1)] += 1
+
+        lap = min(dict_telemetry["LapNumber"], self.max_laps - 1)
+        distance = dict_telemetry["DistanceTraveled"]
+        if self.lap_start_distance is None:
+            self.lap_start_distance = distance
+        if lap != self.lap:
+            # The game reports the time of the lap just finished in LastLap,
+            # otherwise take the lap time of the previous packet.
+            lap_time = dict_telemetry["LastLap"]
+            if lap_time <= 0 and self.last is not None:
+                lap_time = self.last["CurrentLap"]
+            self.lap_times[self.lap] = lap_time
+            self.lap_distances[self.lap] = distance - self.lap_start_distance
+            self.lap_start_distance = distance
+            self.lap = lap
+        distance_bin = int(max(distance - self.lap_start_distance, 0) / self.distance_bin)
+        distance_bin = min(distance_bin, self.max_distance_bins - 1)
+        self.speed_sums[lap, distance_bin] += dict_telemetry["Speed"]
+        self.speed_counts[lap, distance_bin] += 1
+        self.last = dict_telemetry
+
+    def summary(self) -> dict:
+        # JSON-serializable summary of the race so far.
+        if self.count == 0:
+            return {"packets": 0}
+        std = np.sqrt(self.m2 / self.count)
+        n_laps = self.lap + 1
+        self.lap_distances[self.lap] = self.last["DistanceTraveled"] - self.lap_start_distance
+        return {
+            "packets": self.count,
+            "race_time": self.last["CurrentRaceTime"],
+            "race_position": self.last["RacePosition"],
+            "best_lap": self.last["BestLap"],
+            "lap_times": self.lap_times[:self.lap].tolist() + [self.last["CurrentLap"]],
+            "sector_speeds": [self._sector_speeds(lap) for lap in range(n_laps)],
+            "car": {
+                "ordinal": self.last["CarOrdinal"],
+                "class": self.last["CarClass"],
+                "performance_index": self.last["CarPerformanceIndex"],
+            },
+            "fields": {
+                name: {
+                    "mean": float(self.mean[i]),
+                    "std": float(std[i]),
+                    "min": float(self.min[i]),
+                    "max": float(self.max[i]),
+                }
+                for i, name in enumerate(self.fields)
+            },
+            "gear_histogram": self.gear_counts.tolist(),
+            "combined_slip_histogram": {
+                "bin_width": self.slip_bin_width,
+                "counts": {wheel: self.slip_counts[i].tolist() for i, wheel in enumerate(WHEELS)},
+            },
+        }
+
+    def _sector_speeds(self, lap:int) -> list:
+        # Mean speed of each of n_sectors equal-distance sectors of the lap.
+        n_bins = int(self.lap_distances[lap] / self.distance_bin) + 1
+        n_bins = min(max(n_bins, self.n_sectors), self.max_distance_bins)
+        edges = np.linspace(0, n_bins, self.n_sectors + 1).astype(int)
+        speed_sums = np.add.reduceat(self.speed_sums[lap, :n_bins], edges[:-1])
+        speed_counts = np.add.reduceat(self.speed_counts[lap, :n_bins], edges[:-1])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            speeds = np.where(speed_counts > 0, speed_sums / np.maximum(speed_counts, 1), 0.0)
+        return speeds.tolist()
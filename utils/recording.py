@@ -0,0 +1,255 @@
+import os
+import csv
+import json
+import time
+import zlib
+import struct
+import argparse
+
+import numpy as np
+
+RECORDING_BACKENDS = ("csv", "raw", "columnar")
+
+# Packets per second sent by the game.
+PACKET_RATE = 60
+
+# Raw packet log:
+#     header: magic (8 bytes), packet size (u32), reserved (u32)
+#     record: receive time (f64), packet length (u32), packet
+RAW_MAGIC = b"FZRAW1\0\0"
+RAW_HEADER = struct.Struct("<8sII")
+
+# Columnar chunk file:
+#     header: magic (8 bytes), dtype json length (u32), dtype json
+#     chunk:  number of rows (u32), compressed length (u32),
+#             zlib-compressed columns, one after another
+COLUMNAR_MAGIC = b"FZCOL1\0\0"
+COLUMNAR_HEADER = struct.Struct("<8sI")
+COLUMNAR_CHUNK_HEADER = struct.Struct("<II")
+
+def raw_record_dtype(packet_dtype:np.dtype) -> np.dtype:
+    return np.dtype([
+        ("recv_time", "<f8"),
+        ("length", "<u4"),
+        ("packet", packet_dtype),
+    ])
+
+def columnar_dtype(packet_dtype:np.dtype) -> np.dtype:
+    return np.dtype([("recv_time", "<f8")] + packet_dtype.descr)
+
+class CsvRecorder():
+    # One text row per packet, as TelemetryManager always wrote.
+    ext = ".csv"
+
+    def __init__(self, output_file_name:str, telemetry_parser, append:bool):
+        self.output_file_name = output_file_name
+        fields = list(telemetry_parser.fields)
+        if append:
+            self.output_file_handler = open(output_file_name, "a", newline='', encoding='utf-8')
+            self.csv_writer = csv.DictWriter(self.output_file_handler, fieldnames=fields, extrasaction="ignore")
+        else:
+            self.output_file_handler = open(output_file_name, "w", newline='', encoding='utf-8')
+            self.csv_writer = csv.DictWriter(self.output_file_handler, fieldnames=fields, extrasaction="ignore")
+            self.csv_writer.writeheader()
+
+    def write(self, dict_data:dict, udp_data:bytes=None, recv_time:float=None):
+        self.csv_writer.writerow(dict_data)
+
+    def close(self):
+        self.output_file_handler.close()
+
+class RawPacketRecorder():
+    # Append-only log of the packets as received. The records have a fixed
+    # size, so read_raw_log can memory-map the file without copying.
+    ext = ".fzraw"
+
+    def __init__(self, output_file_name:str, telemetry_parser, append:bool):
+        self.output_file_name = output_file_name
+        self.telemetry_parser = telemetry_parser
+        self.record_header = struct.Struct("<dI")
+        self.output_file_handler = open(output_file_name, "ab" if append else "wb")
+        if self.output_file_handler.tell() == 0:
+            self.output_file_handler.write(RAW_HEADER.pack(RAW_MAGIC, telemetry_parser.packet_size, 0))
+            self.output_file_handler.flush()
+
+    def write(self, dict_data:dict, udp_data:bytes=None, recv_time:float=None):
+        if udp_data is None:
+            udp_data = self.telemetry_parser.decoder.pack(
+                *[dict_data[name] for name in self.telemetry_parser.fields])
+        if recv_time is None:
+            recv_time = time.time()
+        self.output_file_handler.write(self.record_header.pack(recv_time, len(udp_data)))
+        self.output_file_handler.write(udp_data)
+
+    def close(self):
+        self.output_file_handler.close()
+
+class ColumnarRecorder():
+    # Rows are buffered in a preallocated structured array and flushed as a
+    # zlib-compressed columnar chunk every chunk_rows rows.
+    ext = ".fzcol"
+    compress_level = 1
+
+    def __init__(self, output_file_name:str, telemetry_parser, append:bool, chunk_rows:int=600):
+        self.output_file_name = output_file_name
+        self.telemetry_parser = telemetry_parser
+        self.dtype = columnar_dtype(telemetry_parser.dtype)
+        self.chunk_rows = chunk_rows
+        self._packets = telemetry_parser.allocate(chunk_rows)
+        self._recv_times = np.zeros(chunk_rows, dtype="<f8")
+        self._n_rows = 0
+        self.output_file_handler = open(output_file_name, "ab" if append else "wb")
+        if self.output_file_handler.tell() == 0:
+            descr = json.dumps(self.dtype.descr).encode("utf-8")
+            self.output_file_handler.write(COLUMNAR_HEADER.pack(COLUMNAR_MAGIC, len(descr)))
+            self.output_file_handler.write(descr)
+            self.output_file_handler.flush()
+
+    def write(self, dict_data:dict, udp_data:bytes=None, recv_time:float=None):
+        if udp_data is not None:
+            self.telemetry_parser.parse_into(udp_data, self._packets, self._n_rows)
+        else:
+            self._packets[self._n_rows] = tuple(
+                dict_data[name] for name in self.telemetry_parser.fields)
+        self._recv_times[self._n_rows] = time.time() if recv_time is None else recv_time
+        self._n_rows += 1
+        if self._n_rows == self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        if self._n_rows == 0:
+            return
+        n_rows = self._n_rows
+        columns = [self._recv_times[:n_rows].tobytes()]
+        columns += [self._packets[name][:n_rows].tobytes() for name in self.telemetry_parser.fields]
+        chunk = zlib.compress(b"".join(columns), self.compress_level)
+        self.output_file_handler.write(COLUMNAR_CHUNK_HEADER.pack(n_rows, len(chunk)))
+        self.output_file_handler.write(chunk)
+        self.output_file_handler.flush()
+        self._n_rows = 0
+
+    def close(self):
+        self.flush()
+        self.output_file_handler.close()
+
+def create_recorder(backend:str, output_file_name:str, telemetry_parser, append:bool, chunk_rows:int=600):
+    if backend == "csv":
+        return CsvRecorder(output_file_name, telemetry_parser, append)
+    if backend == "raw":
+        return RawPacketRecorder(output_file_name, telemetry_parser, append)
+    if backend == "columnar":
+        return ColumnarRecorder(output_file_name, telemetry_parser, append, chunk_rows)
+    raise ValueError("Unknown recording backend {}, expected one of {}.".format(
+        backend, RECORDING_BACKENDS))
+
+def recorder_ext(backend:str) -> str:
+    return {"csv": CsvRecorder, "raw": RawPacketRecorder, "columnar": ColumnarRecorder}[backend].ext
+
+def read_raw_log(fname:str, packet_dtype:np.dtype) -> np.ndarray:
+    # Memory-map a raw packet log. Returns a structured array with
+    # recv_time, length and packet fields, backed by the file.
+    with open(fname, "rb") as f:
+        magic, packet_size, _ = RAW_HEADER.unpack(f.read(RAW_HEADER.size))
+    if magic != RAW_MAGIC:
+        raise ValueError("{} is not a raw packet log.".format(fname))
+    if packet_size != packet_dtype.itemsize:
+        raise ValueError("{} holds {}-byte packets, expected {} bytes.".format(
+            fname, packet_size, packet_dtype.itemsize))
+    record_dtype = raw_record_dtype(packet_dtype)
+    n_records = (os.path.getsize(fname) - RAW_HEADER.size) // record_dtype.itemsize
+    if n_records == 0:
+        return np.zeros(0, dtype=record_dtype)
+    return np.memmap(fname, dtype=record_dtype, mode="r", offset=RAW_HEADER.size, shape=(n_records,))
+
+def read_columnar(fname:str) -> np.ndarray:
+    # Read a columnar chunk file back into one structured array,
+    # with recv_time followed by the telemetry fields.
+    with open(fname, "rb") as f:
+        magic, descr_len = COLUMNAR_HEADER.unpack(f.read(COLUMNAR_HEADER.size))
+        if magic != COLUMNAR_MAGIC:
+            raise ValueError("{} is not a columnar telemetry file.".format(fname))
+        dtype = np.dtype([tuple(field) for field in json.loads(f.read(descr_len).decode("utf-8"))])
+        chunks = []
+        while True:
+            chunk_header = f.read(COLUMNAR_CHUNK_HEADER.size)
+            if len(chunk_header) < COLUMNAR_CHUNK_HEADER.size:
+                break
+            n_rows, chunk_len = COLUMNAR_CHUNK_HEADER.unpack(chunk_header)
+            columns = zlib.decompress(f.read(chunk_len))
+            rows = np.zeros(n_rows, dtype=dtype)
+            offset = 0
+            for name in dtype.names:
+                column_size = dtype[name].itemsize * n_rows
+                rows[name] = np.frombuffer(columns, dtype=dtype[name], count=n_rows, offset=offset)
+                offset += column_size
+            chunks.append(rows)
+    if not chunks:
+        return np.zeros(0, dtype=dtype)
+    return np.concatenate(chunks)
+
+def read_recording(fname:str, packet_dtype:np.dtype) -> np.ndarray:
+    # Telemetry rows of a raw or columnar recording as a structured array.
+    with open(fname, "rb") as f:
+        magic = f.read(len(RAW_MAGIC))
+    if magic == RAW_MAGIC:
+        return read_raw_log(fname, packet_dtype)["packet"]
+    if magic == COLUMNAR_MAGIC:
+        return read_columnar(fname)[list(packet_dtype.names)]
+    raise ValueError("{} is neither a raw nor a columnar recording.".format(fname))
+
+def load_session(fname:str, parser) -> tuple:
+    # Load a CSV recording of TelemetryManager, a raw packet log or a
+    # columnar recording with the TelemetryParser of its format. Returns
+    # (packets, times) where packets is a structured array with the
+    # telemetry_format layout.
+    with open(fname, "rb") as f:
+        magic = f.read(len(RAW_MAGIC))
+    if magic == RAW_MAGIC:
+        records = read_raw_log(fname, parser.dtype)
+        return np.array(records["packet"]), np.array(records["recv_time"])
+    if magic == COLUMNAR_MAGIC:
+        rows = read_columnar(fname)
+        packets = parser.allocate(len(rows))
+        for name in parser.fields:
+            packets[name] = rows[name]
+        return packets, rows["recv_time"]
+
+    with open(fname, "r", newline='', encoding='utf-8') as f:
+        rows = list(csv.DictReader(f))
+    packets = parser.allocate(len(rows))
+    for name in parser.fields:
+        packets[name] = np.array([float(row[name]) for row in rows]).astype(parser.dtype[name])
+    # CSV rows have no receive time, use the game timestamp if it moves.
+    timestamps = packets["TimestampMS"].astype(np.float64) / 1000
+    if len(rows) > 1 and np.all(np.diff(timestamps) >= 0) and timestamps[-1] > timestamps[0]:
+        times = timestamps - timestamps[0]
+    else:
+        times = np.arange(len(rows)) / float(PACKET_RATE)
+    return packets, times
+
+def export_csv(src_fname:str, dst_fname:str, packet_dtype:np.dtype) -> str:
+    # Export a raw or columnar recording to the CSV layout of CsvRecorder.
+    rows = read_recording(src_fname, packet_dtype)
+    with open(dst_fname, "w", newline='', encoding='utf-8') as f:
+        csv_writer = csv.writer(f)
+        csv_writer.writerow(packet_dtype.names)
+        columns = [rows[name].tolist() for name in packet_dtype.names]
+        csv_writer.writerows(zip(*columns))
+    return dst_fname
+
+if __name__ == "__main__":
+
+    from .forza_telemetry import TelemetryParser
+
+    parser = argparse.ArgumentParser(description='Export a raw or columnar Forza telemetry recording to CSV.')
+    parser.add_argument('src', help='Path of the .fzraw or .fzcol recording.')
+    parser.add_argument('dst', nargs='?', default=None,
+                    help='Path of the CSV file, defaults to the recording path with a .csv extension.')
+    parser.add_argument('--telemetry_format', dest='telemetry_format_fname',
+                    default=os.path.join("config", "telemetry_format"),
+                    help='Path of the telemetry format file.')
+    args = parser.parse_args()
+
+    dst = args.dst or os.path.splitext(args.src)[0] + ".csv"
+    export_csv(args.src, dst, TelemetryParser(args.telemetry_format_fname).dtype)
+    print("Exported {} to {}.".format(args.src, dst))
@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import socket
+import tempfile
+import argparse
+import threading
+
+import numpy as np
+
+from .forza_telemetry import TelemetryParser
+from .recording import load_session, PACKET_RATE
+
+BASE_DIR = "."
+CONFIG_FNAME = os.path.join("config", "forza_config.json")
+TELEMETRY_FORMAT_FNAME = os.path.join("config", "telemetry_format")
+
+def synthesize_session(parser:TelemetryParser,
+                       n_laps:int=3,
+                       lap_time:float=30,
+                       idle_seconds:float=2,
+                       rate:int=PACKET_RATE) -> tuple:
+    # A race of n_laps laps around a circle, with idle packets before and
+    # after it, as the game sends from the menus. Returns (packets, times).
+    n_idle = int(idle_seconds * rate)
+    # The last race packet is just before the line, still in the last lap.
+    n_race = int(n_laps * lap_time * rate) - 1
+    packets = parser.allocate(2 * n_idle + n_race)
+    times = np.arange(len(packets)) / float(rate)
+
+    race = packets[n_idle:n_idle + n_race]
+    race_time = np.arange(n_race) / float(rate) + 1.0 / rate
+    angle = 2 * np.pi * race_time / lap_time
+    lap_number = (race_time // lap_time).astype(int)
+    race["IsRaceOn"] = 1
+    race["RacePosition"] = 1
+    race["CurrentRaceTime"] = race_time
+    race["LapNumber"] = lap_number
+    race["CurrentLap"] = race_time - lap_number * lap_time
+    race["BestLap"] = np.where(lap_number > 0, lap_time, 0)
+    race["PositionX"] = 500 * np.cos(angle)
+    race["PositionZ"] = 500 * np.sin(angle)
+    race["Speed"] = 2 * np.pi * 500 / lap_time
+    race["CurrentEngineRpm"] = 4000 + 2000 * np.sin(angle * 7)
+    race["EngineMaxRpm"] = 8000
+    race["Gear"] = 3 + (np.sin(angle * 7) > 0)
+    race["AccelerationX"] = (2 * np.pi * 500 / lap_time) ** 2 / 500
+    race["TireTempFrontLeft"] = 180 + 20 * np.sin(angle)
+    race["DistanceTraveled"] = race_time * 2 * np.pi * 500 / lap_time
+    packets["TimestampMS"] = (times * 1000).astype(np.uint32)
+    return packets, times
+
+def open_console_sockets(n_consoles:int, target_ip:str) -> list:
+    # One socket per simulated console. On loopback every console gets its
+    # own source IP (127.0.0.10, 127.0.0.11, ...), so the relay sees them as
+    # separate consoles. Elsewhere the consoles share the host IP.
+    socks = []
+    for i in range(n_consoles):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if target_ip.startswith("127."):
+            try:
+                sock.bind(("127.0.0.{}".format(10 + i), 0))
+            except OSError:
+                pass
+        socks.append(sock)
+    return socks
+
+def replay(packets:np.ndarray,
+           times:np.ndarray,
+           target:tuple,
+           n_consoles:int=1,
+           speed:float=1) -> dict:
+    # Send the packets to target from n_consoles consoles, at speed times
+    # real time. speed=0 sends as fast as possible.
+    payloads = [packets[i:i + 1].tobytes() for i in range(len(packets))]
+    socks = open_console_sockets(n_consoles, target[0])
+    offsets = (times - times[0]) / speed if speed > 0 else None
+    n_sent = 0
+    start = time.perf_counter()
+    for i, payload in enumerate(payloads):
+        if offsets is not None:
+            delay = offsets[i] - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        for sock in socks:
+            sock.sendto(payload, target)
+        n_sent += len(socks)
+    duration = time.perf_counter() - start
+    for sock in socks:
+        sock.close()
+    return {
+        "sent": n_sent,
+        "duration": duration,
+        "packets_per_sec": n_sent / duration if duration > 0 else 0.0,
+    }
+
+def run_harness(base_dir:str,
+                packets:np.ndarray,
+                times:np.ndarray,
+                n_consoles:int,
+                speed:float,
+                mode:str="threads",
+                forward_targets:list=None) -> dict:
+    # Replay through an in-process ForzaIoTApp (or AsyncForzaIoTApp) wired to
+    # the local IoT Hub and blob storage stand-ins, and measure what comes
+    # out of it.
+    from main import ForzaIoTApp, AsyncForzaIoTApp
+    from .local_iothub import LocalBlobServer, LocalDeviceClient, LocalAsyncDeviceClient, LocalMessage
+
+    with open(os.path.join(base_dir, CONFIG_FNAME), "r") as f:
+        forza_config = json.load(f)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        forza_config["device"].update({
+            "receive_ip": "127.0.0.1",
+            "receive_port": 0,
+            "output_fname": os.path.join(tmp_dir, "data", "telemetry.csv"),
+            "telemetry_format_fname": os.path.abspath(os.path.join(base_dir, TELEMETRY_FORMAT_FNAME)),
+            "debug": False,
+            "log_fname": "",
+        })
+        forza_config.setdefault("work_queue", {})["journal_fname"] = os.path.join(tmp_dir, "work_queue.sqlite")
+        forza_config["metrics"] = {"enabled": False}
+        forza_config["forwarding"] = {"targets": forward_targets or []}
+        formats_config = forza_config.setdefault("formats", {})
+        formats_config["specs"] = {
+            name: os.path.abspath(os.path.join(base_dir, fname))
+            for name, fname in formats_config.get("specs", {}).items()
+        }
+        formats_config["cache_fname"] = os.path.join(tmp_dir, "telemetry_formats.json")
+        with open(os.path.join(tmp_dir, "forza_config.json"), "w") as f:
+            json.dump(forza_config, f)
+
+        blob_server = LocalBlobServer().start()
+        if mode == "async":
+            device_client = LocalAsyncDeviceClient(blob_server)
+            app = AsyncForzaIoTApp(tmp_dir, "forza_config.json", device_client, LocalMessage)
+        else:
+            device_client = LocalDeviceClient(blob_server)
+            app = ForzaIoTApp(tmp_dir, "forza_config.json", device_client, LocalMessage)
+        app.uploader.scheme = "http"
+        app_thread = threading.Thread(target=app.run, daemon=True)
+        app_thread.start()
+        while not app.running:
+            time.sleep(0.01)
+
+        replay_stats = replay(packets, times, app.sock.getsockname(), n_consoles, speed)
+
+        # Wait for the relay to go idle, i.e. nothing queued and
+        # nothing received for a second.
+        expected = replay_stats["sent"]
+        deadline = time.time() + 30
+        last_received = -1
+        while time.time() < deadline:
+            stats = app.stats()
+            idle = all(stage["depth"] == 0 for stage in stats["pipeline"].values())
+            if idle and stats["receiver"]["packets"] in (expected, last_received):
+                break
+            last_received = stats["receiver"]["packets"]
+            time.sleep(1)
+        app.stop()
+        app_thread.join()
+        blob_server.stop()
+
+        stats = app.stats()
+        received = stats["receiver"]["packets"]
+        return {
+            "mode": mode,
+            "consoles": n_consoles,
+            "sessions": len(app.sessions),
+            "sent": replay_stats["sent"],
+            "received": received,
+            "recorded": app.record_latency.count,
+            "drop_rate": 1 - received / float(expected) if expected else 0.0,
+            "kernel_drops": stats["receiver"]["kernel_drops"],
+            "pipeline_drops": sum(stage["dropped"] for stage in stats["pipeline"].values()),
+            "send_packets_per_sec": replay_stats["packets_per_sec"],
+            "receive_packets_per_sec": received / replay_stats["duration"],
+            "parse_latency": app.parse_latency.as_dict(),
+            "write_latency": app.write_latency.as_dict(),
+            "record_latency": app.record_latency.as_dict(),
+            "message_latency": app.message_latency.as_dict(),
+            "forwarded": stats["forwarder"],
+            "messages": len(device_client.messages),
+            "uploads": len(blob_server.blobs),
+        }
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Replay recorded Forza telemetry over UDP.')
+    parser.add_argument('--base_dir', dest='base_dir', default=BASE_DIR,
+                    help='Base directory of the Forza IoT demo repository.')
+    parser.add_argument('--session', dest='session', default=None,
+                    help='CSV, raw (.fzraw) or columnar (.fzcol) recording. '
+                         'A synthetic 3-lap race is replayed if it is not given.')
+    parser.add_argument('--target', dest='target', default=None,
+                    help='ip:port of a running relay. Without it, an in-process relay '
+                         'with local IoT Hub stand-ins is benchmarked.')
+    parser.add_argument('--consoles', dest='n_consoles', type=int, default=1,
+                    help='Number of simulated consoles.')
+    parser.add_argument('--speed', dest='speed', type=float, default=1,
+                    help='Replay speed, relative to real time. 0 replays as fast as possible.')
+    parser.add_argument('--mode', dest='mode', choices=['threads', 'async'], default='threads',
+                    help='Runtime of the in-process relay.')
+    args = parser.parse_args()
+
+    telemetry_parser = TelemetryParser(os.path.join(args.base_dir, TELEMETRY_FORMAT_FNAME))
+    if args.session:
+        packets, times = load_session(args.session, telemetry_parser)
+    else:
+        packets, times = synthesize_session(telemetry_parser)
+    print("Replaying {} packets from {} console(s) at {}.".format(
+        len(packets), args.n_consoles, "{}x".format(args.speed) if args.speed > 0 else "max speed"))
+
+    if args.target:
+        target_ip, target_port = args.target.rsplit(":", 1)
+        print(json.dumps(replay(packets, times, (target_ip, int(target_port)), args.n_consoles, args.speed), indent=4))
+    else:
+        print(json.dumps(run_harness(args.base_dir, packets, times, args.n_consoles, args.speed, args.mode), indent=4))
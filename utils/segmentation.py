@@ -0,0 +1,163 @@
+import os
+import argparse
+
+import numpy as np
+
+from .race_state import START_POSITION_THRESHOLD
+
+RACE_DTYPE = np.dtype([
+    ("start", "<i8"),   # index of the first recorded packet
+    ("stop", "<i8"),    # index of the packet that ended the race, or len(packets)
+    ("ended", "?"),     # False if the session stops in the middle of the race
+])
+
+SEGMENT_DTYPE = np.dtype([
+    ("race", "<i8"),
+    ("start", "<i8"),
+    ("stop", "<i8"),
+])
+
+LAP_DTYPE = np.dtype([
+    ("race", "<i8"),
+    ("lap", "<i8"),
+    ("start", "<i8"),
+    ("stop", "<i8"),
+    ("lap_time", "<f8"),
+])
+
+class RaceIndex():
+    """
+    Race and lap boundaries of a recorded session, as found by segment_session.
+
+    races:    one row per race, see RACE_DTYPE
+    segments: the packet ranges [start, stop) recorded for each race. A race
+              paused in a 3-lap event has one segment per stint.
+    laps:     one row per lap, ranges of recorded packets with the same LapNumber
+    recorded: boolean mask of the packets the relay records
+    """
+
+    def __init__(self, races:np.ndarray, segments:np.ndarray, laps:np.ndarray, recorded:np.ndarray):
+        self.races = races
+        self.segments = segments
+        self.laps = laps
+        self.recorded = recorded
+
+    def race_packets(self, packets:np.ndarray, race:int) -> np.ndarray:
+        # The packets recorded for race, without the pauses.
+        segments = self.segments[self.segments["race"] == race]
+        return np.concatenate([packets[s["start"]:s["stop"]] for s in segments])
+
+def _runs(mask:np.ndarray) -> tuple:
+    # Start and stop indices of the runs of True in mask.
+    edges = np.diff(np.concatenate(([0], mask.view(np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+def segment_session(packets:np.ndarray, three_lap_race:bool=False) -> RaceIndex:
+    """
+    Apply the race state machine of utils.race_state to a whole session.
+
+    Packets with a non-zero RacePosition form runs. A race starts at the first
+    packet of a run with CurrentRaceTime > 0 and stops at the first packet
+    after the run. In a 3-lap event the race only ends there if the last
+    packet of the run is in the 3rd lap, close to the start position and late
+    enough; otherwise it is paused and resumes with the next run.
+    The per-packet work is vectorized, the loop is over runs.
+    """
+    n_packets = len(packets)
+    pos_not_zero = packets["RacePosition"] != 0
+    time_not_zero = packets["CurrentRaceTime"] > 0
+    run_starts, run_stops = _runs(pos_not_zero)
+
+    # First packet of each run that can start a race.
+    start_candidates = np.flatnonzero(pos_not_zero & time_not_zero)
+    candidate = np.searchsorted(start_candidates, run_starts)
+    has_candidate = candidate < len(start_candidates)
+    first_start = np.full(len(run_starts), -1, dtype=np.int64)
+    first_start[has_candidate] = start_candidates[candidate[has_candidate]]
+    first_start[first_start >= run_stops] = -1
+
+    if three_lap_race and len(run_stops):
+        # Values of the last packet of every run, for the end checks.
+        last = run_stops - 1
+        last_pos = np.stack([packets["PositionX"][last], packets["PositionY"][last], packets["PositionZ"][last]], axis=1)
+        last_pos = last_pos.astype(np.float64)
+        lap_ok = packets["LapNumber"][last] == 2 # LapNumber starts from 0
+        time_ok = ~(packets["CurrentRaceTime"][last] < 2.5 * packets["BestLap"][last])
+
+    races = []
+    segments = []
+    race_start = None
+    start_pos = None
+    for i in range(len(run_starts)):
+        if race_start is None:
+            # Not in a race: wait for a packet with race time.
+            if first_start[i] < 0:
+                continue
+            seg_start = first_start[i]
+            race_start = seg_start
+            start_pos = np.array([
+                packets["PositionX"][seg_start], packets["PositionY"][seg_start], packets["PositionZ"][seg_start]
+            ], dtype=np.float64)
+        else:
+            # Paused: any packet with a race position resumes the race.
+            seg_start = run_starts[i]
+        seg_stop = run_stops[i]
+        segments.append((len(races), seg_start, seg_stop))
+        if seg_stop == n_packets:
+            races.append((race_start, n_packets, False))
+            race_start = None
+            break
+        if three_lap_race:
+            dist2 = np.sum((last_pos[i] - start_pos) ** 2)
+            if not (dist2 < START_POSITION_THRESHOLD and lap_ok[i] and time_ok[i]):
+                continue
+        races.append((race_start, seg_stop, True))
+        race_start = None
+    if race_start is not None:
+        # Paused at the end of the session.
+        races.append((race_start, n_packets, False))
+
+    races = np.array(races, dtype=RACE_DTYPE)
+    segments = np.array(segments, dtype=SEGMENT_DTYPE)
+    recorded = np.zeros(n_packets, dtype=bool)
+    for segment in segments:
+        recorded[segment["start"]:segment["stop"]] = True
+    laps = _find_laps(packets, segments)
+    return RaceIndex(races, segments, laps, recorded)
+
+def _find_laps(packets:np.ndarray, segments:np.ndarray) -> np.ndarray:
+    laps = []
+    for race in np.unique(segments["race"]):
+        race_segments = segments[segments["race"] == race]
+        index = np.concatenate([np.arange(s["start"], s["stop"]) for s in race_segments])
+        lap_number = packets["LapNumber"][index].astype(np.int64)
+        boundaries = np.flatnonzero(np.diff(lap_number)) + 1
+        starts = np.concatenate(([0], boundaries))
+        stops = np.concatenate((boundaries, [len(index)]))
+        lap_times = packets["CurrentLap"][index[stops - 1]]
+        for start, stop, lap_time in zip(starts, stops, lap_times):
+            laps.append((race, lap_number[start], index[start], index[stop - 1] + 1, lap_time))
+    return np.array(laps, dtype=LAP_DTYPE)
+
+if __name__ == "__main__":
+
+    from .forza_telemetry import TelemetryParser
+    from .recording import load_session
+
+    parser = argparse.ArgumentParser(description='Split a recorded Forza session into races and laps.')
+    parser.add_argument('session', help='CSV, raw (.fzraw) or columnar (.fzcol) recording.')
+    parser.add_argument('--telemetry_format', dest='telemetry_format_fname',
+                    default=os.path.join("config", "telemetry_format"),
+                    help='Path of the telemetry format file.')
+    parser.add_argument('--3_lap_race', dest='three_lap_race', action='store_true',
+                    help='Apply the 3-lap race end checks.')
+    args = parser.parse_args()
+
+    packets, times = load_session(args.session, TelemetryParser(args.telemetry_format_fname))
+    race_index = segment_session(packets, args.three_lap_race)
+    for race_id, race in enumerate(race_index.races):
+        print("Race {}: packets {} to {}{}".format(
+            race_id, race["start"], race["stop"], "" if race["ended"] else " (not ended)"))
+        for lap in race_index.laps[race_index.laps["race"] == race_id]:
+            print("    Lap {}: packets {} to {}, {:.3f} s".format(
+                lap["lap"], lap["start"], lap["stop"], lap["lap_time"]))
@@ -0,0 +1,105 @@
+import os
+import json
+import logging
+import threading
+from collections import namedtuple
+
+class Settings(namedtuple("Settings", ["debug", "three_lap_race", "forward_targets"])):
+    """
+    The config values read on the hot path, resolved once.
+
+    Immutable: a config reload builds new Settings and swaps the reference,
+    so a stage reads either the old or the new values, never a mix.
+        debug:           log the race telemetry and the statistics
+        three_lap_race:  race mode of the race state machines
+        forward_targets: tuple of the Forwarder target dicts
+    """
+    __slots__ = ()
+
+def settings_from_config(forza_config:dict) -> Settings:
+    device_config = forza_config["device"]
+    targets = forza_config.get("forwarding", {}).get("targets", [])
+    if not targets and device_config.get("send_ip", ""):
+        # The single target of older configs.
+        targets = [{"ip": device_config["send_ip"], "port": device_config["send_port"]}]
+    return Settings(
+        debug=bool(device_config.get("debug", False)),
+        three_lap_race=bool(device_config.get("3_lap_race", True)),
+        forward_targets=tuple(targets)
+    )
+
+class ConfigWatcher():
+    """
+    Reload the config file when it changes.
+
+    A background thread checks the modification time and size of
+    config_fname every interval seconds; reload() has it check now and
+    reload even if the file looks unchanged, e.g. on SIGHUP. The new config
+    goes to on_change(forza_config). A config that fails to load or apply
+    is logged, and the previous one stays in use.
+    """
+
+    def __init__(self,
+                 config_fname:str,
+                 on_change,
+                 interval:float=2,
+                 logger:logging.Logger=None):
+        self.config_fname = config_fname
+        self.on_change = on_change
+        self.interval = interval
+        self.logger = logger or logging.getLogger(__name__)
+        self._signature = self._stat()
+        self._wake = threading.Event()
+        self._forced = False
+        self._stopping = False
+        self._thread = None
+        self.reloads = 0
+        self.errors = 0
+
+    def _stat(self) -> tuple:
+        try:
+            stat = os.stat(self.config_fname)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="config-watcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping = True
+        self._wake.set()
+
+    def reload(self):
+        # Safe to call from a signal handler, only sets an event.
+        self._forced = True
+        self._wake.set()
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stopping:
+                break
+            forced, self._forced = self._forced, False
+            signature = self._stat()
+            if signature is None or (signature == self._signature and not forced):
+                continue
+            self._signature = signature
+            try:
+                with open(self.config_fname, "r") as f:
+                    forza_config = json.load(f)
+                self.on_change(forza_config)
+            except Exception as e:
+                self.errors += 1
+                self.logger.error("Failed to reload {}, keeping the current config: {}".format(self.config_fname, e))
+                continue
+            self.reloads += 1
+
+    def stats(self) -> dict:
+        return {
+            "reloads": self.reloads,
+            "errors": self.errors,
+        }
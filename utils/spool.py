@@ -0,0 +1,133 @@
+import os
+import gzip
+import shutil
+import logging
+import threading
+import contextlib
+
+from .file_upload import MANIFEST_EXT
+
+UPLOADED_DIR = "uploaded"
+
+class SpoolManager():
+    """
+    Closed recording segments waiting for upload, kept on a disk budget.
+
+    add() moves a closed segment into spool_dir, gzip-compressed if compress
+    is set, and returns its new path; it runs on a work queue thread, in the
+    background of the recorder. Uploaded segments move to spool_dir/uploaded.
+    When the spool grows over budget_bytes, the oldest uploaded segments are
+    deleted first, then the oldest segments not uploaded yet, whose upload
+    jobs then find no file and are skipped. A segment being uploaded, see
+    uploading(), is not deleted.
+    """
+
+    def __init__(self,
+                 spool_dir:str,
+                 budget_bytes:int=None,
+                 compress:bool=False,
+                 compress_level:int=6,
+                 logger:logging.Logger=None):
+        self.spool_dir = spool_dir
+        self.uploaded_dir = os.path.join(spool_dir, UPLOADED_DIR)
+        self.budget_bytes = budget_bytes
+        self.compress = compress
+        self.compress_level = compress_level
+        self.logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._uploading = set()
+        self.evicted = 0
+        self.evicted_not_uploaded = 0
+        for directory in (self.spool_dir, self.uploaded_dir):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+    def add(self, path:str, uploaded:bool=False) -> str:
+        # Move a closed segment into the spool. A segment that is not going
+        # to be uploaded, e.g. the recording of a CSV export, goes straight
+        # to the uploaded directory.
+        directory = self.uploaded_dir if uploaded else self.spool_dir
+        if not os.path.isfile(path):
+            # Already moved by an earlier attempt of the job.
+            for spooled in (os.path.join(directory, os.path.basename(path)) + ext for ext in (".gz", "")):
+                if os.path.isfile(spooled):
+                    return spooled
+            raise FileNotFoundError(path)
+        if self.compress and not uploaded and not path.endswith(".gz"):
+            spooled = os.path.join(directory, os.path.basename(path)) + ".gz"
+            # Compressed aside and renamed, so that a crash leaves either
+            # the segment or its complete .gz.
+            with open(path, "rb") as src, gzip.open(spooled + ".tmp", "wb", self.compress_level) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.replace(spooled + ".tmp", spooled)
+            os.remove(path)
+        else:
+            spooled = os.path.join(directory, os.path.basename(path))
+            shutil.move(path, spooled)
+        self.enforce_budget()
+        return spooled
+
+    @contextlib.contextmanager
+    def uploading(self, path:str):
+        # Keeps path and its upload manifest while the block is running.
+        path = os.path.abspath(path)
+        with self._lock:
+            self._uploading.add(path)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._uploading.discard(path)
+
+    def uploaded(self, path:str):
+        if os.path.isfile(path) and os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.spool_dir):
+            os.replace(path, os.path.join(self.uploaded_dir, os.path.basename(path)))
+        self.enforce_budget()
+
+    def _files(self, directory:str) -> list:
+        # (mtime, size, path) of the segments in directory, oldest first.
+        files = []
+        for fname in os.listdir(directory):
+            path = os.path.join(directory, fname)
+            if fname.endswith(".tmp") or fname.endswith(MANIFEST_EXT) or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, stat.st_size, path))
+        return sorted(files)
+
+    def usage(self) -> int:
+        return sum(size for _, size, _ in self._files(self.spool_dir) + self._files(self.uploaded_dir))
+
+    def enforce_budget(self):
+        if not self.budget_bytes:
+            return
+        with self._lock:
+            uploaded = self._files(self.uploaded_dir)
+            pending = self._files(self.spool_dir)
+            usage = sum(size for _, size, _ in uploaded + pending)
+            for files, not_uploaded in ((uploaded, False), (pending, True)):
+                for _, size, path in files:
+                    if usage <= self.budget_bytes:
+                        return
+                    if os.path.abspath(path) in self._uploading:
+                        continue
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        continue
+                    usage -= size
+                    self.evicted += 1
+                    if os.path.isfile(path + MANIFEST_EXT):
+                        os.remove(path + MANIFEST_EXT)
+                    if not_uploaded:
+                        self.evicted_not_uploaded += 1
+                        self.logger.error("Spool over its budget of {} bytes, deleted {} before upload.".format(
+                            self.budget_bytes, path))
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._files(self.spool_dir)),
+            "bytes": self.usage(),
+            "evicted": self.evicted,
+            "evicted_not_uploaded": self.evicted_not_uploaded,
+        }
@@ -0,0 +1,127 @@
+import operator
+
+import numpy as np
+
+REDUCE_METHODS = ("mean", "max", "last", "lttb")
+
+# The fields whose peaks fall between two messages of a 1 Hz feed.
+REDUCE_FIELDS = [
+    "Speed",
+    "CurrentEngineRpm",
+    "AccelerationX",
+    "AccelerationY",
+    "AccelerationZ",
+    "TireCombinedSlipFrontLeft",
+    "TireCombinedSlipFrontRight",
+    "TireCombinedSlipRearLeft",
+    "TireCombinedSlipRearRight",
+]
+
+class StreamingReducer():
+    """
+    Keep every packet of a message window in a fixed-size ring buffer, one
+    column per field, and reduce the window to n_points values per field
+    with NumPy when it is flushed:
+        mean, max, last: the window is split into n_points buckets of
+                         consecutive samples, reduced per bucket
+        lttb:            Largest-Triangle-Three-Buckets, which keeps the
+                         n_points samples that best preserve the shape of
+                         each field, including its peaks
+    A ring smaller than the window drops the oldest samples, see overwritten.
+    """
+
+    def __init__(self, fields:list=REDUCE_FIELDS, method:str="lttb", n_points:int=10, capacity:int=256):
+        if method not in REDUCE_METHODS:
+            raise ValueError("Unknown reduce method {}, expected one of {}.".format(method, REDUCE_METHODS))
+        self.fields = list(fields)
+        self.method = method
+        self.n_points = n_points
+        self.capacity = capacity
+        self._get_values = operator.itemgetter(*self.fields)
+        self._times = np.zeros(capacity)
+        self._values = np.zeros((capacity, len(self.fields)))
+        self._head = 0
+        self._count = 0
+        self.overwritten = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def add(self, telemetry, t:float):
+        # telemetry is a dict or a record view with every field of fields.
+        values = self._get_values(telemetry)
+        self._values[self._head] = values if len(self.fields) > 1 else (values,)
+        self._times[self._head] = t
+        self._head = (self._head + 1) % self.capacity
+        if self._count == self.capacity:
+            self.overwritten += 1
+        else:
+            self._count += 1
+
+    def reduce(self) -> dict:
+        # The payload of the samples added since the last call, or None.
+        n = self._count
+        if n == 0:
+            return None
+        order = (np.arange(self._head - n, self._head)) % self.capacity
+        times = self._times[order]
+        values = self._values[order]
+        self._count = 0
+
+        payload = {"t0": float(times[0]), "t1": float(times[-1]), "count": n, "method": self.method}
+        if self.method == "lttb":
+            selected = lttb(times, values, self.n_points)
+            for i, name in enumerate(self.fields):
+                payload[name] = {
+                    "t": np.round(times[selected[:, i]] - times[0], 4).tolist(),
+                    "v": values[selected[:, i], i].tolist(),
+                }
+            return payload
+
+        # Start of every bucket, n_points buckets of nearly equal size.
+        n_buckets = min(self.n_points, n)
+        starts = np.arange(n_buckets) * n // n_buckets
+        ends = np.append(starts[1:], n)
+        if self.method == "mean":
+            reduced = np.add.reduceat(values, starts, axis=0) / (ends - starts)[:, None]
+        elif self.method == "max":
+            reduced = np.maximum.reduceat(values, starts, axis=0)
+        else:
+            reduced = values[ends - 1]
+        payload["t"] = np.round(times[ends - 1] - times[0], 4).tolist()
+        for i, name in enumerate(self.fields):
+            payload[name] = reduced[:, i].tolist()
+        return payload
+
+def lttb(x:np.ndarray, y:np.ndarray, n_out:int) -> np.ndarray:
+    # Largest-Triangle-Three-Buckets downsampling of the columns of y
+    # (n, n_fields) over x (n,). Returns the selected row of every column,
+    # an (n_out, n_fields) array of indices. The loop is over the buckets
+    # only, all the columns and the samples of a bucket are vectorized.
+    n, n_fields = y.shape
+    columns = np.arange(n_fields)
+    if n_out >= n or n_out < 3:
+        return np.repeat(np.arange(n)[:, None], n_fields, axis=1)
+    selected = np.zeros((n_out, n_fields), dtype=np.int64)
+    selected[-1] = n - 1
+    # The first and last samples are kept, the others are split in
+    # n_out - 2 buckets.
+    bounds = (np.arange(n_out - 1) * (n - 2) // (n_out - 2) + 1).tolist()
+    a = selected[0]
+    for i in range(n_out - 2):
+        start, end = bounds[i], bounds[i + 1]
+        # Mean of the next bucket, or the last sample after the last bucket.
+        next_end = bounds[i + 2] if i + 2 < len(bounds) else n
+        next_x = x[end:next_end].mean()
+        next_y = y[end:next_end].mean(axis=0)
+        a_x = x[a]
+        a_y = y[a, columns]
+        # Twice the area of the triangle of a, each sample of the bucket
+        # and the mean of the next bucket.
+        areas = np.abs(
+            (a_x - next_x) * (y[start:end] - a_y)
+            - (a_x - x[start:end, None]) * (next_y - a_y)
+        )
+        a = start + np.argmax(areas, axis=0)
+        selected[i + 1] = a
+    return selected
@@ -0,0 +1,241 @@
+import os
+import time
+import signal
+import logging
+import threading
+import multiprocessing as mp
+
+import numpy as np
+
+SHARDING_MODES = ("reuseport", "ports")
+
+# Columns of the shared counter block, one row per worker.
+COUNTERS = ("packets", "bytes", "drops", "queue_depth", "messages", "uploads", "heartbeat")
+
+class SharedCounters():
+    """
+    Counters of the workers in a block of shared memory.
+
+    Each worker only writes its own row, so no lock is needed; the
+    supervisor reads all of them to aggregate.
+    """
+
+    def __init__(self, n_workers:int):
+        self.n_workers = n_workers
+        self._block = mp.RawArray("d", n_workers * len(COUNTERS))
+
+    def _table(self) -> np.ndarray:
+        return np.frombuffer(self._block, dtype=np.float64).reshape(self.n_workers, len(COUNTERS))
+
+    def update(self, worker_id:int, stats:dict):
+        # stats is ForzaIoTApp.stats()
+        receiver = stats["receiver"]
+        pipeline = stats["pipeline"].values()
+        work_queue = stats["work_queue"]
+        self._table()[worker_id] = (
+            receiver["packets"],
+            receiver["bytes"],
+            receiver["drops"] + sum(stage["dropped"] for stage in pipeline),
+            sum(stage["depth"] for stage in pipeline),
+            work_queue.get("message", {}).get("done", 0),
+            work_queue.get("upload", {}).get("done", 0),
+            time.time(),
+        )
+
+    def reset(self, worker_id:int):
+        self._table()[worker_id] = 0
+
+    def rows(self) -> list:
+        return [dict(zip(COUNTERS, row.tolist())) for row in self._table()]
+
+    def report(self, worker_id:int, get_stats, interval:float=0.5) -> threading.Thread:
+        # Copy get_stats() into the row of worker_id every interval seconds.
+        def loop():
+            while True:
+                try:
+                    self.update(worker_id, get_stats())
+                except Exception:
+                    pass
+                time.sleep(interval)
+        thread = threading.Thread(target=loop, name="counters", daemon=True)
+        thread.start()
+        return thread
+
+def shard_config(forza_config:dict, worker_id:int, sharding:str) -> dict:
+    # Config of one worker: its share of the receive port, and its own
+    # work queue journal, log file, metrics endpoint, spool, archive and
+    # format cache.
+    if sharding not in SHARDING_MODES:
+        raise ValueError("Unknown sharding {}, expected one of {}.".format(sharding, SHARDING_MODES))
+    device_config = forza_config["device"]
+    def worker_fname(fname):
+        root, ext = os.path.splitext(fname)
+        return "{}_w{}{}".format(root, worker_id, ext)
+    if sharding == "ports":
+        device_config["receive_port"] += worker_id
+    else:
+        device_config["recv_reuse_port"] = True
+        # A console can move to another worker when the kernel rehashes the
+        # flows, so the workers never append to the same recording.
+        if device_config.get("output_fname", None):
+            device_config["output_fname"] = worker_fname(device_config["output_fname"])
+    work_queue_config = forza_config.setdefault("work_queue", {})
+    work_queue_config["journal_fname"] = worker_fname(
+        work_queue_config.get("journal_fname", "data/work_queue.sqlite"))
+    if device_config.get("log_fname", None):
+        device_config["log_fname"] = worker_fname(device_config["log_fname"])
+    metrics_config = forza_config.get("metrics", {})
+    if metrics_config.get("port", None):
+        metrics_config["port"] += worker_id
+    if metrics_config.get("snapshot_fname", None):
+        metrics_config["snapshot_fname"] = worker_fname(metrics_config["snapshot_fname"])
+    # The spool budget, the archive index and the format cache are kept
+    # by one process each.
+    spool_config = forza_config.setdefault("spool", {})
+    spool_config["dir"] = worker_fname(spool_config.get("dir", "data/spool"))
+    archive_config = forza_config.setdefault("archive", {})
+    archive_config["dir"] = worker_fname(archive_config.get("dir", "data/archive"))
+    formats_config = forza_config.setdefault("formats", {})
+    if formats_config.get("cache_fname", None):
+        formats_config["cache_fname"] = worker_fname(formats_config["cache_fname"])
+    return forza_config
+
+def _kill(process:mp.Process):
+    os.kill(process.pid, getattr(signal, "SIGKILL", signal.SIGTERM))
+
+class Supervisor():
+    """
+    Run n_workers worker processes and restart the ones that exit or hang.
+
+    target(worker_id, counters, *args) is the entry point of a worker. It
+    should update its row of counters, which also serves as heartbeat.
+    A worker is restarted after restart_delay seconds, doubled every time
+    it crashes again within max_restart_delay seconds of its start.
+
+    With "ports" sharding a console stays with its worker, so a restart
+    does not affect the sessions of the other workers. With "reuseport"
+    the kernel hashes the consoles over the open sockets: when a worker
+    exits or comes back, the consoles of healthy workers can move to
+    another worker, which has no session state for them: the race in
+    progress is split between the recordings of both workers.
+    """
+
+    def __init__(self,
+                 target,
+                 n_workers:int,
+                 args:tuple=(),
+                 restart_delay:float=1,
+                 max_restart_delay:float=60,
+                 hang_timeout:float=30,
+                 stats_interval:float=1,
+                 logger:logging.Logger=None):
+        self.target = target
+        self.n_workers = n_workers
+        self.args = args
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.hang_timeout = hang_timeout
+        self.stats_interval = stats_interval
+        self.logger = logger or logging.getLogger(__name__)
+        self.counters = SharedCounters(n_workers)
+        self.processes = [None] * n_workers
+        self.restarts = [0] * n_workers
+        self._started_at = [0.0] * n_workers
+        self._next_start = [0.0] * n_workers
+        self._delays = [restart_delay] * n_workers
+        self._stopping = threading.Event()
+        self._last_totals = None
+
+    def _spawn(self, worker_id:int):
+        self.counters.reset(worker_id)
+        process = mp.Process(
+            target=self.target,
+            args=(worker_id, self.counters) + tuple(self.args),
+            name="worker-{}".format(worker_id)
+        )
+        process.start()
+        self.processes[worker_id] = process
+        self._started_at[worker_id] = time.time()
+        self.logger.warning("Started worker {} (pid {}).".format(worker_id, process.pid))
+
+    def start(self):
+        for worker_id in range(self.n_workers):
+            self._spawn(worker_id)
+
+    def run(self):
+        # Supervise until SIGINT/SIGTERM or stop().
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                signal.signal(signum, lambda signum, frame: self.stop())
+            except ValueError:
+                # Not running in the main thread.
+                pass
+        self.start()
+        last_stats_time = time.time()
+        try:
+            while not self._stopping.wait(0.2):
+                self._check_workers()
+                now = time.time()
+                if now - last_stats_time >= self.stats_interval:
+                    self.logger.info(self.stats(now - last_stats_time))
+                    last_stats_time = now
+        finally:
+            self.shutdown()
+
+    def stop(self):
+        self._stopping.set()
+
+    def _check_workers(self):
+        now = time.time()
+        for worker_id, process in enumerate(self.processes):
+            if process is None:
+                if now >= self._next_start[worker_id]:
+                    self._spawn(worker_id)
+                continue
+            heartbeat = self.counters.rows()[worker_id]["heartbeat"]
+            hung = heartbeat > 0 and now - heartbeat > self.hang_timeout
+            if process.is_alive() and not hung:
+                continue
+            if hung:
+                self.logger.error("Worker {} (pid {}) stopped reporting, killing it.".format(worker_id, process.pid))
+                _kill(process)
+            process.join()
+            self.logger.error("Worker {} (pid {}) exited with code {}.".format(
+                worker_id, process.pid, process.exitcode))
+            # Back off if the worker keeps crashing soon after it starts.
+            if now - self._started_at[worker_id] >= self.max_restart_delay:
+                self._delays[worker_id] = self.restart_delay
+            self._next_start[worker_id] = now + self._delays[worker_id]
+            self._delays[worker_id] = min(self._delays[worker_id] * 2, self.max_restart_delay)
+            self.processes[worker_id] = None
+            self.restarts[worker_id] += 1
+
+    def stats(self, elapsed:float=None) -> dict:
+        rows = self.counters.rows()
+        totals = {name: sum(row[name] for row in rows) for name in COUNTERS if name != "heartbeat"}
+        packets_per_sec = 0.0
+        if elapsed and self._last_totals is not None:
+            packets_per_sec = (totals["packets"] - self._last_totals["packets"]) / elapsed
+        self._last_totals = totals
+        return {
+            "workers": sum(1 for process in self.processes if process is not None and process.is_alive()),
+            "restarts": sum(self.restarts),
+            "packets_per_sec": packets_per_sec,
+            "totals": totals,
+            "per_worker": rows,
+        }
+
+    def shutdown(self, timeout:float=30):
+        # SIGTERM lets the workers drain their queues, then they are killed.
+        self._stopping.set()
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        deadline = time.time() + timeout
+        for process in self.processes:
+            if process is None:
+                continue
+            process.join(max(0, deadline - time.time()))
+            if process.is_alive():
+                _kill(process)
+                process.join()
@@ -0,0 +1,132 @@
+import os
+import json
+import struct
+import logging
+
+from .forza_telemetry import TelemetryParser
+
+# Fields read by the race state machine. Formats without them, e.g. the
+# FM7 sled packet, are only forwarded.
+RACE_FIELDS = ("RacePosition", "CurrentRaceTime", "LapNumber", "BestLap",
+               "PositionX", "PositionY", "PositionZ")
+
+# Every Forza packet starts with s32 IsRaceOn, which is 0 or 1.
+_IS_RACE_ON = struct.Struct("<i")
+
+class TelemetryFormat():
+    # One packet layout, with the counters of its packets.
+
+    def __init__(self, name:str, parser:TelemetryParser):
+        self.name = name
+        self.parser = parser
+        self.packet_size = parser.packet_size
+        self.has_race_fields = all(field in parser.fields for field in RACE_FIELDS)
+        self.packets = 0
+        self.malformed = 0
+
+class FormatRegistry():
+    """
+    The telemetry formats the relay understands, e.g. FM7 sled and dash and
+    FH4 packets from consoles running different games.
+
+    Forza packets carry no format id, but every layout has its own size, so
+    dispatch() picks the format with a dict lookup on the packet length
+    and checks the IsRaceOn header. Packets of no known size are counted as
+    unknown, packets failing the header check as malformed.
+
+    The compiled layouts are cached in cache_fname as JSON, keyed by the
+    size and modification time of each format file, so a restart does not
+    parse the format files again.
+    """
+
+    def __init__(self,
+                 format_fnames:dict,
+                 primary:str=None,
+                 cache_fname:str=None,
+                 logger:logging.Logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.primary = primary
+        self.formats = {}
+        self._by_size = {}
+        self.unknown = 0
+
+        cache = self._load_cache(cache_fname)
+        cache_changed = False
+        for name, fname in sorted(format_fnames.items()):
+            stat = os.stat(fname)
+            stamp = [os.path.abspath(fname), stat.st_size, stat.st_mtime]
+            entry = cache.get(name, None)
+            if entry is None or entry["stamp"] != stamp:
+                entry = {"stamp": stamp, "layout": TelemetryParser.compile_layout(fname)}
+                cache[name] = entry
+                cache_changed = True
+            telemetry_format = TelemetryFormat(name, TelemetryParser(fname, entry["layout"]))
+            other = self._by_size.get(telemetry_format.packet_size, None)
+            if other is not None:
+                raise ValueError("Telemetry formats {} and {} are both {} bytes.".format(
+                    other.name, name, telemetry_format.packet_size))
+            self.formats[name] = telemetry_format
+            self._by_size[telemetry_format.packet_size] = telemetry_format
+
+        if cache_fname and cache_changed:
+            self._save_cache(cache_fname, {name: cache[name] for name in self.formats})
+
+    def _load_cache(self, cache_fname:str) -> dict:
+        if not cache_fname or not os.path.exists(cache_fname):
+            return {}
+        try:
+            with open(cache_fname, "r") as f:
+                return json.load(f)
+        except (ValueError, OSError):
+            self.logger.warning("Ignoring the unreadable telemetry format cache {}.".format(cache_fname))
+            return {}
+
+    def _save_cache(self, cache_fname:str, cache:dict):
+        cache_dir = os.path.dirname(cache_fname)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Written aside and renamed, so that a reader never sees half a file.
+        with open(cache_fname + ".tmp", "w") as f:
+            json.dump(cache, f)
+        os.replace(cache_fname + ".tmp", cache_fname)
+
+    def dispatch(self, udp_data) -> TelemetryFormat:
+        # The format of a packet, or None if it is unknown or malformed.
+        telemetry_format = self._by_size.get(len(udp_data), None)
+        if telemetry_format is None:
+            self.unknown += 1
+            return None
+        if _IS_RACE_ON.unpack_from(udp_data)[0] not in (0, 1):
+            telemetry_format.malformed += 1
+            return None
+        telemetry_format.packets += 1
+        return telemetry_format
+
+    def stats(self) -> dict:
+        stats = {
+            name: {"packets": telemetry_format.packets, "malformed": telemetry_format.malformed}
+            for name, telemetry_format in self.formats.items()
+        }
+        stats["unknown"] = self.unknown
+        return stats
+
+def registry_from_config(forza_config:dict, logger:logging.Logger=None) -> FormatRegistry:
+    # The formats of the "formats" section, plus device.telemetry_format_fname
+    # as the primary format. Its sessions keep the file names of a single
+    # format relay.
+    formats_config = forza_config.get("formats", {})
+    format_fnames = dict(formats_config.get("specs", {}))
+    primary_fname = os.path.abspath(forza_config["device"]["telemetry_format_fname"])
+    primary = None
+    for name, fname in format_fnames.items():
+        if os.path.abspath(fname) == primary_fname:
+            primary = name
+    if primary is None:
+        primary = "default"
+        format_fnames[primary] = primary_fname
+    return FormatRegistry(
+        format_fnames,
+        primary=primary,
+        cache_fname=formats_config.get("cache_fname", None),
+        logger=logger
+    )
@@ -1,27 +1,961 @@
 import os
+import re
+import sys
 import json
+import gzip
+import zlib
+import socket
+import time
+import signal
 import argparse
+import threading
+import tempfile
+import urllib.request
 import multiprocessing as mp
 
-from file_upload import upload_file_through_iothub
+import numpy as np
+
+from file_upload import upload_file_through_iothub, BlobUploader, BlobUploadError
+from local_iothub import LocalBlobServer, LocalDeviceClient
+
+# The modules with package-relative imports are imported through utils.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.forza_telemetry import TelemetryParser
+from utils.race_state import RaceStateMachine, RACE_STARTED, RACE_RECORDING, RACE_ENDED
+from utils.segmentation import segment_session
+from utils.replay import synthesize_session, run_harness, replay
+from utils.race_summary import RaceSummary
+from utils.forwarder import Forwarder
+from utils.metrics import MetricsRegistry, MetricsServer, SnapshotWriter
+from utils.profiling import ProfilerHook
+from utils.telemetry_formats import FormatRegistry
+from utils.message_batcher import MessageBatcher, encode_message
+from utils.archive import SessionArchive
+from utils.recording import RawPacketRecorder, CsvRecorder, create_recorder, recorder_ext, read_recording, read_raw_log, read_columnar, export_csv
+from utils.spool import SpoolManager
+from utils.work_queue import WorkQueue
+from utils.device_connection import DeviceConnection
+from utils.supervisor import Supervisor, shard_config
+from utils.benchmark import make_packets
+from utils.udp_receiver import UdpReceiver
+from utils.pipeline import BoundedQueue, Pipeline
 
 BASE_DIR = ".."
 CONFIG_FNAME = os.path.join("config", "forza_config.json")
 
+def test_streaming_upload(compress:bool):
+    # Upload through the local blob stand-in, interrupt it,
+    # then check that the second attempt resumes and the blob is complete.
+    content = os.urandom(300 * 1024)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path_to_file = os.path.join(tmp_dir, "telemetry_20200317074355.csv")
+        with open(path_to_file, "wb") as f:
+            f.write(content)
+
+        blob_server = LocalBlobServer(fail_after_blocks=2).start()
+        device_client = LocalDeviceClient(blob_server)
+        uploader = BlobUploader(device_client, block_size=64 * 1024, compress=compress, scheme="http")
+        try:
+            uploader.upload_sync(path_to_file, os.path.basename(path_to_file))
+            raise AssertionError("The first upload should have been interrupted.")
+        except BlobUploadError:
+            pass
+        assert os.path.isfile(path_to_file + ".upload.json")
+
+        blob_server.fail_after_blocks = None
+        blob_name = uploader.upload(path_to_file, os.path.basename(path_to_file)).result()
+        uploader.shutdown()
+        blob_server.stop()
+
+        blob = blob_server.blobs["/forza/forza_iot_relay/" + blob_name]
+        if compress:
+            blob = gzip.decompress(blob)
+        assert blob == content
+        # 5 blocks in total, the first 2 were not sent again.
+        assert blob_server.n_block_requests == 5
+        assert device_client.upload_notifications[-1][1] is True
+        assert not os.path.isfile(path_to_file + ".upload.json")
+    print("Streaming upload (compress={}) passed.".format(compress))
+
+def _random_session(parser:TelemetryParser, rng:np.random.RandomState) -> np.ndarray:
+    # Blocks of idle, menu and racing packets, with the positions, laps and
+    # times the 3-lap end checks look at drawn from a few values.
+    blocks = []
+    for _ in range(rng.randint(1, 12)):
+        n_packets = rng.randint(1, 15)
+        kind = rng.randint(3)
+        block = parser.allocate(n_packets)
+        block["RacePosition"] = 0 if kind == 0 else rng.randint(1, 3, n_packets)
+        block["CurrentRaceTime"] = 0 if kind < 2 else rng.choice([0.5, 30.0], n_packets)
+        block["LapNumber"] = rng.randint(3, size=n_packets)
+        block["PositionX"] = rng.choice([0.0, 50.0, 500.0], n_packets)
+        block["PositionZ"] = rng.choice([0.0, 150.0], n_packets)
+        block["BestLap"] = rng.choice([0.0, 10.0, 20.0], n_packets)
+        block["CurrentLap"] = rng.rand(n_packets)
+        blocks.append(block)
+    return np.concatenate(blocks)
+
+def test_record_view(base_dir:str, n_packets:int=1000):
+    # Every field read through the record view must pack back into the packet.
+    parser = TelemetryParser(os.path.join(base_dir, "config", "telemetry_format"))
+    for udp_data in make_packets(parser, n_packets):
+        record = parser.view(udp_data)
+        assert parser.decoder.pack(*[record[name] for name in parser.fields]) == udp_data
+        assert parser.decoder.pack(*[getattr(record, name) for name in parser.fields]) == udp_data
+        record["RaceStatus"] = 2
+        dict_data = record.to_dict()
+        assert dict_data.pop("RaceStatus") == 2
+        assert parser.decoder.pack(*dict_data.values()) == udp_data
+    print("Record view of {} packets passed.".format(n_packets))
+
+def test_segmentation(base_dir:str, n_sessions:int=1000):
+    # segment_session must record and end races exactly where the
+    # streaming RaceStateMachine does.
+    parser = TelemetryParser(os.path.join(base_dir, "config", "telemetry_format"))
+    rng = np.random.RandomState(0)
+    sessions = [_random_session(parser, rng) for _ in range(n_sessions)]
+    sessions.append(synthesize_session(parser)[0])
+    for packets in sessions:
+        for three_lap_race in (False, True):
+            race_state = RaceStateMachine(three_lap_race, verbose=False)
+            recorded = np.zeros(len(packets), dtype=bool)
+            ends = []
+            for i in range(len(packets)):
+                race_event = race_state.update(dict(zip(parser.fields, packets[i].tolist())))
+                recorded[i] = race_event in (RACE_STARTED, RACE_RECORDING)
+                if race_event == RACE_ENDED:
+                    ends.append(i)
+            race_index = segment_session(packets, three_lap_race)
+            assert (race_index.recorded == recorded).all()
+            assert race_index.races["stop"][race_index.races["ended"]].tolist() == ends
+    print("Segmentation of {} sessions passed.".format(len(sessions)))
+
+def test_race_summary(base_dir:str):
+    # The running statistics must match NumPy over the recorded packets.
+    parser = TelemetryParser(os.path.join(base_dir, "config", "telemetry_format"))
+    packets = synthesize_session(parser, n_laps=3, lap_time=30)[0]
+    race_summary = RaceSummary(n_sectors=3)
+    race_state = RaceStateMachine(verbose=False)
+    recorded = []
+    for i in range(len(packets)):
+        dict_telemetry = dict(zip(parser.fields, packets[i].tolist()))
+        race_event = race_state.update(dict_telemetry)
+        if race_event == RACE_STARTED:
+            race_summary.reset()
+        if race_event in (RACE_STARTED, RACE_RECORDING):
+            race_summary.update(dict_telemetry)
+            recorded.append(i)
+    summary = json.loads(json.dumps(race_summary.summary()))
+    race = packets[recorded]
+    assert summary["packets"] == len(race)
+    for name in ("Speed", "CurrentEngineRpm", "TireTempFrontLeft"):
+        values = race[name].astype(np.float64)
+        assert np.isclose(summary["fields"][name]["mean"], values.mean())
+        assert np.isclose(summary["fields"][name]["std"], values.std())
+        assert summary["fields"][name]["max"] == values.max()
+    assert np.allclose(summary["lap_times"], [30, 30, 30], atol=0.05)
+    assert np.allclose(summary["sector_speeds"], race["Speed"][0], rtol=1e-5)
+    assert sum(summary["gear_histogram"]) == len(race)
+    print("Race summary passed.")
+
+def test_forwarder(base_dir:str):
+    # A target with fields gets those fields of the packet, in packet order,
+    # a rate of 10 Hz keeps 1 packet out of 6 at 60 Hz, and the targets
+    # replaced by a reload are closed by the next forward.
+    parser = TelemetryParser(os.path.join(base_dir, "config", "telemetry_format"))
+    packets = synthesize_session(parser, n_laps=1, lap_time=2, idle_seconds=0)[0]
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    sink.settimeout(1)
+    fields = ["Gear", "Speed", "CurrentEngineRpm", "TimestampMS"]
+    forwarder = Forwarder([{
+        "ip": "127.0.0.1", "port": sink.getsockname()[1], "rate": 10, "fields": fields
+    }], [parser.dtype])
+    for i in range(len(packets)):
+        forwarder.forward(memoryview(packets[i:i + 1].tobytes()), ("192.168.1.20", 1024))
+    out_dtype = np.dtype([(name, parser.dtype[name]) for name in sorted(fields, key=lambda name: parser.dtype.fields[name][1])])
+    received = [np.frombuffer(sink.recv(1024), dtype=out_dtype)[0] for _ in range(forwarder.targets[0].sent)]
+    assert abs(len(received) - len(packets) / 6.0) <= 1
+    for name in fields:
+        assert [row[name] for row in received] == packets[name][::6][:len(received)].tolist()
+
+    # A replaced target stays open until the forwarding thread has moved
+    # on to the new targets.
+    old_target = forwarder.targets[0]
+    forwarder.set_targets([{"ip": "127.0.0.1", "port": sink.getsockname()[1]}])
+    assert old_target.sock.fileno() != -1
+    forwarder.forward_batch([(memoryview(packets[0:1].tobytes()), ("192.168.1.20", 1024))])
+    assert old_target.sock.fileno() == -1 and sink.recv(1024) == packets[0:1].tobytes()
+    forwarder.set_targets([])
+    forwarder.close()
+    sink.close()
+    print("Forwarder passed.")
+
+def test_format_registry(base_dir:str):
+    # Packets of each format are dispatched by size, the layouts come from
+    # the cache the second time, and bad packets are counted, not parsed.
+    format_fnames = {
+        "fh4": os.path.join(base_dir, "config", "telemetry_format"),
+        "fm7_dash": os.path.join(base_dir, "config", "formats", "fm7_dash"),
+        "fm7_sled": os.path.join(base_dir, "config", "formats", "fm7_sled"),
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_fname = os.path.join(tmp_dir, "telemetry_formats.json")
+        FormatRegistry(format_fnames, cache_fname=cache_fname)
+        registry = FormatRegistry(format_fnames, cache_fname=cache_fname)
+    assert {name: f.packet_size for name, f in registry.formats.items()} == {
+        "fh4": 324, "fm7_dash": 311, "fm7_sled": 232}
+    assert not registry.formats["fm7_sled"].has_race_fields
+    for name, telemetry_format in registry.formats.items():
+        parser = TelemetryParser(format_fnames[name])
+        assert telemetry_format.parser.struct_format == parser.struct_format
+        assert telemetry_format.parser.dtype == parser.dtype
+        packet = make_packets(parser, 1)[0]
+        packet = b"\x01\x00\x00\x00" + packet[4:]
+        assert registry.dispatch(packet) is telemetry_format
+        record = telemetry_format.parser.view(packet)
+        assert record.to_dict() == parser.parse(packet)
+    assert registry.dispatch(b"\x00" * 100) is None
+    assert registry.dispatch(b"\x07" * 311) is None
+    assert registry.stats() == {
+        "fh4": {"packets": 1, "malformed": 0},
+        "fm7_dash": {"packets": 1, "malformed": 1},
+        "fm7_sled": {"packets": 1, "malformed": 0},
+        "unknown": 1,
+    }
+    print("Format registry passed.")
+
+def _reference_lttb(x:list, y:list, n_out:int) -> list:
+    # Textbook LTTB of a single series, one point at a time.
+    n = len(x)
+    every = (n - 2) / (n_out - 2)
+    selected = [0]
+    a = 0
+    for i in range(n_out - 2):
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        next_x = sum(x[next_start:next_end]) / (next_end - next_start)
+        next_y = sum(y[next_start:next_end]) / (next_end - next_start)
+        best_area = -1
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            area = abs((x[a] - next_x) * (y[j] - y[a]) - (x[a] - x[j]) * (next_y - y[a]))
+            if area > best_area:
+                best_area, best = area, j
+        selected.append(best)
+        a = best
+    return selected + [n - 1]
+
+def test_streaming_reducer():
+    # The reduced window of 60 packets must match NumPy per bucket and a
+    # plain LTTB per field, and keep the RPM peak between two messages.
+    rng = np.random.RandomState(0)
+    fields = ["Speed", "CurrentEngineRpm"]
+    samples = [{"Speed": float(v), "CurrentEngineRpm": 4000.0} for v in rng.uniform(0, 80, 60)]
+    samples[23]["CurrentEngineRpm"] = 9000.0
+    times = [i / 60.0 for i in range(60)]
+    for method in ("mean", "max", "last", "lttb"):
+        batcher = MessageBatcher(mode="reduce", window=1, fields=fields,
+                                 reduce_config={"method": method, "points": 6, "capacity": 64})
+        payloads = [batcher.add(sample, t) for sample, t in zip(samples, times)]
+        assert payloads.count(None) == len(payloads)
+        payload = json.loads(json.dumps(batcher.flush()))
+        assert payload["count"] == 60 and batcher.flush() is None
+        speed = np.array([sample["Speed"] for sample in samples]).reshape(6, 10)
+        if method == "mean":
+            assert np.allclose(payload["Speed"], speed.mean(axis=1))
+        elif method == "max":
+            assert payload["Speed"] == speed.max(axis=1).tolist()
+            assert 9000.0 in payload["CurrentEngineRpm"]
+        elif method == "last":
+            assert payload["Speed"] == speed[:, -1].tolist()
+        else:
+            selected = _reference_lttb(times, [sample["Speed"] for sample in samples], 6)
+            assert payload["Speed"]["v"] == [samples[i]["Speed"] for i in selected]
+            assert 9000.0 in payload["CurrentEngineRpm"]["v"]
+    print("Streaming reducer passed.")
+
+def test_archive(base_dir:str):
+    # Races of a raw and a CSV recording are indexed by car, the lap query
+    # uses the lap times, and the memory-mapped slices are the packets.
+    parser = TelemetryParser(os.path.join(base_dir, "config", "telemetry_format"))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        archive = SessionArchive(os.path.join(tmp_dir, "archive"))
+        sessions = {}
+        for car_ordinal, lap_time, recorder_cls in ((1234, 30, RawPacketRecorder), (99, 20, CsvRecorder)):
+            packets, times = synthesize_session(parser, n_laps=3, lap_time=lap_time)
+            packets["CarOrdinal"] = car_ordinal
+            fname = os.path.join(tmp_dir, "telemetry_{}{}".format(car_ordinal, recorder_cls.ext))
+            recorder = recorder_cls(fname, parser, append=False)
+            for i in range(len(packets)):
+                recorder.write(dict(zip(parser.fields, packets[i].tolist())), packets[i:i + 1].tobytes(), 1e9 + times[i])
+            recorder.close()
+            assert archive.add(fname, parser) == 1
+            assert archive.add(fname, parser) == 0
+            sessions[car_ordinal] = packets
+        races = archive.races(car_ordinal=1234)
+        assert len(races) == 1 and races[0]["n_laps"] == 3 and races[0]["start_time"] > 1e9
+        laps = archive.laps(max_lap_time=25)
+        assert [lap["car_ordinal"] for lap in laps] == [99, 99, 99]
+        for lap in laps:
+            assert abs(lap["lap_time"] - 20) < 0.05
+        lap = archive.laps(car_ordinal=1234, min_lap_time=25)[1]
+        packets = archive.read(lap)["packet"]
+        expected = sessions[1234][sessions[1234]["LapNumber"] == lap["lap"]]
+        expected = expected[expected["RacePosition"] != 0]
+        assert np.array_equal(np.asarray(packets), expected)
+
+        # A relay recording has only the race packets, without the idle
+        # packets that end it, and is rotated into segments: the relay
+        # tells the end state and the segments make one race.
+        packets, times = synthesize_session(parser, n_laps=3, lap_time=30)
+        packets["CarOrdinal"] = 555
+        in_race = (packets["RacePosition"] != 0) & (packets["CurrentRaceTime"] > 0)
+        packets, times = packets[in_race], times[in_race]
+        split = len(packets) // 2
+        for segment, (start, stop) in enumerate(((0, split), (split, len(packets)))):
+            fname = os.path.join(tmp_dir, "telemetry_555_{}.fzraw".format(segment))
+            recorder = RawPacketRecorder(fname, parser, append=False)
+            for i in range(start, stop):
+                recorder.write(None, packets[i:i + 1].tobytes(), 1e9 + times[i])
+            recorder.close()
+            assert archive.add(fname, parser, ended=segment == 1, session="555", segment=segment) == 1
+            races = archive.races(car_ordinal=555)
+            assert len(races) == 1 and races[0]["ended"] == (segment == 1)
+        assert archive.add(fname, parser, ended=True, session="555", segment=1) == 0
+        assert races[0]["n_laps"] == 3 and not archive.races(ended=False)
+        assert np.array_equal(np.asarray(archive.read(races[0])["packet"]), packets)
+        assert len(archive.laps(car_ordinal=555)) == 3
+        archive.close()
+    print("Session archive passed.")
+
+def test_spool():
+    # Uploads fail while the uplink is down, then the backlog drains oldest
+    # first at the bandwidth cap, and the spool keeps its disk budget.
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        spool = SpoolManager(os.path.join(tmp_dir, "spool"), budget_bytes=550 * 1024, compress=True)
+        blob_server = LocalBlobServer(fail_after_blocks=0).start()
+        uploader = BlobUploader(LocalDeviceClient(blob_server), block_size=64 * 1024, scheme="http",
+                                max_rate=1024 * 1024)
+        uploaded = []
+        def upload(job):
+            uploader.upload_sync(job["path"], os.path.basename(job["path"]), compress=False)
+            spool.uploaded(job["path"])
+            uploaded.append(job["path"])
+        work_queue = WorkQueue(os.path.join(tmp_dir, "work_queue.sqlite"), {"upload": upload},
+                               max_retries={"upload": None}, retry_base_delay=0.05, retry_max_delay=0.2)
+        work_queue.start()
+        def add_segment(i):
+            fname = os.path.join(tmp_dir, "telemetry_2020031707435{}.csv".format(i))
+            with open(fname, "wb") as f:
+                f.write(os.urandom(100 * 1024))
+            return spool.add(fname)
+        paths = []
+        for i in range(5):
+            paths.append(add_segment(i))
+            work_queue.submit("upload", {"path": paths[-1]})
+        assert all(path.endswith(".gz") for path in paths)
+        time.sleep(0.5)
+        assert not uploaded and work_queue.stats()["upload"]["retries"] > 0
+
+        blob_server.fail_after_blocks = None
+        start = time.time()
+        while len(uploaded) < len(paths) and time.time() - start < 10:
+            time.sleep(0.05)
+        elapsed = time.time() - start
+        work_queue.shutdown()
+        blob_server.stop()
+        order = [paths.index(path) for path in uploaded]
+        assert sorted(order) == list(range(len(paths))) and order[1:] == sorted(order[1:])
+        # About 500 KB at 1 MB/s.
+        assert elapsed > 0.4
+        assert spool.stats()["pending"] == 0 and spool.evicted == 0
+        # Two more segments go over budget, the oldest uploaded ones go.
+        add_segment(5)
+        add_segment(6)
+        assert spool.usage() <= 550 * 1024 and spool.evicted == 2 and spool.evicted_not_uploaded == 0
+        assert sorted(os.listdir(spool.uploaded_dir)) == [os.path.basename(path) for path in paths[2:]]
+        assert spool.stats()["pending"] == 2
+        # Over budget with nothing uploaded left to delete, the oldest pending
+        # segment is kept while it is being uploaded, the next one goes.
+        for path in paths[2:]:
+            os.remove(os.path.join(spool.uploaded_dir, os.path.basename(path)))
+        pending = sorted(os.path.join(spool.spool_dir, fname) for fname in os.listdir(spool.spool_dir)
+                         if not os.path.isdir(os.path.join(spool.spool_dir, fname)))
+        with open(pending[0] + ".upload.json", "w") as f:
+            f.write("{}")
+        spool.budget_bytes = 250 * 1024
+        with spool.uploading(pending[0]):
+            add_segment(7)
+        assert os.path.isfile(pending[0]) and os.path.isfile(pending[0] + ".upload.json")
+        assert not os.path.isfile(pending[1]) and spool.evicted_not_uploaded == 1
+    print("Spool passed.")
+
+def test_device_connection():
+    # A message sent while the hub is unreachable waits for the background
+    # connection, which retries with backoff, and is then delivered.
+    device_client = LocalDeviceClient(fail_connects=2)
+    connection = DeviceConnection(lambda: device_client, retry_base_delay=0.05)
+    sender = threading.Thread(target=connection.send_message, args=("hello",))
+    sender.start()
+    connection.start()
+    sender.join(5)
+    assert not sender.is_alive()
+    assert [message for _, message in device_client.messages] == ["hello"]
+    assert connection.stats() == {"connected": 1, "connects": 1, "failures": 2}
+    # A dropped connection is noticed after a failed call and re-established.
+    device_client.disconnect()
+    connection.stop()
+    connection = DeviceConnection(lambda: device_client, retry_base_delay=0.05, check_interval=0.05)
+    connection.start()
+    connection.wait(5)
+    device_client.disconnect()
+    time.sleep(0.2)
+    assert device_client.connected and connection.connects == 2
+    connection.stop()
+    print("Device connection passed.")
+
+def _relay_config(base_dir:str, tmp_dir:str) -> dict:
+    # Config of an in-process relay on a free local port, writing to tmp_dir.
+    with open(os.path.join(base_dir, CONFIG_FNAME), "r") as f:
+        forza_config = json.load(f)
+    forza_config["device"].update({
+        "receive_ip": "127.0.0.1",
+        "receive_port": 0,
+        "output_fname": os.path.join(tmp_dir, "data", "telemetry.csv"),
+        "telemetry_format_fname": os.path.abspath(os.path.join(base_dir, "config", "telemetry_format")),
+        "debug": False,
+        "log_fname": "",
+        "3_lap_race": True,
+    })
+    forza_config["work_queue"]["journal_fname"] = os.path.join(tmp_dir, "work_queue.sqlite")
+    forza_config["metrics"] = {"enabled": False}
+    forza_config["spool"] = {"enabled": False}
+    forza_config["forwarding"] = {"targets": []}
+    forza_config["formats"]["specs"] = {
+        name: os.path.abspath(os.path.join(base_dir, fname))
+        for name, fname in forza_config["formats"]["specs"].items()
+    }
+    forza_config["formats"]["cache_fname"] = os.path.join(tmp_dir, "telemetry_formats.json")
+    return forza_config
+
+def test_config_reload(base_dir:str):
+    # A changed config file swaps the settings of the running relay: a new
+    # forward target receives packets, the race mode of the existing race
+    # state machine changes, and the receive socket stays the same.
+    from main import ForzaIoTApp
+    from local_iothub import LocalMessage
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        forza_config = _relay_config(base_dir, tmp_dir)
+        forza_config["config_watch"] = {"enabled": True, "interval": 0.05}
+        config_fname = os.path.join(tmp_dir, "forza_config.json")
+        with open(config_fname, "w") as f:
+            json.dump(forza_config, f)
+
+        app = ForzaIoTApp(tmp_dir, "forza_config.json", LocalDeviceClient(), LocalMessage)
+        app_thread = threading.Thread(target=app.run, daemon=True)
+        app_thread.start()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        packet = bytes(app.formats.formats[app.formats.primary].packet_size)
+        while app.packets_parsed.value == 0:
+            sock.sendto(packet, app.sock.getsockname())
+            time.sleep(0.01)
+        relay_sock = app.sock
+        session, = app.sessions.values()
+        assert app.forwarder is None and session.race_state.three_lap_race
+
+        sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink.bind(("127.0.0.1", 0))
+        sink.settimeout(1)
+        forza_config["forwarding"]["targets"] = [{"ip": "127.0.0.1", "port": sink.getsockname()[1]}]
+        forza_config["device"]["3_lap_race"] = False
+        forza_config["device"]["debug"] = True
+        forza_config["device"]["receive_port"] = 1
+        with open(config_fname, "w") as f:
+            json.dump(forza_config, f)
+        while app.config_watcher.reloads == 0:
+            time.sleep(0.01)
+        assert app.settings.debug and not app.settings.three_lap_race
+        assert not session.race_state.three_lap_race and app.sessions[("127.0.0.1", app.formats.primary)] is session
+        sock.sendto(packet, app.sock.getsockname())
+        assert sink.recv(1024) == packet
+        assert app.sock is relay_sock
+
+        # A broken config keeps the current settings.
+        with open(config_fname, "w") as f:
+            f.write("{")
+        while app.config_watcher.errors == 0:
+            time.sleep(0.01)
+        assert app.settings.debug and app.forwarder is not None
+        app.stop()
+        app_thread.join()
+        sock.close()
+        sink.close()
+    print("Config reload passed.")
+
+def test_receiver_ring():
+    # A batch handed back before an older one, e.g. dropped from a full
+    # queue, does not free the slots of the older batch.
+    receiver = UdpReceiver("127.0.0.1", 0, ring_size=4, batch_size=2, timeout=0.5)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    def send(*payloads):
+        for payload in payloads:
+            sock.sendto(payload, receiver.sock.getsockname())
+        time.sleep(0.05)
+    send(b"a0", b"a1", b"b0", b"b1")
+    older = receiver.share(receiver.recv_batch(), 1)
+    newer = receiver.share(receiver.recv_batch(), 1)
+    newer.done()
+    send(b"c0", b"c1")
+    assert receiver.recv_batch() == [] and receiver.stats.overruns == 1
+    assert [bytes(data) for data, _ in older.batch] == [b"a0", b"a1"]
+    older.done()
+    batch = receiver.recv_batch()
+    assert [bytes(data) for data, _ in batch] == [b"c0", b"c1"]
+    receiver.share(batch, 2).done()
+    assert receiver._used == 2
+    sock.close()
+    receiver.close()
+    print("Receiver ring passed.")
+
+def test_parse_paths(base_dir:str, n_packets:int=200):
+    # parse_into and parse_batch decode the same values as parse, for every
+    # telemetry format.
+    for fname in ("telemetry_format", os.path.join("formats", "fm7_dash"), os.path.join("formats", "fm7_sled")):
+        parser = TelemetryParser(os.path.join(base_dir, "config", fname))
+        packets = make_packets(parser, n_packets)
+        out = parser.allocate(n_packets)
+        for i, data in enumerate(packets):
+            parser.parse_into(data, out, i)
+        batch = parser.parse_batch(packets)
+        for i, data in enumerate(packets):
+            expected = parser.parse(data)
+            assert len(data) == parser.dtype.itemsize
+            for name in parser.fields:
+                assert out[i][name].item() == expected[name], (fname, name)
+                assert batch[i][name].item() == expected[name], (fname, name)
+    print("Parse paths of 3 formats passed.")
+
+def test_receiver_batches():
+    # Datagrams are drained in batches of batch_size, and one larger than a
+    # ring slot is counted as truncated, with recvmsg_into (Linux) and with
+    # the recvfrom_into fallback.
+    for use_recvmsg in (True, False):
+        receiver = UdpReceiver("127.0.0.1", 0, ring_size=8, batch_size=3, slot_size=64, timeout=0.5)
+        receiver._use_recvmsg = receiver._use_recvmsg and use_recvmsg
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for payload in (b"0" * 64, b"x" * 65, b"1", b"2", b"3"):
+            sock.sendto(payload, receiver.sock.getsockname())
+        time.sleep(0.05)
+        first, second = receiver.recv_batch(), receiver.recv_batch()
+        # The truncated datagram takes one of the batch_size receives.
+        assert [bytes(data) for data, _ in first] == [b"0" * 64, b"1"]
+        assert [bytes(data) for data, _ in second] == [b"2", b"3"]
+        assert receiver.stats.truncated == 1 and receiver.stats.packets == 4
+        sock.close()
+        receiver.close()
+    print("Receiver batches passed.")
+
+def test_replay_smoke(base_dir:str):
+    # A short 3-lap race from one console through the in-process relay of
+    # the replay benchmark, in both runtimes: it is received in full, sent
+    # to IoT Hub and its recording uploaded.
+    parser = TelemetryParser(os.path.join(base_dir, "config", "telemetry_format"))
+    packets, times = synthesize_session(parser, n_laps=3, lap_time=4, idle_seconds=1)
+    for mode in ("threads", "async"):
+        result = run_harness(base_dir, packets, times, n_consoles=1, speed=4, mode=mode)
+        assert result["received"] == result["sent"] == len(packets), result
+        assert result["messages"] > 0 and result["uploads"] > 0, result
+    print("Replay smoke run passed.")
+
+def test_pipeline_policies():
+    # drop_oldest evicts the oldest item and hands it to on_drop, block
+    # waits for the consumer, and sample keeps 1 of every sample_every items
+    # above half full.
+    dropped = []
+    drop_queue = BoundedQueue(maxsize=4, policy="drop_oldest", on_drop=dropped.append)
+    for i in range(6):
+        drop_queue.put(i)
+    assert [drop_queue.get()[1] for _ in range(4)] == [2, 3, 4, 5]
+    assert dropped == [0, 1] and drop_queue.dropped == 2
+
+    block_queue = BoundedQueue(maxsize=2, policy="block")
+    producer = threading.Thread(target=lambda: [block_queue.put(i) for i in range(4)])
+    producer.start()
+    time.sleep(0.1)
+    assert producer.is_alive() and len(block_queue) == 2
+    assert [block_queue.get(timeout=1)[1] for _ in range(4)] == [0, 1, 2, 3]
+    producer.join(1)
+    assert not producer.is_alive() and block_queue.dropped == 0
+
+    dropped = []
+    sample_queue = BoundedQueue(maxsize=8, policy="sample", sample_every=4, on_drop=dropped.append)
+    for i in range(20):
+        sample_queue.put(i)
+    kept = [sample_queue.get()[1] for _ in range(len(sample_queue))]
+    assert kept[:4] == [0, 1, 2, 3] and all(i % 4 == 3 for i in kept[4:])
+    assert sorted(kept + dropped) == list(range(20)) and sample_queue.dropped == len(dropped)
+
+    # Stages drain their queues on stop, upstream first.
+    handled = []
+    pipeline = Pipeline()
+    pipeline.add_stage("double", lambda i: pipeline.put("collect", 2 * i), policy="block")
+    pipeline.add_stage("collect", handled.append, policy="block")
+    pipeline.start()
+    for i in range(100):
+        pipeline.put("double", i)
+    pipeline.stop()
+    assert handled == [2 * i for i in range(100)]
+    print("Pipeline policies passed.")
+
+def test_recording_round_trip(base_dir:str, n_packets:int=250):
+    # Raw and columnar recordings read back the packets and receive times
+    # they were written with, from the packet or from the decoded dict, and
+    # across chunks and appends; the CSV export matches the CSV recorder.
+    parser = TelemetryParser(os.path.join(base_dir, "config", "telemetry_format"))
+    packets = make_packets(parser, n_packets)
+    expected = parser.parse_batch(packets)
+    recv_times = [1584431035.0 + i / 60.0 for i in range(n_packets)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for backend in ("raw", "columnar"):
+            fname = os.path.join(tmp_dir, "telemetry" + recorder_ext(backend))
+            half = n_packets // 2
+            for append, rows in ((False, range(half)), (True, range(half, n_packets))):
+                recorder = create_recorder(backend, fname, parser, append, chunk_rows=64)
+                for i in rows:
+                    udp_data = packets[i] if i % 2 else None
+                    recorder.write(parser.parse(packets[i]), udp_data, recv_times[i])
+                recorder.close()
+            rows = read_recording(fname, parser.dtype)
+            for name in parser.fields:
+                assert rows[name].tobytes() == expected[name].tobytes(), (backend, name)
+            if backend == "raw":
+                assert read_raw_log(fname, parser.dtype)["recv_time"].tolist() == recv_times
+            else:
+                assert read_columnar(fname)["recv_time"].tolist() == recv_times
+            csv_fname = os.path.join(tmp_dir, "export_{}.csv".format(backend))
+            export_csv(fname, csv_fname, parser.dtype)
+
+        recorder = CsvRecorder(os.path.join(tmp_dir, "telemetry.csv"), parser, False)
+        for data in packets:
+            recorder.write(parser.parse(data))
+        recorder.close()
+        with open(os.path.join(tmp_dir, "telemetry.csv"), "r") as f:
+            csv_rows = f.read()
+        for backend in ("raw", "columnar"):
+            with open(os.path.join(tmp_dir, "export_{}.csv".format(backend)), "r") as f:
+                assert f.read() == csv_rows, backend
+    print("Recording round trip passed.")
+
+def test_work_queue():
+    # A failing job is retried with backoff until it succeeds, one that
+    # keeps failing is kept as failed, and a job not done at shutdown, even
+    # one still running past the drain or the join timeout, is resumed
+    # after a restart.
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        journal_fname = os.path.join(tmp_dir, "work_queue.sqlite")
+        attempts = {"flaky": 0, "broken": 0}
+        def handler(payload):
+            attempts[payload["name"]] += 1
+            if payload["name"] == "broken" or attempts["flaky"] < 3:
+                raise ConnectionError("Network is down.")
+        work_queue = WorkQueue(journal_fname, {"message": handler}, max_retries=4, retry_base_delay=0.01)
+        work_queue.start()
+        work_queue.submit("message", {"name": "flaky"})
+        work_queue.submit("message", {"name": "broken"})
+        deadline = time.time() + 5
+        while work_queue.stats()["message"]["done"] + work_queue.stats()["message"]["failed"] < 2 \
+                and time.time() < deadline:
+            time.sleep(0.01)
+        work_queue.shutdown()
+        assert attempts == {"flaky": 3, "broken": 4}
+        assert work_queue.done["message"] == 1 and work_queue.failed["message"] == 1
+
+        started = threading.Event()
+        def slow_handler(payload):
+            started.set()
+            time.sleep(0.3)
+            raise ConnectionError("Network is down.")
+        work_queue = WorkQueue(journal_fname, {"upload": slow_handler}, retry_base_delay=60)
+        work_queue.start()
+        work_queue.submit("upload", {"path": "telemetry.csv"})
+        started.wait(1)
+        work_queue.shutdown(drain_timeout=0.05)
+        assert work_queue.retries["upload"] == 1
+
+        # A handler blocked past the join timeout does not hold up the
+        # shutdown, and its job stays pending.
+        blocked_fname = os.path.join(tmp_dir, "work_queue_blocked.sqlite")
+        release = threading.Event()
+        def blocked_handler(payload):
+            started.set()
+            release.wait(5)
+        started.clear()
+        work_queue = WorkQueue(blocked_fname, {"upload": blocked_handler})
+        work_queue.start()
+        work_queue.submit("upload", {"path": "telemetry_blocked.csv"})
+        started.wait(1)
+        start = time.time()
+        work_queue.shutdown(drain_timeout=0.05, join_timeout=0.1)
+        assert time.time() - start < 1
+        assert WorkQueue(blocked_fname, {"upload": blocked_handler}).stats()["upload"]["depth"] == 1
+        release.set()
+
+        done = []
+        work_queue = WorkQueue(journal_fname, {"upload": done.append})
+        assert work_queue.stats()["upload"]["depth"] == 1
+        work_queue.start()
+        work_queue.shutdown()
+        assert done == [{"path": "telemetry.csv"}]
+        assert WorkQueue(journal_fname, {"upload": done.append}).stats()["upload"]["depth"] == 0
+    print("Work queue passed.")
+
+def test_message_batcher():
+    # One payload per window of 1 s, from samples taken at most 8 times
+    # per second, in every mode but reduce (see test_streaming_reducer).
+    samples = [{"Speed": float(i), "Gear": 1 + i // 20, "IsRaceOn": 1} for i in range(60)]
+    times = [i / 32.0 for i in range(60)]
+    payloads = {}
+    for mode in ("single", "columnar", "delta", "stats"):
+        batcher = MessageBatcher(mode=mode, window=1, rate=8, fields=["Speed", "Gear"])
+        payloads[mode] = [p for p in (batcher.add(s, t) for s, t in zip(samples, times)) if p is not None]
+        assert len(payloads[mode]) == 1 and batcher.flush() is not None and batcher.flush() is None
+    kept = [samples[i] for i in range(0, 33, 4)]
+    assert payloads["single"][0] == {"Speed": 32.0, "Gear": 2}
+    columnar = payloads["columnar"][0]
+    assert columnar["Speed"] == [s["Speed"] for s in kept] and "IsRaceOn" not in columnar
+    assert columnar["t"] == [round(t, 4) for t in times[:33:4]]
+    delta = payloads["delta"][0]
+    assert delta["first"] == {"Speed": 0.0, "Gear": 1}
+    assert [d.get("Gear") for d in delta["deltas"]] == [None] * 4 + [2] + [None] * 3
+    assert all(d["Speed"] == s["Speed"] for d, s in zip(delta["deltas"], kept[1:]))
+    stats = payloads["stats"][0]
+    assert stats["count"] == len(kept) and stats["Speed"]["max"] == 32.0 and stats["Gear"]["last"] == 2
+    assert stats["Speed"]["mean"] == sum(s["Speed"] for s in kept) / len(kept)
+
+    # JSON and CBOR (RFC 7049 appendix A layout) bodies, deflated on demand.
+    data = {"a": 1, "b": [1.5, None, True]}
+    body, content_type, content_encoding = encode_message(data, "cbor")
+    assert body == bytes.fromhex("a2616101616283fa3fc00000f6f5") and content_encoding is None
+    body, content_type, content_encoding = encode_message(data, "json", compress=True)
+    assert json.loads(zlib.decompress(body).decode("utf-8")) == data
+    assert (content_type, content_encoding) == ("application/json", "deflate")
+    print("Message batcher passed.")
+
+def test_async_runtime(base_dir:str):
+    # A race through the event loop runtime: a message whose send fails
+    # is journaled and delivered by the work queue, the race summary too,
+    # and the recording is written by the file I/O thread and uploaded.
+    from main import AsyncForzaIoTApp
+    from local_iothub import LocalAsyncDeviceClient, LocalMessage
+    parser = TelemetryParser(os.path.join(base_dir, "config", "telemetry_format"))
+    packets, times = synthesize_session(parser, n_laps=3, lap_time=2, idle_seconds=0.5)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        blob_server = LocalBlobServer().start()
+        device_client = LocalAsyncDeviceClient(blob_server, fail_sends=1)
+        app = AsyncForzaIoTApp(tmp_dir, None, device_client, LocalMessage,
+                               forza_config=_relay_config(base_dir, tmp_dir))
+        app.uploader.scheme = "http"
+        app_thread = threading.Thread(target=app.run, daemon=True)
+        app_thread.start()
+        app.device.wait(5)
+        replay(packets, times, app.sock.getsockname(), 1, speed=2)
+        deadline = time.time() + 10
+        while app.work_queue.stats()["upload"]["done"] == 0 and time.time() < deadline:
+            time.sleep(0.05)
+        app.stop()
+        app_thread.join()
+        blob_server.stop()
+        work_queue_stats = app.work_queue.stats()
+        # The failed live message and the race summary went through the journal.
+        assert work_queue_stats["message"]["done"] == 2 and work_queue_stats["upload"]["done"] == 1
+        assert app.record_latency.count == app.packets_recorded.value > 0
+        summaries = [message for _, message in device_client.messages
+                     if message.custom_properties.get("message_type") == "race_summary"]
+        assert len(summaries) == 1 and len(device_client.messages) >= 4
+        blob, = blob_server.blobs.values()
+        assert blob.count(b"\n") == app.packets_recorded.value + 1
+    print("Async runtime passed.")
+
+def _supervised_worker(worker_id:int, counters, crash_after:float):
+    # Worker of test_supervisor: reports its counters, and worker 1 crashes.
+    started = time.time()
+    while True:
+        counters.update(worker_id, {
+            "receiver": {"packets": 10 * (worker_id + 1), "bytes": 0, "drops": 0},
+            "pipeline": {"parser": {"dropped": 1, "depth": 2}},
+            "work_queue": {"message": {"done": 3}},
+        })
+        if worker_id == 1 and time.time() - started > crash_after:
+            os._exit(1)
+        time.sleep(0.02)
+
+def test_supervisor():
+    # Each worker gets its own share of the port and files; a crashing
+    # worker is restarted with backoff, the others keep running, and the
+    # counters of all workers are aggregated.
+    forza_config = {
+        "device": {"receive_port": 6669, "log_fname": "forza_iot.log", "output_fname": "data/telemetry.csv"},
+        "work_queue": {},
+        "metrics": {"port": 9108, "snapshot_fname": "data/metrics.json"},
+        "spool": {"dir": "data/spool"},
+        "formats": {"cache_fname": "data/telemetry_formats.json"},
+    }
+    config = shard_config(json.loads(json.dumps(forza_config)), 2, "ports")
+    assert config["device"]["receive_port"] == 6671 and config["metrics"]["port"] == 9110
+    assert config["work_queue"]["journal_fname"] == os.path.join("data", "work_queue_w2.sqlite")
+    assert config["device"]["log_fname"] == "forza_iot_w2.log"
+    assert config["spool"]["dir"] == "data/spool_w2" and config["archive"]["dir"] == "data/archive_w2"
+    assert config["formats"]["cache_fname"] == "data/telemetry_formats_w2.json"
+    assert config["device"]["output_fname"] == "data/telemetry.csv"
+    config = shard_config(json.loads(json.dumps(forza_config)), 2, "reuseport")
+    assert config["device"]["receive_port"] == 6669 and config["device"]["recv_reuse_port"]
+    assert config["device"]["output_fname"] == "data/telemetry_w2.csv"
+
+    supervisor = Supervisor(_supervised_worker, 2, args=(0.2,), restart_delay=0.1, max_restart_delay=1)
+    supervisor.start()
+    first_pid = supervisor.processes[0].pid
+    deadline = time.time() + 10
+    while supervisor.restarts[1] < 2 and time.time() < deadline:
+        supervisor._check_workers()
+        time.sleep(0.05)
+    stats = supervisor.stats()
+    supervisor.shutdown(timeout=1)
+    assert supervisor.restarts == [0, 2] and supervisor.processes[0].pid == first_pid
+    # The restart delay doubles as worker 1 keeps crashing soon after it starts.
+    assert supervisor._delays == [0.1, 0.4]
+    assert stats["totals"]["packets"] in (10, 30) and stats["totals"]["messages"] in (3, 6)
+    print("Supervisor passed.")
+
+def test_metrics(base_dir:str):
+    # The registry fed from the forwarder statistics renders valid
+    # Prometheus names, with the target as a label, the snapshot file holds
+    # the same values, and USR1 writes a profile of the running threads.
+    parser = TelemetryParser(os.path.join(base_dir, "config", "telemetry_format"))
+    packets = make_packets(parser, 10)
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    forwarder = Forwarder([{"ip": "127.0.0.1", "port": sink.getsockname()[1]}], [parser.dtype])
+    for packet in packets:
+        forwarder.forward(memoryview(packet), ("192.168.1.20", 1024))
+    registry = MetricsRegistry()
+    registry.counter("packets_parsed", "Packets parsed.").inc(10)
+    latency = registry.histogram("parse_seconds", "Receive to parse.")
+    for seconds in (1e-5, 1e-3, 0.2):
+        latency.record(seconds)
+    registry.add_collector(lambda: {"forwarder": forwarder.stats()}, labels={"forwarder": "target"})
+    server = MetricsServer(registry, port=0).start()
+    with urllib.request.urlopen("http://127.0.0.1:{}/metrics".format(server.port)) as response:
+        text = response.read().decode("utf-8")
+    server.stop()
+    target = "127.0.0.1:{}".format(sink.getsockname()[1])
+    for line in text.splitlines():
+        if line.startswith("#"):
+            name = line.split(" ")[2]
+        else:
+            name = line.split("{")[0].split(" ")[0]
+        assert re.match("^[a-zA-Z_:][a-zA-Z0-9_:]*$", name), line
+    lines = text.splitlines()
+    assert 'forza_forwarder_sent{{target="{}"}} 10'.format(target) in lines
+    assert "forza_packets_parsed_total 10" in lines and "forza_parse_seconds_count 3" in lines
+    assert 'forza_parse_seconds_bucket{le="0.001"} 2' in lines
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fname = os.path.join(tmp_dir, "metrics", "metrics.json")
+        writer = SnapshotWriter(registry, fname, interval=0.05).start()
+        time.sleep(0.2)
+        registry.counter("packets_parsed").inc()
+        writer.stop()
+        with open(fname, "r") as f:
+            snapshot = json.load(f)
+        assert snapshot["counters"] == {"packets_parsed": 11}
+        assert snapshot["histograms"]["parse_seconds"]["count"] == 3
+        assert sum(snapshot["histograms"]["parse_seconds"]["counts"]) == 3
+        assert snapshot["gauges"]['forwarder_sent{{target="{}"}}'.format(target)] == 10
+        assert not os.path.exists(fname + ".tmp")
+
+        if hasattr(signal, "SIGUSR1"):
+            previous = signal.getsignal(signal.SIGUSR1), signal.getsignal(signal.SIGUSR2)
+            profile_dir = os.path.join(tmp_dir, "profiles")
+            assert ProfilerHook(profile_dir, interval=0.001).install()
+            os.kill(os.getpid(), signal.SIGUSR1)
+            time.sleep(0.1)
+            os.kill(os.getpid(), signal.SIGUSR1)
+            time.sleep(0.01)
+            signal.signal(signal.SIGUSR1, previous[0])
+            signal.signal(signal.SIGUSR2, previous[1])
+            profiles = os.listdir(profile_dir)
+            assert len(profiles) == 1 and profiles[0].endswith(".folded")
+            with open(os.path.join(profile_dir, profiles[0]), "r") as f:
+                stacks = f.read().splitlines()
+            assert stacks and all(line.rsplit(" ", 1)[1].isdigit() for line in stacks)
+    forwarder.close()
+    sink.close()
+    print("Metrics passed.")
+
 if __name__ == "__main__":
-    
+
     parser = argparse.ArgumentParser(description='Run Forza IoT demo test scripts.')
     parser.add_argument('--base_dir', dest='base_dir', default=BASE_DIR,
                     help='Base directory of the Forza IoT demo repository.')
     parser.add_argument('--config', dest='config_path', default=CONFIG_FNAME,
                     help='Path of the config file, relevant to BASE_DIR.')
+    parser.add_argument('--local', dest='local', action='store_true',
+                    help='Only run the tests against local stand-ins, without Azure.')
     args = parser.parse_args()
-    
+
+    # Test file_upload.BlobUploader against the local blob stand-in
+    test_streaming_upload(compress=False)
+    test_streaming_upload(compress=True)
+    # Test udp_receiver.UdpReceiver batching and truncation
+    test_receiver_batches()
+    # Test udp_receiver.UdpReceiver slots handed back out of order
+    test_receiver_ring()
+    # Test pipeline.BoundedQueue backpressure policies and Pipeline drain
+    test_pipeline_policies()
+    # Test forza_telemetry.TelemetryParser parse_into and parse_batch against parse
+    test_parse_paths(args.base_dir)
+    # Test recording raw and columnar write, read back and CSV export
+    test_recording_round_trip(args.base_dir)
+    # Test forza_telemetry.TelemetryRecord against the packet
+    test_record_view(args.base_dir)
+    # Test segmentation.segment_session against race_state.RaceStateMachine
+    test_segmentation(args.base_dir)
+    # Test race_summary.RaceSummary against NumPy
+    test_race_summary(args.base_dir)
+    # Test forwarder.Forwarder field filtering and decimation
+    test_forwarder(args.base_dir)
+    # Test metrics.MetricsRegistry export, SnapshotWriter and the profiler trigger
+    test_metrics(args.base_dir)
+    # Test telemetry_formats.FormatRegistry dispatch and layout cache
+    test_format_registry(args.base_dir)
+    # Test message_batcher.MessageBatcher windows, modes and encodings
+    test_message_batcher()
+    # Test message_batcher.MessageBatcher reduce mode
+    test_streaming_reducer()
+    # Test archive.SessionArchive index and memory-mapped reads
+    test_archive(args.base_dir)
+    # Test spool.SpoolManager with WorkQueue and BlobUploader offline
+    test_spool()
+    # Test work_queue.WorkQueue retries and resume after a restart
+    test_work_queue()
+    # Test supervisor.Supervisor restarts and shard_config
+    test_supervisor()
+    # Test device_connection.DeviceConnection against a hub that is down
+    test_device_connection()
+    # Test settings.ConfigWatcher reloading a running relay
+    test_config_reload(args.base_dir)
+    # Test the event loop runtime with failing IoT Hub sends
+    test_async_runtime(args.base_dir)
+    # Smoke run of replay.run_harness in both runtimes
+    test_replay_smoke(args.base_dir)
+    if args.local:
+        exit(0)
+
     with open(os.path.join(args.base_dir, args.config_path), "r") as f:
         forza_config = json.load(f)
     with open(os.path.join(args.base_dir, forza_config["iothub"]["conn_str_fname"]), "r") as f:
         conn_str = f.read()
-    
+
     # Test file_upload.upload_file_through_iothub
     upload_file_name = os.path.join(BASE_DIR, "data/telemetry_20200317074355.csv")
     #upload_file_through_iothub(conn_str, path_to_file=upload_file_name, file_name=upload_file_name)
@@ -0,0 +1,187 @@
+import sys
+import time
+import socket
+import select
+import threading
+
+# Linux reports the number of datagrams the kernel dropped on a socket
+# as ancillary data once SO_RXQ_OVFL is enabled.
+SO_RXQ_OVFL = getattr(socket, "SO_RXQ_OVFL", 40)
+
+class ReceiverStats():
+
+    def __init__(self):
+        self.packets = 0        # datagrams handed to the application
+        self.batches = 0        # non-empty batches returned by recv_batch
+        self.bytes = 0
+        self.truncated = 0      # datagrams larger than a ring slot
+        self.kernel_drops = 0   # datagrams dropped by the kernel (Linux only)
+        self.overruns = 0       # recv_batch calls that found the ring full
+
+    @property
+    def drops(self) -> int:
+        return self.truncated + self.kernel_drops
+
+    def as_dict(self) -> dict:
+        return {
+            "packets": self.packets,
+            "batches": self.batches,
+            "bytes": self.bytes,
+            "truncated": self.truncated,
+            "kernel_drops": self.kernel_drops,
+            "drops": self.drops,
+            "overruns": self.overruns,
+        }
+
+def enable_reuse_port(sock:socket.socket):
+    # Several processes bind the same port and the kernel spreads the
+    # datagrams over them by source address (Linux, BSD).
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise OSError("SO_REUSEPORT is not supported on this platform.")
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+class UdpReceiver():
+    """
+    Drain a UDP socket in batches into a ring of preallocated buffers.
+
+    recv_batch() returns a list of (memoryview, addr) tuples. The memoryviews
+    point into the ring and stay valid until the slots are handed back with
+    share(batch).done(). Batches may be handed back in any order, e.g. when a
+    queue drops a newer batch than the one being parsed, and from another
+    thread; a slot is only reused once it and all older slots are free.
+    """
+
+    def __init__(self,
+                 recv_ip:str,
+                 recv_port:int,
+                 recv_buffer_size:int=4*1024*1024,
+                 ring_size:int=1024,
+                 batch_size:int=64,
+                 slot_size:int=1024,
+                 timeout:float=1,
+                 reuse_port:bool=False):
+
+        self.sock = socket.socket(socket.AF_INET, # Internet
+                                  socket.SOCK_DGRAM) # UDP
+        # A large kernel buffer absorbs bursts while the loop is busy,
+        # e.g. flushing a file.
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, recv_buffer_size)
+        if reuse_port:
+            enable_reuse_port(self.sock)
+        self.sock.bind((recv_ip, recv_port))
+        # Wait with select() instead of a socket timeout, so that a batch
+        # can be drained without blocking and keyboard interupt can still
+        # be received.
+        self.sock.setblocking(False)
+        self.timeout = timeout
+
+        self.ring_size = ring_size
+        self.batch_size = batch_size
+        self.slot_size = slot_size
+        # Every slot has a spare byte, so a datagram larger than slot_size
+        # fills it and is reported as truncated on every platform.
+        self._stride = slot_size + 1
+        self._ring = bytearray(ring_size * self._stride)
+        self._ring_view = memoryview(self._ring)
+        self._head = 0  # next slot to fill
+        self._tail = 0  # oldest slot handed out
+        self._used = 0  # slots from tail to head, released or not
+        self._released = bytearray(ring_size)  # 1 for a slot released ahead of tail
+        self._used_lock = threading.Lock()
+        self._batch_start = 0  # first slot of the last batch
+
+        self.stats = ReceiverStats()
+        self._last_kernel_drops = 0
+        self._use_recvmsg = sys.platform.startswith("linux") and hasattr(self.sock, "recvmsg_into")
+        if self._use_recvmsg:
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+                self._anc_size = socket.CMSG_SPACE(4)
+            except OSError:
+                self._use_recvmsg = False
+
+    def _recv_into(self, slot:memoryview):
+        if not self._use_recvmsg:
+            nbytes, addr = self.sock.recvfrom_into(slot)
+            return nbytes, addr, nbytes > self.slot_size
+        nbytes, ancdata, flags, addr = self.sock.recvmsg_into([slot], self._anc_size)
+        for level, kind, value in ancdata:
+            if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL:
+                kernel_drops = int.from_bytes(value[:4], sys.byteorder)
+                self.stats.kernel_drops += kernel_drops - self._last_kernel_drops
+                self._last_kernel_drops = kernel_drops
+        return nbytes, addr, nbytes > self.slot_size or bool(flags & socket.MSG_TRUNC)
+
+    def recv_batch(self) -> list:
+        # Returns an empty list after timeout seconds without data.
+        free = self.ring_size - self._used
+        if free == 0:
+            # The consumer is behind. Leave the packets in the kernel buffer.
+            self.stats.overruns += 1
+            time.sleep(0.001)
+            return []
+        readable, _, _ = select.select([self.sock], [], [], self.timeout)
+        if not readable:
+            return []
+
+        batch = []
+        self._batch_start = self._head
+        for _ in range(min(free, self.batch_size)):
+            start = self._head * self._stride
+            slot = self._ring_view[start:start + self._stride]
+            try:
+                nbytes, addr, truncated = self._recv_into(slot)
+            except (BlockingIOError, InterruptedError):
+                break
+            if truncated:
+                self.stats.truncated += 1
+                continue
+            batch.append((slot[:nbytes], addr))
+            self._head = (self._head + 1) % self.ring_size
+            self.stats.bytes += nbytes
+
+        if batch:
+            with self._used_lock:
+                self._used += len(batch)
+            self.stats.packets += len(batch)
+            self.stats.batches += 1
+        return batch
+
+    def release(self, first_slot:int, n_slots:int):
+        # Hand n_slots from first_slot back to the ring, and move the tail
+        # over the free slots.
+        with self._used_lock:
+            for i in range(first_slot, first_slot + n_slots):
+                self._released[i % self.ring_size] = 1
+            while self._used and self._released[self._tail]:
+                self._released[self._tail] = 0
+                self._tail = (self._tail + 1) % self.ring_size
+                self._used -= 1
+
+    def share(self, batch:list, n_consumers:int) -> "SharedBatch":
+        # Called with the batch just returned by recv_batch().
+        return SharedBatch(self, batch, n_consumers, self._batch_start)
+
+    def close(self):
+        self.sock.close()
+
+class SharedBatch():
+    """
+    A batch of recv_batch() handed to several consumers, e.g. the parser and
+    the forwarder, which all read the ring slots in place. The slots are
+    released when the last consumer calls done().
+    """
+
+    def __init__(self, receiver:UdpReceiver, batch:list, n_consumers:int, first_slot:int):
+        self.receiver = receiver
+        self.batch = batch
+        self.first_slot = first_slot
+        self._n_consumers = n_consumers
+        self._lock = threading.Lock()
+
+    def done(self):
+        with self._lock:
+            self._n_consumers -= 1
+            last = self._n_consumers == 0
+        if last:
+            self.receiver.release(self.first_slot, len(self.batch))
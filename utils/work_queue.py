@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import heapq
+import random
+import sqlite3
+import logging
+import threading
+
+class WorkQueue():
+    """
+    Durable work queue with per-kind concurrency limits and retries.
+
+    Jobs are JSON payloads journaled in SQLite before submit() returns, so the
+    jobs not done yet survive a restart of the relay. Each kind of job, e.g.
+    "message" or "upload", has its own handler and its own worker threads.
+    A failing job is retried with exponential backoff, until max_retries
+    attempts have failed and the job is kept in the journal as failed.
+    max_retries can be a dict per kind, where None retries until the job
+    succeeds, e.g. uploads while the uplink is down.
+
+    When a job succeeds after jobs of its kind failed, e.g. connectivity is
+    back, the backlog of that kind is made due at once, oldest first,
+    instead of waiting for the backoff of every job.
+    """
+
+    def __init__(self,
+                 journal_fname:str,
+                 handlers:dict,
+                 concurrency:dict=None,
+                 max_retries=10,
+                 retry_base_delay:float=1,
+                 retry_max_delay:float=300,
+                 logger:logging.Logger=None):
+        self.handlers = handlers
+        self.concurrency = concurrency or {}
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.logger = logger or logging.getLogger(__name__)
+
+        journal_dir = os.path.dirname(journal_fname)
+        if journal_dir and not os.path.isdir(journal_dir):
+            os.makedirs(journal_dir)
+        self._db = sqlite3.connect(journal_fname, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "kind TEXT NOT NULL, "
+            "payload TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "next_try REAL NOT NULL, "
+            "failed INTEGER NOT NULL DEFAULT 0, "
+            "last_error TEXT)")
+        self._db.commit()
+
+        self._lock = threading.Lock()
+        self._job_ready = threading.Condition(self._lock)
+        self._pending = {kind: [] for kind in handlers}  # heaps of (next_try, id)
+        self._payloads = {}
+        self._stopping = False
+        self._threads = []
+        self._running = {}  # thread name -> (kind, job id) of the jobs in flight
+        self.in_flight = {kind: 0 for kind in handlers}
+        self.retries = {kind: 0 for kind in handlers}
+        self.done = {kind: 0 for kind in handlers}
+        self.failed = {kind: 0 for kind in handlers}
+        self._failing = {kind: False for kind in handlers}
+
+        # Reload the jobs a previous run did not finish.
+        now = time.time()
+        rows = self._db.execute(
+            "SELECT id, kind, payload, attempts FROM jobs WHERE failed = 0 ORDER BY id").fetchall()
+        for job_id, kind, payload, attempts in rows:
+            if kind not in handlers:
+                continue
+            self._payloads[job_id] = (kind, json.loads(payload), attempts)
+            heapq.heappush(self._pending[kind], (now, job_id))
+        if rows:
+            self.logger.info("Reloaded {} pending jobs from {}.".format(len(rows), journal_fname))
+
+    def submit(self, kind:str, payload:dict) -> int:
+        if kind not in self.handlers:
+            raise ValueError("No handler for job kind {}.".format(kind))
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO jobs (kind, payload, next_try) VALUES (?, ?, ?)",
+                (kind, json.dumps(payload), now))
+            self._db.commit()
+            job_id = cursor.lastrowid
+            self._payloads[job_id] = (kind, payload, 0)
+            heapq.heappush(self._pending[kind], (now, job_id))
+            self._job_ready.notify_all()
+        return job_id
+
+    def start(self):
+        for kind in self.handlers:
+            for i in range(self.concurrency.get(kind, 1)):
+                thread = threading.Thread(
+                    target=self._worker, args=(kind,), name="{}-{}".format(kind, i), daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def shutdown(self, drain_timeout:float=10, join_timeout:float=5):
+        # Wait up to drain_timeout seconds for the jobs that are due to finish.
+        # Whatever is left stays in the journal for the next run.
+        deadline = time.time() + drain_timeout
+        with self._lock:
+            while time.time() < deadline and (any(self.in_flight.values()) or self._has_due_jobs()):
+                self._job_ready.wait(0.1)
+            self._stopping = True
+            self._job_ready.notify_all()
+        # Jobs started before the deadline get join_timeout more seconds to
+        # write their outcome to the journal. A handler still blocked, e.g.
+        # on an upload, is left behind: its job stays pending for the next
+        # run, and the journal stays open in case it finishes.
+        deadline = time.time() + join_timeout
+        for thread in self._threads:
+            thread.join(max(deadline - time.time(), 0))
+        with self._lock:
+            running = dict(self._running)
+        if running:
+            for name, (kind, job_id) in sorted(running.items()):
+                self.logger.warning("Job {} {} still running in {} at shutdown, left pending for the next run.".format(
+                    kind, job_id, name))
+            return
+        self._db.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                kind: {
+                    "depth": len(self._pending[kind]),
+                    "in_flight": self.in_flight[kind],
+                    "retries": self.retries[kind],
+                    "done": self.done[kind],
+                    "failed": self.failed[kind],
+                }
+                for kind in self.handlers
+            }
+
+    def _has_due_jobs(self) -> bool:
+        now = time.time()
+        return any(heap and heap[0][0] <= now for heap in self._pending.values())
+
+    def _drain_backlog(self, kind:str):
+        # Make the pending jobs of kind due now, in submission order.
+        # Called with the lock held.
+        heap = self._pending[kind]
+        if not heap:
+            return
+        now = time.time()
+        heap[:] = sorted((now, job_id) for _, job_id in heap)
+        self._db.execute("UPDATE jobs SET next_try = ? WHERE kind = ? AND failed = 0", (now, kind))
+        self.logger.warning("Jobs {} succeed again, draining {} pending jobs oldest first.".format(kind, len(heap)))
+
+    def _worker(self, kind:str):
+        heap = self._pending[kind]
+        while True:
+            with self._lock:
+                while not self._stopping:
+                    now = time.time()
+                    if heap and heap[0][0] <= now:
+                        break
+                    self._job_ready.wait(min(heap[0][0] - now, 1) if heap else 1)
+                if self._stopping:
+                    return
+                _, job_id = heapq.heappop(heap)
+                _, payload, attempts = self._payloads[job_id]
+                self.in_flight[kind] += 1
+                self._running[threading.current_thread().name] = (kind, job_id)
+
+            error = None
+            try:
+                self.handlers[kind](payload)
+            except Exception as e:
+                error = e
+
+            with self._lock:
+                self.in_flight[kind] -= 1
+                del self._running[threading.current_thread().name]
+                max_retries = self.max_retries
+                if isinstance(max_retries, dict):
+                    max_retries = max_retries.get(kind, 10)
+                if error is None:
+                    self.done[kind] += 1
+                    del self._payloads[job_id]
+                    self._db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+                    if self._failing[kind]:
+                        self._failing[kind] = False
+                        self._drain_backlog(kind)
+                elif max_retries is not None and attempts + 1 >= max_retries:
+                    self.failed[kind] += 1
+                    del self._payloads[job_id]
+                    self._db.execute(
+                        "UPDATE jobs SET attempts = ?, failed = 1, last_error = ? WHERE id = ?",
+                        (attempts + 1, str(error), job_id))
+                    self.logger.error("Job {} {} failed after {} attempts: {}".format(
+                        kind, job_id, attempts + 1, error))
+                else:
+                    self._failing[kind] = True
+                    self.retries[kind] += 1
+                    # Exponential backoff with jitter. The exponent is capped
+                    # first, a float base overflows after ~1000 attempts.
+                    delay = min(self.retry_max_delay, self.retry_base_delay * 2 ** min(attempts, 30))
+                    next_try = time.time() + delay * random.uniform(0.5, 1)
+                    self._payloads[job_id] = (kind, payload, attempts + 1)
+                    heapq.heappush(heap, (next_try, job_id))
+                    self._db.execute(
+                        "UPDATE jobs SET attempts = ?, next_try = ?, last_error = ? WHERE id = ?",
+                        (attempts + 1, next_try, str(error), job_id))
+                    self.logger.warning("Job {} {} failed, retry in {:.1f} s: {}".format(
+                        kind, job_id, delay, error))
+                self._db.commit()
+                self._job_ready.notify_all()